@@ -0,0 +1,229 @@
+'''
+analytics contains the session analysis: recordings loaded into columnar NumPy arrays, and the trial statistics
+
+Each source is loaded into a Session: for every channel, the onset and offset times (seconds since the session
+start) as float arrays. Everything else is computed on those arrays with searchsorted / diff / histogram, with no
+per-row Python loop, so an hour-long session takes milliseconds:
+
+    trials      onsets of the profile's trial channels (cue onsets in cuedtaste, poke light onsets in basic_np, ...)
+    latency     from the profile's latency start to its end (s): arming poke -> reward (cuedtaste), trial onset ->
+                poke where no poke arms the reward; the last start before each end, within [window]
+    missed      trials with no reward within [deadline] s of the trial onset (cuedtaste's crosstime)
+    iti         intervals between consecutive trial onsets (s)
+    poke rate   poke onsets per minute, over the session and per [bin_s] bin
+
+    python analytics.py sessions/*.rigevt sessions/pipi2_log.csv output_times.csv [--bin 60] [--json]
+
+Sources: event streams (.rigevt: ProtocolEngine recordings, CuedTaste record()), pipi2 EventLog CSVs (one Session per
+"Animal ID"), and the output_times.csv delivery lists of pi_rig/jet_rig passive sessions (ctime stamps, 1 s).
+'''
+
+import argparse
+import collections
+import csv
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+
+from event_log import parse_timestamps
+from event_stream import StreamReader, EXTENSION
+
+VERSION = 2  # bump whenever analyze() results change, so cached results (see cohort) are recomputed
+
+# How a protocol's channels map onto the statistics. pokes = channels whose onsets are pokes, trials = channels
+# whose onsets start a trial, rewards = channels whose onsets are rewards, latency = (start channels, end channels)
+# of the latency (None = no latency), window = longest start -> end time counted as a latency (s), deadline = seconds
+# a trial has to be rewarded in (None = no deadline).
+# The poke that delivers a reward is not a latency start (that latency would only be software lag): the start is
+# the poke that arms the reward (cuedtaste's Poke2), or the trial onset where no poke arms it.
+Profile = collections.namedtuple('Profile', ['pokes', 'trials', 'rewards', 'latency', 'window', 'deadline'])
+
+CUEDTASTE_LINES = ['Line1', 'Line2', 'Line3', 'Line4']
+PASSIVE_VALVES = ['valves' + str(i) for i in range(12)]  # ProtocolEngine channels of the passive protocols' lines
+
+PROFILES = {
+    'cuedtaste': Profile(['Poke1', 'Poke2'], ['Cue1', 'Cue2', 'Cue3', 'Cue4'], CUEDTASTE_LINES,
+                         (['Poke2'], CUEDTASTE_LINES), 10, 10),
+    'basic_np': Profile(['poke'], ['lights'], ['valve'], (['lights'], ['poke']), 60, None),
+    'odor_np': Profile(['poke'], ['houselight'], ['valve'], (['houselight'], ['poke']), 60, None),
+    'pipi2': Profile(['poke'], ['trial'], ['Water_solenoid'], (['trial'], ['poke']), 60, None),
+    'passive': Profile([], ['delivery'], ['delivery'], None, 0, None),
+    'passive_cue': Profile([], ['cue'], PASSIVE_VALVES, None, 0, None),
+    'affective': Profile([], ['marker'], [], None, 0, None),  # trials = the start and end marks
+}
+
+
+class Session:
+    # onsets / offsets = channel -> sorted float64 arrays of seconds since the start. start = clock.time() at t = 0,
+    # if known. duration = seconds covered by the source.
+    def __init__(self, source, protocol, onsets, offsets, duration, start=None):
+        self.source = source
+        self.protocol = protocol
+        self.onsets = onsets
+        self.offsets = offsets
+        self.duration = duration
+        self.start = start
+
+    @property
+    def channels(self):
+        return list(self.onsets)
+
+    # Sorted onsets of several channels together
+    def onsets_of(self, channels):
+        arrays = [self.onsets[name] for name in channels if name in self.onsets]
+        return np.sort(np.concatenate(arrays)) if arrays else np.zeros(0)
+
+    def __repr__(self):
+        return ('Session(' + os.path.basename(self.source) + ', ' + str(self.protocol) + ', ' +
+                str(round(self.duration, 1)) + ' s, ' + str(len(self.onsets)) + ' channels)')
+
+
+# Loaders
+
+def load_stream(filename):
+    reader = StreamReader(filename)
+    times = np.asarray(reader.records['t_ns']) / 1e9
+    states = reader.states()
+    previous = np.vstack([np.zeros((1, len(reader.channels)), dtype=bool), states[:-1]])
+    rises = states & ~previous
+    falls = ~states & previous
+    onsets = {name: times[rises[:, i]] for i, name in enumerate(reader.channels)}
+    offsets = {name: times[falls[:, i]] for i, name in enumerate(reader.channels)}
+    protocol = reader.header.get('protocol') or ('cuedtaste' if 'Cue1' in reader.channels else None)
+    return Session(filename, protocol, onsets, offsets, float(times[-1]) if len(times) else 0.0,
+                   reader.header.get('starttime'))
+
+
+# One Session per "Animal ID" in a pipi2 EventLog CSV. Channels: 'trial' ("=== Trial n ==="), 'poke' (the first
+# event after each "Waiting for IR beam", logged as soon as the beam is crossed), and every "<name> turned On/Off".
+def load_event_log(filename):
+    with open(filename, newline='') as f:
+        rows = [row for row in csv.reader(f) if len(row) >= 2]
+    times = parse_timestamps([row[0] for row in rows])
+    names = np.array([row[1] for row in rows], dtype=str)
+    starts = np.flatnonzero(np.char.startswith(names, 'Animal ID'))
+    if not len(starts) or starts[0] != 0:
+        starts = np.r_[0, starts]
+    sessions = []
+    for first, last in zip(starts, np.r_[starts[1:], len(names)]):
+        t = times[first:last] - times[first]
+        n = names[first:last]
+        onsets = {'trial': t[np.char.startswith(n, '=== Trial')]}
+        waiting = np.flatnonzero(np.char.startswith(n, 'Waiting for IR beam'))
+        onsets['poke'] = t[waiting[waiting + 1 < len(n)] + 1]
+        offsets = {'trial': np.zeros(0), 'poke': np.zeros(0)}
+        on = np.char.endswith(n, ' turned On')
+        off = np.char.endswith(n, ' turned Off')
+        channel = np.char.partition(n, ' turned ')[:, 0]
+        for name in np.unique(channel[on | off]):
+            onsets[name] = t[on & (channel == name)]
+            offsets[name] = t[off & (channel == name)]
+        sessions.append(Session(filename, 'pipi2', onsets, offsets, float(t[-1]) if len(t) else 0.0,
+                                float(times[first]) if len(t) else None))
+    return sessions
+
+
+# Session of a passive output_times.csv (one time.ctime() delivery time per row, written character by character)
+def load_output_times(filename):
+    with open(filename, newline='') as f:
+        stamps = [''.join(row) for row in csv.reader(f, delimiter=' ', quotechar='|') if row]
+    times = np.array([datetime.datetime.strptime(' '.join(stamp.split()), '%a %b %d %H:%M:%S %Y').timestamp()
+                      for stamp in stamps])
+    start = float(times[0]) if len(times) else None
+    deliveries = times - start if len(times) else times
+    return Session(filename, 'passive', {'delivery': deliveries}, {'delivery': np.zeros(0)},
+                   float(deliveries[-1]) if len(deliveries) else 0.0, start)
+
+
+# Every Session in [filename], by file type
+def load(filename):
+    if filename.endswith(EXTENSION):
+        return [load_stream(filename)]
+    if os.path.basename(filename).startswith('output_times'):
+        return [load_output_times(filename)]
+    return load_event_log(filename)
+
+
+# Statistics
+
+# For each time in [times], the index in [events] (sorted) of the last event at or before it, -1 if none
+def last_at_or_before(events, times):
+    return np.searchsorted(events, times, side='right') - 1
+
+
+# For each time in [times], whether any event of [events] (sorted) falls in [t + lo, t + hi]
+def any_within(events, times, lo, hi):
+    i = np.searchsorted(events, times + lo, side='left')
+    found = i < len(events)
+    found[found] = events[i[found]] <= times[found] + hi
+    return found
+
+
+# First end after each start - that start (s): an end answers the last start before it, and only the first end
+# answering a start counts (pipi2 opens the water twice). Latencies over [window] are dropped.
+def latencies(starts, ends, window):
+    i = last_at_or_before(starts, ends)
+    ends, i = ends[i >= 0], i[i >= 0]
+    i, first = np.unique(i, return_index=True)
+    latency = ends[first] - starts[i]
+    return latency[latency <= window]
+
+
+# Poke onsets per minute in consecutive [bin_s] bins
+def poke_rates(pokes, duration, bin_s=60):
+    edges = np.arange(0, max(duration, bin_s) + bin_s, bin_s)
+    counts, edges = np.histogram(pokes, bins=edges)
+    return counts * 60.0 / bin_s, edges
+
+
+def _stats(values, digits=3):
+    if not len(values):
+        return {'count': 0}
+    p5, p50, p95 = np.percentile(values, [5, 50, 95])
+    return {'count': int(len(values)), 'mean': round(float(np.mean(values)), digits),
+            'median': round(float(p50), digits), 'p5': round(float(p5), digits), 'p95': round(float(p95), digits),
+            'max': round(float(np.max(values)), digits)}
+
+
+def analyze(session, profile=None, bin_s=60):
+    profile = profile or PROFILES.get(session.protocol)
+    if profile is None:
+        raise ValueError('no analysis profile for protocol ' + str(session.protocol))
+    trials = session.onsets_of(profile.trials)
+    rewards = session.onsets_of(profile.rewards)
+    pokes = session.onsets_of(profile.pokes)
+    result = {'source': session.source, 'protocol': session.protocol, 'duration_s': round(session.duration, 3),
+              'trials': int(len(trials)), 'rewards': int(len(rewards)), 'pokes': int(len(pokes)),
+              'poke_rate_per_min': round(len(pokes) * 60 / session.duration, 3) if session.duration else 0.0}
+    if profile.latency is not None:
+        starts, ends = profile.latency
+        result['latency_s'] = _stats(latencies(session.onsets_of(starts), session.onsets_of(ends), profile.window))
+    if profile.deadline is not None:
+        missed = ~any_within(rewards, trials, 0, profile.deadline)
+        result['missed'] = int(np.sum(missed))
+        result['missed_fraction'] = round(float(np.mean(missed)), 4) if len(trials) else 0.0
+    result['iti_s'] = _stats(np.diff(trials))
+    rates, edges = poke_rates(pokes, session.duration, bin_s)
+    result['poke_rate_per_bin'] = [round(float(rate), 3) for rate in rates]
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Trial statistics of recorded sessions')
+    parser.add_argument('files', nargs='+', help='.rigevt streams, pipi2 EventLog CSVs, output_times.csv')
+    parser.add_argument('--bin', type=float, default=60, help='seconds per poke rate bin')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+    results = [analyze(session, bin_s=args.bin) for filename in args.files for session in load(filename)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        for result in results:
+            print(os.path.basename(result['source']) + ' (' + str(result['protocol']) + ')')
+            for key, value in result.items():
+                if key not in ('source', 'protocol'):
+                    print('    ' + key.ljust(20) + ' ' + str(value))
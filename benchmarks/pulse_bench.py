@@ -0,0 +1,82 @@
+'''
+pulse_bench measures valve pulse width error with plain time.sleep() versus the PulseEngine hybrid sleep/spin,
+idle and under synthetic CPU load (one busy process per core)
+
+    python benchmarks/pulse_bench.py --pulses 300 --width 0.012
+
+Runs on any Linux box: outputs go to rig_gpio.SimGPIO on the real clock, so only the timing is exercised.
+Add --realtime to run the engine on its SCHED_FIFO thread (needs root).
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pulse import PulseEngine
+from rig_gpio import SimGPIO
+
+
+def burn(stop):  # synthetic CPU load
+    x = 0
+    while not stop.is_set():
+        x = (x * 31 + 7) % 1000003
+
+
+def sleep_pulses(gpio, pins, width, n):  # what the rig codes did before: output, time.sleep, output
+    errors = []
+    for i in range(n):
+        gpio.output(pins, 1)
+        on_ns = time.perf_counter_ns()
+        time.sleep(width)
+        gpio.output(pins, 0)
+        errors.append((time.perf_counter_ns() - on_ns) / 1e6 - width * 1000)
+        time.sleep(0.002)
+    return errors
+
+
+def engine_pulses(engine, pins, width, n):
+    errors = []
+    for i in range(n):
+        record = engine.pulse(pins, width)
+        errors.append((record.measured_s - record.requested_s) * 1000)
+        time.sleep(0.002)
+    return errors
+
+
+def describe(name, errors):
+    errors = sorted(errors)
+    pick = lambda q: errors[min(len(errors) - 1, int(q * len(errors)))]
+    print(name.ljust(26) + ' error (ms)  median ' + format(pick(0.5), '7.3f') + '   p95 ' + format(pick(0.95), '7.3f') +
+          '   p99 ' + format(pick(0.99), '7.3f') + '   max ' + format(errors[-1], '7.3f'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pulses', type=int, default=300)
+    parser.add_argument('--width', type=float, default=0.012)
+    parser.add_argument('--spin', type=float, default=0.002)
+    parser.add_argument('--realtime', action='store_true')
+    args = parser.parse_args()
+
+    gpio = SimGPIO()
+    pins = [31, 24]
+    gpio.setup(pins, gpio.OUT)
+    engine = PulseEngine(gpio, spin=args.spin, realtime=args.realtime)
+    for loaded in (False, True):
+        stop = multiprocessing.Event()
+        workers = []
+        if loaded:
+            workers = [multiprocessing.Process(target=burn, args=(stop,)) for i in range(os.cpu_count() or 1)]
+            for worker in workers:
+                worker.start()
+        label = 'loaded' if loaded else 'idle'
+        describe('time.sleep, ' + label, sleep_pulses(gpio, pins, args.width, args.pulses))
+        describe('PulseEngine, ' + label, engine_pulses(engine, pins, args.width, args.pulses))
+        stop.set()
+        for worker in workers:
+            worker.join()
+    engine.close()
@@ -0,0 +1,256 @@
+'''
+rig_bench runs every rig protocol on the simulated backend and checks its timing against stored baselines
+
+    python benchmarks/rig_bench.py                    # every protocol, compared with benchmarks/baselines.json
+    python benchmarks/rig_bench.py basic_np pipi2     # some of them
+    python benchmarks/rig_bench.py --update           # store the current results as the new baselines
+
+Each protocol runs with rig_sim's scripted animal and a fixed seed, and is measured from the SimGPIO's output
+writes and input changes:
+    pulse_err       |measured valve open -> close time - the protocol's opentime| (ms), median and max
+    iti_drift       |trial onset interval - the planned interval| (ms), largest and summed over the session, for
+                    the protocols with a fixed ITI
+    unclosed        valve openings never written closed (opened again while open, or open at the end); any is a
+                    failure
+    latency         beam crossing -> reward valve opening (ms), p50 / p95 / p99, over the rewarded crossings
+    cpu             process CPU ms per simulated minute, and CPU time / wall time
+plus the EventLog's throughput (events/s written to a CSV, on the real clock), and the Intan clock map's pairing
+on a synthetic recording with one misread barcode (see run_intan_sync).
+
+On the VirtualClock the timing metrics measure the task code, not the Pi: polling intervals, relative sleeps that
+add up, steps done in the wrong order. For real-clock pulse jitter under CPU load see benchmarks/pulse_bench.py.
+A metric fails when it is worse than its baseline by more than its threshold in baselines.json (abs + rel *
+baseline); the exit status is 1 if any metric fails.
+'''
+
+import argparse
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import intan_sync
+import rig_gpio
+import rig_sim
+from event_log import EventLog
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# run = rig_sim entry point and its arguments. valves = {pin: opentime (s)} of the pulses to check. iti = planned
+# seconds between trial onsets (onsets = openings of the [valves] pins) as protocols.json schedules them, i.e. the
+# ITI plus the opentime and any cue hold before it starts; None if the ITI is random or poke-driven.
+# beam = (input pin, level while crossed) and rewards = output pins whose opening after a crossing is the reward.
+# The latency of a crossing is counted to the first reward opening within LATENCY_WINDOW seconds after it.
+Bench = collections.namedtuple('Bench', ['run', 'kwargs', 'valves', 'iti', 'beam', 'rewards'])
+
+TASTE_LINES = {31: 0.01, 33: 0.01, 35: 0.01, 37: 0.01}  # rig_sim.run_passive's four lines
+
+BENCHES = {
+    'passive': Bench(rig_sim.run_passive, {'trials': 30}, TASTE_LINES, 0.01 + 22, None, []),
+    # passive_cue holds the cue for 1 s after the valve closes before the ITI starts
+    'passive_cue': Bench(rig_sim.run_passive, {'trials': 30, 'cue': True}, TASTE_LINES, 0.01 + 1 + 22, None, []),
+    'basic_np': Bench(rig_sim.run_basic_np, {'trials': 200}, {40: 0.012}, None, (13, 0), [40]),
+    'odor_np': Bench(rig_sim.run_odor_np, {'trials': 100}, {40: 0.012, 36: 0.5, 37: 0.7}, None, (13, 0), [40]),
+    'affective': Bench(rig_sim.run_affective, {'tim_dur': 1200}, {24: 0.1}, 0.1 + 1200, None, []),
+    'cuedtaste': Bench(rig_sim.run_cuedtaste, {'minutes': 60}, {31: 0.012, 33: 0.012, 35: 0.012, 37: 0.012}, None,
+                       (38, 1), [31, 33, 35, 37]),
+    'pipi2': Bench(rig_sim.run_pipi2, {'trials': 20}, {31: 2.1, 33: 2.1, 35: 2.1, 32: 0.05, 26: 0.05}, None, (13, 1),
+                   [26]),
+}
+
+LATENCY_WINDOW = 2.0  # a reward opening more than this many seconds after a crossing is not counted as its reward
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 3) if len(values) else None
+
+
+# {pin: [(open ns, close ns), ...]} from SimGPIO writes (repeated writes of the same level are ignored)
+def openings(writes, pins):
+    opened = {}
+    spans = collections.defaultdict(list)
+    for t_ns, pin, level in writes:
+        if pin not in pins:
+            continue
+        if level and pin not in opened:
+            opened[pin] = t_ns
+        elif not level and pin in opened:
+            spans[pin].append((opened.pop(pin), t_ns))
+    return spans
+
+
+# Number of openings of [pins] that are never written closed: opened again while open, or still open at the end
+def unclosed(writes, pins):
+    opened = set()
+    count = 0
+    for t_ns, pin, level in writes:
+        if pin not in pins:
+            continue
+        if level:
+            count += pin in opened
+            opened.add(pin)
+        else:
+            opened.discard(pin)
+    return count + len(opened)
+
+
+def measure(bench, gpio):
+    metrics = {}
+    spans = openings(gpio.writes, set(bench.valves))
+    errors = [abs((off - on) / 1e6 - bench.valves[pin] * 1000)
+              for pin in bench.valves for on, off in spans.get(pin, [])]
+    metrics['pulses'] = len(errors)
+    metrics['pulse_err_median_ms'] = round(float(np.median(errors)), 3) if errors else None
+    metrics['pulse_err_max_ms'] = round(max(errors), 3) if errors else None
+    metrics['unclosed'] = unclosed(gpio.writes, set(bench.valves) | set(bench.rewards))
+
+    if bench.iti is not None:
+        onsets = sorted(on for pin in bench.valves for on, off in spans.get(pin, []))
+        drift = np.diff(onsets) / 1e6 - bench.iti * 1000
+        metrics['iti_drift_max_ms'] = round(float(np.max(np.abs(drift))), 3) if len(drift) else None
+        metrics['iti_drift_total_ms'] = round(float(np.sum(drift)), 3) if len(drift) else None
+
+    if bench.beam is not None:
+        pin, active = bench.beam
+        crossings = [t_ns for t_ns, p, level in gpio.inputs if p == pin and level == active]
+        rewards = np.array(sorted(t_ns for t_ns, p, level in gpio.writes if p in bench.rewards and level))
+        latencies = []
+        for t_ns in crossings:
+            i = np.searchsorted(rewards, t_ns)
+            if i < len(rewards) and rewards[i] - t_ns <= LATENCY_WINDOW * 1e9:
+                latencies.append((rewards[i] - t_ns) / 1e6)
+        metrics['rewarded_pokes'] = len(latencies)
+        for q in (50, 95, 99):
+            metrics['latency_p' + str(q) + '_ms'] = percentile(latencies, q)
+    return metrics
+
+
+def run_bench(name, seed=0):
+    bench = BENCHES[name]
+    cpu0 = time.process_time()
+    wall0 = time.perf_counter()
+    summary = bench.run(seed=seed, **bench.kwargs)
+    cpu = time.process_time() - cpu0
+    wall = time.perf_counter() - wall0
+    metrics = measure(bench, rig_gpio.GPIO)
+    metrics['simulated_s'] = summary['simulated_s']
+    metrics['cpu_ms_per_sim_min'] = round(cpu * 1000 / (summary['simulated_s'] / 60), 3)
+    metrics['cpu_util'] = round(cpu / wall, 3) if wall > 0 else None
+    return metrics
+
+
+# EventLog throughput: [events] log_event() calls, then close() (which writes and fsyncs everything)
+def run_event_log(events=50000):
+    rig_gpio.use_backend('sim')
+    with tempfile.TemporaryDirectory() as directory:
+        log = EventLog(os.path.join(directory, 'bench_log.csv'), clock=rig_gpio.RealClock())
+        t0 = time.perf_counter()
+        for i in range(events):
+            log.log_event('Event ' + str(i % 10))
+        log_s = time.perf_counter() - t0
+        log.close()
+        total_s = time.perf_counter() - t0
+    return {'events': events, 'dropped': log.dropped,
+            'log_event_us': round(log_s / events * 1e6, 3),
+            'events_per_s': round(events / total_s)}
+
+
+# Intan clock map on a synthetic recording: [barcodes] sync barcodes, an Intan clock [drift_ppm] fast, and one
+# barcode (the [misread]th) read with its top bit flipped. Only that barcode may be lost (pairs_lost = 1); map_err is
+# how far the mapped sample numbers of the logged barcodes are from the true ones (ms).
+def run_intan_sync(barcodes=200, drift_ppm=40, misread=50, rate=30000):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench_sync.csv')
+        pulser = intan_sync.SyncPulser(0, filename)
+        t = np.arange(barcodes) * 1.0 + 0.0173  # rig clock.time() of each start pulse
+        true = np.round((t - t[0] + 5.0) * (1 + drift_ppm * 1e-6) * rate).astype(np.int64)
+        trace = np.zeros(true[-1] + 2 * rate, dtype=np.int8)
+        for i, onset in enumerate(true):
+            code = i ^ (1 << (pulser.bits - 1)) if i == misread else i
+            edges = pulser.edges(code)
+            for (ms, level), (end_ms, _) in zip(edges, edges[1:]):
+                if level:
+                    trace[onset + int(round(ms * rate / 1000)):onset + int(round(end_ms * rate / 1000))] = 1
+        with open(filename, 'w') as f:
+            f.write(','.join(intan_sync.SYNC_COLUMNS) + '\n')
+            f.writelines('%d,%d,%.6f\n' % (i, int(t[i] * 1e9), t[i]) for i in range(barcodes))
+        clock_map = intan_sync.fit(filename, trace, rate)
+    return {'barcodes': barcodes, 'pairs_lost': barcodes - len(clock_map.rig),
+            'map_err_max_ms': round(float(np.max(np.abs(clock_map(t) - true))) / rate * 1000, 3)}
+
+
+# Metrics where a larger value is the better one
+HIGHER_IS_BETTER = {'events_per_s'}
+
+
+# [(protocol, metric, value, baseline, limit, ok)] for every metric that has a baseline and a threshold
+def compare(results, baselines):
+    rows = []
+    thresholds = baselines.get('thresholds', {})
+    for name, metrics in results.items():
+        stored = baselines.get('baselines', {}).get(name, {})
+        for metric, value in metrics.items():
+            baseline = stored.get(metric)
+            threshold = thresholds.get(metric)
+            if value is None or baseline is None or threshold is None:
+                continue
+            allowance = threshold.get('abs', 0) + threshold.get('rel', 0) * abs(baseline)
+            if metric in HIGHER_IS_BETTER:
+                limit = baseline - allowance
+                ok = value >= limit
+            else:
+                limit = baseline + allowance
+                ok = value <= limit
+            rows.append((name, metric, value, baseline, round(limit, 3), ok))
+    return rows
+
+
+def load_baselines(filename=BASELINES):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_baselines(results, filename=BASELINES):
+    baselines = load_baselines(filename)
+    baselines.setdefault('baselines', {}).update(results)
+    with open(filename, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', help='protocols (and/or event_log, intan_sync) to run (default: all)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--update', action='store_true', help='save the results as the new baselines')
+    args = parser.parse_args()
+    names = args.benchmarks or sorted(BENCHES) + ['event_log', 'intan_sync']
+    results = {}
+    for name in names:
+        if name == 'event_log':
+            results[name] = run_event_log()
+        elif name == 'intan_sync':
+            results[name] = run_intan_sync()
+        else:
+            results[name] = run_bench(name, args.seed)
+        print(name.ljust(12) + ' ' + ', '.join(metric + ' ' + str(value) for metric, value in results[name].items()))
+    if args.update:
+        save_baselines(results, args.baselines)
+        print('baselines saved to ' + args.baselines)
+        raise SystemExit(0)
+    rows = compare(results, load_baselines(args.baselines))
+    failed = [row for row in rows if not row[5]]
+    for name, metric, value, baseline, limit, ok in failed:
+        print('REGRESSION  ' + name + ' ' + metric + ': ' + str(value) + ' (baseline ' + str(baseline) + ', limit ' +
+              str(limit) + ')')
+    print(str(len(rows)) + ' metrics checked, ' + str(len(failed)) + ' regressions')
+    raise SystemExit(1 if failed else 0)
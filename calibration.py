@@ -0,0 +1,112 @@
+'''
+calibration contains the valve calibration store and the volume -> opentime dosing tables
+
+Every calibration run (a valve opened [deliveries] times for one opentime, the liquid weighed) is kept as a point
+of that valve's opentime -> volume curve, across sessions, in one JSON file. A ValveModel interpolates the curve
+(piecewise linear through the median volume measured at each opentime, forced to be non-decreasing, and through
+zero at opentime 0), and a DoseTable precomputes the opentime of every volume step once at session start, so a
+delivery asked for in microlitres costs one list index:
+
+    store = CalibrationStore()
+    store.add(31, 0.012, 3.1, deliveries=5)    # 3.1 uL per delivery at 12 ms, saved straight away
+    doses = store.table(31)                    # DoseTable, or None while the valve has no points
+    doses.opentime(3.0)                        # seconds to open for 3 uL
+'''
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+CALIBRATIONS = 'valve_calibrations.json'  # default store, in the working directory like the rig config files
+
+
+class CalibrationStore:
+    # filename = JSON file holding {valve: {"points": [...], "opentime": seconds chosen for the valve}}
+    def __init__(self, filename=CALIBRATIONS):
+        self.filename = filename
+        self.valves = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.valves = json.load(f)
+        self.models = {}  # valve -> (number of points it was fitted on, ValveModel)
+
+    def _valve(self, valve):
+        return self.valves.setdefault(str(valve), {'points': [], 'opentime': None})
+
+    # Record a calibration run of [valve]: [volume_ul] per delivery at [opentime] seconds
+    def add(self, valve, opentime, volume_ul, deliveries=1):
+        self._valve(valve)['points'].append({'opentime': opentime, 'volume_ul': volume_ul, 'deliveries': deliveries,
+                                             'date': datetime.datetime.now().isoformat(timespec='seconds')})
+        self.save()
+
+    def points(self, valve):
+        return list(self.valves.get(str(valve), {}).get('points', []))
+
+    # Opentime kept for [valve] by the last calibration (what cuedtaste_config.ini used to be rewritten for)
+    def opentime(self, valve, default=None):
+        opentime = self.valves.get(str(valve), {}).get('opentime')
+        return default if opentime is None else opentime
+
+    def set_opentime(self, valve, opentime):
+        self._valve(valve)['opentime'] = opentime
+        self.save()
+
+    # Fitted ValveModel of [valve], refitted only when it has new points. None if it has no points.
+    def model(self, valve):
+        points = self.points(valve)
+        if not points:
+            return None
+        cached = self.models.get(str(valve))
+        if cached is None or cached[0] != len(points):
+            cached = (len(points), ValveModel([p['opentime'] for p in points], [p['volume_ul'] for p in points]))
+            self.models[str(valve)] = cached
+        return cached[1]
+
+    def table(self, valve, step_ul=0.05, max_ul=None):
+        model = self.model(valve)
+        return None if model is None else DoseTable(model, step_ul, max_ul)
+
+    def save(self):  # write to a temporary file and rename it, so a crash never leaves a half-written store
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.valves, f, indent=2)
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+# Interpolated opentime -> volume curve of one valve
+class ValveModel:
+    def __init__(self, opentimes, volumes):
+        opentimes = np.asarray(opentimes, dtype=float)
+        volumes = np.asarray(volumes, dtype=float)
+        self.opentimes = np.unique(opentimes)
+        self.volumes = np.array([np.median(volumes[opentimes == t]) for t in self.opentimes])
+        if self.opentimes[0] > 0:
+            self.opentimes = np.concatenate([[0.0], self.opentimes])
+            self.volumes = np.concatenate([[0.0], self.volumes])
+        self.volumes = np.maximum.accumulate(self.volumes)  # measurement noise must not make the curve fall
+
+    def volume(self, opentime):  # uL per delivery
+        return float(np.interp(opentime, self.opentimes, self.volumes))
+
+    # Opentime (s) for [volume_ul]. Past the last point the curve is extended along its last segment.
+    def opentime(self, volume_ul):
+        if volume_ul <= self.volumes[-1] or len(self.opentimes) < 2:
+            return float(np.interp(volume_ul, self.volumes, self.opentimes))
+        slope = (self.opentimes[-1] - self.opentimes[-2]) / max(self.volumes[-1] - self.volumes[-2], 1e-9)
+        return float(self.opentimes[-1] + (volume_ul - self.volumes[-1]) * slope)
+
+
+# Opentime of every [step_ul] volume from 0 to [max_ul] (default: the largest calibrated volume)
+class DoseTable:
+    def __init__(self, model, step_ul=0.05, max_ul=None):
+        self.step_ul = step_ul
+        self.max_ul = model.volumes[-1] if max_ul is None else max_ul
+        volumes = np.arange(0, round(self.max_ul / step_ul) + 1) * step_ul
+        self.opentimes = [model.opentime(v) for v in volumes]
+
+    def opentime(self, volume_ul):
+        i = round(volume_ul / self.step_ul)
+        if not 0 <= i < len(self.opentimes):
+            raise ValueError(str(volume_ul) + ' uL is outside the calibrated range (0-' + str(self.max_ul) + ' uL)')
+        return self.opentimes[i]
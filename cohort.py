@@ -0,0 +1,163 @@
+'''
+cohort runs the session analysis (see analytics) over many session files in parallel, with an on-disk result cache
+
+Files are fanned out over a WorkerPool, one file per task. Every file's results are cached in [cache_dir] under the
+SHA-256 of its contents, the analytics VERSION and the analysis options, so re-running a cohort report only analyzes
+new or changed files; a changed file gets a new key, and a bumped VERSION invalidates everything. File hashes are
+themselves remembered by (path, size, mtime), so an unchanged file is not even re-read.
+
+    python cohort.py sessions/*.rigevt sessions/*_log.csv --jobs 4 --csv cohort.csv
+'''
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+
+import analytics
+from workers import WorkerPool
+
+CACHE_DIR = '.analytics_cache'
+
+
+# Side task: analytics results of every session in [filename]
+def analyze_file(filename, bin_s=60):
+    return [analytics.analyze(session, bin_s=bin_s) for session in analytics.load(filename)]
+
+
+def file_hash(filename, chunk=2 ** 20):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json(filename, value):  # write to a temporary file and rename, so a crash never leaves half a file
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(value, f)
+    os.replace(filename + '.tmp', filename)
+
+
+class ResultCache:
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hashes_file = os.path.join(directory, 'hashes.json')
+        self.hashes = {}  # absolute path -> [size, mtime_ns, sha256]
+        if os.path.exists(self.hashes_file):
+            with open(self.hashes_file) as f:
+                self.hashes = json.load(f)
+
+    def content_hash(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        known = self.hashes.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = file_hash(path)
+        self.hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    # Cache key of [filename]'s results under the current analytics VERSION and [options]
+    def key(self, filename, **options):
+        identity = json.dumps([self.content_hash(filename), analytics.VERSION, options], sort_keys=True)
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, key + '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, results):
+        _write_json(os.path.join(self.directory, key + '.json'), results)
+
+    def save(self):
+        _write_json(self.hashes_file, self.hashes)
+
+
+# Results of every session of [filenames], in file order. Returns (results, stats): stats counts the files taken
+# from the cache, analyzed, and failed ({filename: error}).
+def run(filenames, jobs=None, cache_dir=CACHE_DIR, bin_s=60):
+    cache = ResultCache(cache_dir) if cache_dir else None
+    per_file = {}
+    keys = {}
+    todo = []
+    errors = {}
+    for filename in filenames:
+        if cache is not None:
+            try:
+                keys[filename] = cache.key(filename, bin_s=bin_s)
+            except OSError as e:  # missing or unreadable: reported with the other failures
+                errors[filename] = repr(e)
+                continue
+            cached = cache.get(keys[filename])
+            if cached is not None:
+                for result in cached:  # the same contents may have been analyzed under another path
+                    result['source'] = filename
+                per_file[filename] = cached
+                continue
+        todo.append(filename)
+    hits = len(per_file)
+    if todo:
+        jobs = jobs or os.cpu_count() or 1
+        with WorkerPool(processes=min(jobs, len(todo)), queue_size=2 * jobs) as pool:
+            futures = {filename: pool.submit(analyze_file, filename, bin_s) for filename in todo}
+            for filename, future in futures.items():
+                try:
+                    per_file[filename] = future.result()
+                except Exception as e:
+                    errors[filename] = repr(e)
+                    continue
+                if cache is not None:
+                    cache.put(keys[filename], per_file[filename])
+    if cache is not None:
+        cache.save()
+    results = [result for filename in filenames if filename in per_file for result in per_file[filename]]
+    stats = {'files': len(filenames), 'cached': hits, 'analyzed': len(per_file) - hits, 'failed': errors}
+    return results, stats
+
+
+# One flat row per session: nested statistics become "<name>.<stat>" columns; per-bin lists are left out
+def flatten(result):
+    row = {}
+    for name, value in result.items():
+        if isinstance(value, dict):
+            row.update({name + '.' + stat: item for stat, item in value.items()})
+        elif not isinstance(value, list):
+            row[name] = value
+    return row
+
+
+def save_csv(results, filename):
+    rows = [flatten(result) for result in results]
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Analyze a cohort of session files in parallel, with caching')
+    parser.add_argument('files', nargs='+', help='.rigevt streams, pipi2 EventLog CSVs, output_times.csv')
+    parser.add_argument('--jobs', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache', default=CACHE_DIR, help="cache directory ('' to disable)")
+    parser.add_argument('--bin', type=float, default=60, help='seconds per poke rate bin')
+    parser.add_argument('--csv', help='write one row per session to this CSV')
+    parser.add_argument('--json', help='write the full results to this JSON file')
+    args = parser.parse_args()
+    results, stats = run(args.files, args.jobs, args.cache, args.bin)
+    if args.csv:
+        save_csv(results, args.csv)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    for filename, error in stats['failed'].items():
+        print('FAILED  ' + filename + ': ' + error)
+    print(str(len(results)) + ' sessions from ' + str(stats['files']) + ' files: ' + str(stats['cached']) +
+          ' cached, ' + str(stats['analyzed']) + ' analyzed, ' + str(len(stats['failed'])) + ' failed')
+    raise SystemExit(1 if stats['failed'] else 0)
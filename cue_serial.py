@@ -0,0 +1,200 @@
+'''
+cue_serial contains the serial link to the cue Arduino used by CuedTaste
+
+Writing to the serial port from the task and polling ser.read(1) to find out whether a cue is playing blocks the
+caller for up to the read timeout and lets every reader steal the others' bytes. A CueChannel owns the port
+instead: one I/O thread writes queued cue messages and reads everything the Arduino sends back. The Arduino echoes
+each one-byte cue message when it starts playing it; the channel matches every echo to the oldest unacknowledged
+send of that message, so it knows which cue is playing and how long each acknowledgment took.
+
+On a simulated clock (rig_gpio 'sim' backend) there is no thread: send() writes and reads the echo straight away.
+FakeCuePeripheral is an echoing Arduino on a pseudo-terminal, for trying the real serial path off-rig:
+
+    python cue_serial.py
+'''
+
+import collections
+import os
+import queue
+import select
+import threading
+
+from rig_gpio import clock as rig_clock
+from tracing import tracer
+
+# One acknowledged cue. sent_ns / acked_ns = clock.monotonic_ns() when the message was written / echoed back.
+CueAck = collections.namedtuple('CueAck', ['message', 'sent_ns', 'acked_ns'])
+
+
+class CueChannel:
+    # ser = serial.Serial (or rig_gpio.SimSerial), already open. poll = seconds between reads when the port has no
+    # fileno() to wait on. history = how many CueAcks to keep.
+    def __init__(self, ser, clock=None, poll=0.001, history=10000):
+        self.ser = ser
+        self.clock = clock or getattr(ser, 'clock', None) or rig_clock
+        self.poll = poll
+        self.outbox = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = collections.deque()  # (message, sent_ns) waiting for their echo, oldest first
+        self.playing = None  # message of the last cue the Arduino acknowledged
+        self.acks = collections.deque(maxlen=history)
+        self.sent = 0
+        self.unexpected = 0  # received bytes that matched no pending message
+        self.listeners = []
+        self.thread = None
+        if not self.clock.virtual:
+            self.wake_r, self.wake_w = os.pipe()
+            self.thread = threading.Thread(target=self._run, name='CueChannel I/O', daemon=True)
+            self.thread.start()
+
+    # Run listener(message, t_ns) for every acknowledged cue, in the I/O thread
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Queue [message] (bytes) for the Arduino. Returns straight away.
+    def send(self, message):
+        if self.thread is None:
+            self._write(message)
+            with tracer.span('serial.read', 'serial'):
+                data = self.ser.read(len(message))
+            self._received(data)
+            return
+        self.outbox.put(message)
+        os.write(self.wake_w, b'\0')
+
+    def is_playing(self, message):
+        return self.playing == message
+
+    # I/O thread
+
+    def _write(self, message):
+        with self.lock:
+            self.pending.append((message, self.clock.monotonic_ns()))
+            self.sent += 1
+        with tracer.span('serial.write', 'serial', message=message):
+            self.ser.write(message)
+
+    def _received(self, data):
+        t_ns = self.clock.monotonic_ns()
+        acked = []
+        with self.lock:
+            for value in data:
+                message = bytes([value])
+                for i, (sent_message, sent_ns) in enumerate(self.pending):
+                    if sent_message == message:
+                        del self.pending[i]
+                        self.playing = message
+                        self.acks.append(CueAck(message, sent_ns, t_ns))
+                        acked.append(message)
+                        break
+                else:
+                    self.unexpected += 1
+        for message in acked:
+            with tracer.span('serial.ack', 'serial', message=message):
+                for listener in self.listeners:
+                    listener(message, t_ns)
+
+    def _send_queued(self):  # False once close() has been called
+        while True:
+            try:
+                message = self.outbox.get_nowait()
+            except queue.Empty:
+                return True
+            if message is None:
+                return False
+            self._write(message)
+
+    def _run(self):
+        try:
+            fileno = self.ser.fileno()
+        except (AttributeError, OSError):
+            fileno = None
+        while self._send_queued():
+            if fileno is None:
+                data = self.ser.read(getattr(self.ser, 'in_waiting', 0) or 1)
+                if data:
+                    self._received(data)
+                else:
+                    select.select([self.wake_r], [], [], self.poll)
+            else:
+                ready = select.select([fileno, self.wake_r], [], [])[0]
+                if fileno in ready:
+                    self._received(self.ser.read(self.ser.in_waiting or 1))
+            if self.wake_r in select.select([self.wake_r], [], [], 0)[0]:
+                os.read(self.wake_r, 4096)
+
+    def close(self):
+        if self.thread is not None:
+            self.outbox.put(None)
+            os.write(self.wake_w, b'\0')
+            self.thread.join()
+            self.thread = None
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+
+    # Acknowledgment latency statistics (ms) over the kept acks
+    def summary(self):
+        latencies = sorted((ack.acked_ns - ack.sent_ns) / 1e6 for ack in self.acks)
+        with self.lock:
+            out = {'sent': self.sent, 'acked': len(latencies), 'unacked': len(self.pending),
+                   'unexpected': self.unexpected}
+        if latencies:
+            out.update({'median_ms': round(latencies[len(latencies) // 2], 3),
+                        'p99_ms': round(latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))], 3),
+                        'max_ms': round(latencies[-1], 3)})
+        return out
+
+
+# Stand-in for the cue Arduino on a pseudo-terminal: echoes every byte it receives after [delay] seconds, except
+# the ones in [drop]. Open [port] with serial.Serial the way CuedTaste opens /dev/ttyS0.
+class FakeCuePeripheral:
+    def __init__(self, delay=0.0, drop=b''):
+        import tty
+        self.delay = delay
+        self.drop = drop
+        self.received = []  # (time.monotonic_ns(), byte) of everything read from the port
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)  # no line buffering or echo by the terminal itself
+        self.port = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self._run, name='FakeCuePeripheral', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        clock = rig_clock
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            for value in data:
+                message = bytes([value])
+                self.received.append((clock.monotonic_ns(), message))
+                if message in self.drop:
+                    continue
+                if self.delay:
+                    clock.sleep(self.delay)
+                os.write(self.master, message)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+if __name__ == '__main__':
+    import serial
+
+    peripheral = FakeCuePeripheral(delay=0.002, drop=b'9')
+    ser = serial.Serial(peripheral.port, baudrate=57600, timeout=0.01)
+    channel = CueChannel(ser)
+    for i in range(200):
+        channel.send(str(i % 7).encode('utf-8'))
+        rig_clock.sleep(0.01)
+    channel.send(b'9')  # never acknowledged
+    rig_clock.sleep(0.1)
+    print('playing:', channel.playing)
+    print(channel.summary())
+    channel.close()
+    ser.close()
+    peripheral.close()
@@ -0,0 +1,160 @@
+'''
+event_log contains the buffered, batched event logger used on the trial path
+
+Opening the CSV in append mode, building a csv.writer and printing for every event puts syscalls and SD-card
+writes in the middle of trials. EventLog.log_event() only timestamps the event and appends it to an in-memory
+ring buffer (a few microseconds); a background thread formats, prints and writes the buffered events in
+batches, when [batch] events are waiting or every [interval] seconds, to a file that stays open.
+
+fsync = 'batch' (fsync after every batch write), 'close' (only when the log is closed) or 'never'.
+Buffered events are always written out on close(), at interpreter exit (including after an exception or
+KeyboardInterrupt) and on SIGTERM.
+'''
+
+import atexit
+import collections
+import csv
+import datetime
+import os
+import signal
+import threading
+
+from rig_gpio import clock as rig_clock
+from tracing import tracer
+
+_EVENT, _ROW, _TEXT = 0, 1, 2
+
+
+# Default timestamp format, the one pipi2 logs use: 2023-10-02 14:03:11.123
+def ms_timestamp(t):
+    return datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+# clock.time() values (float64 array) of ms_timestamp() strings, parsed in one pass for the offline readers. The
+# stamps are local time: each hour of them is shifted by its own UTC offset, so a session across a DST change is right.
+def parse_timestamps(stamps):
+    import numpy as np
+    local = np.array(stamps, dtype='datetime64[ms]').astype(np.int64)
+    hours, index = np.unique(local // 3600000, return_inverse=True)
+    offsets = np.array([(datetime.datetime(1970, 1, 1) + datetime.timedelta(hours=int(hour))).timestamp() -
+                        int(hour) * 3600 for hour in hours])
+    return local / 1000 + offsets[index] if len(local) else np.zeros(0)
+
+
+class EventLog:
+    # filename = CSV file to append to (None = console only). echo = also print each event as "[time] name".
+    # timestamp = function turning a clock.time() value into the logged string. capacity = ring buffer size;
+    # if the writer falls that far behind, the oldest events are dropped and counted in [dropped].
+    def __init__(self, filename=None, echo=False, batch=256, interval=0.5, fsync='batch', capacity=100000,
+                 timestamp=ms_timestamp, clock=None):
+        if fsync not in ('batch', 'close', 'never'):
+            raise ValueError("fsync must be 'batch', 'close' or 'never'")
+        self.filename = filename
+        self.echo_events = echo
+        self.batch = batch
+        self.interval = interval
+        self.fsync = fsync
+        self.capacity = capacity
+        self.timestamp = timestamp
+        self.clock = clock or rig_clock
+        self.buffer = collections.deque(maxlen=capacity)
+        self.dropped = 0
+        self.written = 0
+        self.file = None if filename is None else open(filename, mode='a', newline='')
+        self.writer = None if self.file is None else csv.writer(self.file)
+        self.wake = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='EventLog writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        _flush_on_sigterm()
+
+    # Hot path
+
+    def log_event(self, name):  # log [name] at the current time
+        with tracer.span('log_event', 'log'):
+            self._put((_EVENT, self.clock.time(), name))
+
+    def log_row(self, row):  # write an arbitrary CSV row
+        self._put((_ROW, row))
+
+    def echo(self, text):  # print [text] from the writer thread instead of the trial loop
+        self._put((_TEXT, text))
+
+    def _put(self, item):
+        if len(self.buffer) == self.capacity:
+            self.dropped += 1
+        self.buffer.append(item)
+        if len(self.buffer) >= self.batch:
+            self.wake.set()
+
+    # Writer side
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):  # write out everything buffered so far (called by the writer thread, or directly)
+        with self.flush_lock:
+            rows = []
+            lines = []
+            while True:
+                try:
+                    item = self.buffer.popleft()
+                except IndexError:
+                    break
+                if item[0] == _EVENT:
+                    stamp = self.timestamp(item[1])
+                    rows.append([stamp, item[2]])
+                    if self.echo_events:
+                        lines.append('[' + stamp + '] ' + str(item[2]))
+                elif item[0] == _ROW:
+                    rows.append(item[1])
+                else:
+                    lines.append(str(item[1]))
+            if lines:
+                with tracer.span('log.print', 'print', lines=len(lines)):
+                    print('\n'.join(lines), flush=True)
+            if rows and self.writer is not None:
+                with tracer.span('log.write', 'log', rows=len(rows)):
+                    self.writer.writerows(rows)
+                    self.file.flush()
+                    if self.fsync == 'batch':
+                        os.fsync(self.file.fileno())
+            self.written += len(rows)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+        if self.file is not None:
+            if self.fsync != 'never':
+                os.fsync(self.file.fileno())
+            self.file.close()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# SIGTERM normally kills Python without running atexit; turn it into SystemExit so open logs get flushed.
+# Only done from the main thread and only if nobody else has installed a handler.
+def _flush_on_sigterm():
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, _raise_exit)
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(128 + signum)
@@ -0,0 +1,245 @@
+'''
+event_stream contains the compact binary format for rig state recordings, its reader and CSV/Parquet exporters
+
+A stream file is a small JSON header followed by fixed-width 12-byte records:
+
+    t_ns   int64   nanoseconds since the session start (monotonic clock)
+    state  uint32  one bit per channel, bit i = channels[i] (True = crossed / open / playing)
+
+StreamWriter packs records into a preallocated buffer and writes it out in large blocks. StateRecorder sits on top
+of it and writes a record only when a channel changes, so a file holds one record per behavioural event, however
+long a beam is held. Each record carries the full state, so the state at any time is the last record before it.
+StreamReader memory-maps the records as a NumPy structured array (loading an hour-long session costs nothing until
+it is used) and reconstructs the state at any times with state_at().
+
+    python event_stream.py anID_101023_14h05m.rigevt --csv out.csv --parquet out.parquet
+'''
+
+import argparse
+import csv
+import json
+import struct
+import threading
+
+import numpy as np
+
+from rig_gpio import clock as rig_clock
+
+MAGIC = b'RIGEVT1\n'
+RECORD = struct.Struct('<qI')
+RECORD_DTYPE = np.dtype([('t_ns', '<i8'), ('state', '<u4')])
+EXTENSION = '.rigevt'
+
+
+# Bit-pack a sequence of truthy values (channel 0 = bit 0)
+def pack_state(values):
+    state = 0
+    for bit, value in enumerate(values):
+        if value:
+            state |= 1 << bit
+    return state
+
+
+class StreamWriter:
+    # channels = channel names in bit order (max 32). meta = extra JSON-able header fields (animal ID, start
+    # time, ...). buffer_records = how many records are packed in memory before one write() to the file.
+    def __init__(self, filename, channels, meta=None, buffer_records=4096):
+        if len(channels) > 32:
+            raise ValueError('a stream holds at most 32 channels')
+        self.filename = filename
+        self.channels = list(channels)
+        header = dict(meta or {})
+        header['channels'] = self.channels
+        header = json.dumps(header).encode('utf-8')
+        # pad the header so the records start 8-byte aligned
+        header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+        self.file = open(filename, 'wb')
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.buffer = bytearray(RECORD.size * buffer_records)
+        self.view = memoryview(self.buffer)
+        self.used = 0
+        self.count = 0
+
+    def write(self, t_ns, state):
+        RECORD.pack_into(self.buffer, self.used, t_ns, state)
+        self.used += RECORD.size
+        self.count += 1
+        if self.used == len(self.buffer):
+            self.flush()
+
+    def write_values(self, t_ns, values):
+        self.write(t_ns, pack_state(values))
+
+    def flush(self):
+        if self.used:
+            self.file.write(self.view[:self.used])
+            self.used = 0
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Change-only recorder: set() is called from the places that change a channel (poke callbacks, valve pulses,
+# cues), from any thread, and a record is written only if the packed state actually changes. zero_ns = the
+# clock.monotonic_ns() time that becomes t = 0 in the file (default: now).
+class StateRecorder:
+    def __init__(self, filename, channels, meta=None, zero_ns=None, clock=None, buffer_records=4096):
+        self.clock = clock or rig_clock
+        self.zero_ns = self.clock.monotonic_ns() if zero_ns is None else zero_ns
+        self.stream = StreamWriter(filename, channels, meta, buffer_records)
+        self.bits = {name: 1 << bit for bit, name in enumerate(self.stream.channels)}
+        self.state = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+        self._write(self.clock.monotonic_ns())  # starting state
+
+    # Run listener(state, t_ns) after every change, with the packed state and its clock.monotonic_ns() time
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Set [channel] to [value] at monotonic_ns time [t_ns] (default: now)
+    def set(self, channel, value, t_ns=None):
+        self.update({channel: value}, t_ns)
+
+    # Set several channels at once, as one record
+    def update(self, values, t_ns=None):
+        if t_ns is None:
+            t_ns = self.clock.monotonic_ns()
+        with self.lock:
+            if self.stream.file is None:  # closed
+                return
+            state = self.state
+            for channel, value in values.items():
+                if value:
+                    state |= self.bits[channel]
+                else:
+                    state &= ~self.bits[channel]
+            if state == self.state:
+                return
+            self.state = state
+            self._write(t_ns)
+            for listener in self.listeners:
+                listener(state, t_ns)
+
+    def is_set(self, channel):
+        return bool(self.state & self.bits[channel])
+
+    def _write(self, t_ns):  # caller holds self.lock (or is __init__)
+        self.stream.write(t_ns - self.zero_ns, self.state)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    # Writes a last record with the final state, so the file also marks when recording stopped
+    def close(self):
+        with self.lock:
+            if self.stream.file is not None:
+                self._write(self.clock.monotonic_ns())
+                self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamReader:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(filename + ' is not a rig event stream')
+            length = struct.unpack('<I', f.read(4))[0]
+            self.header = json.loads(f.read(length).decode('utf-8'))
+        self.channels = self.header['channels']
+        self.offset = len(MAGIC) + 4 + length
+        size = _file_size(filename) - self.offset
+        count = size // RECORD_DTYPE.itemsize  # ignore a partly written last record
+        if count:
+            self.records = np.memmap(filename, dtype=RECORD_DTYPE, mode='r', offset=self.offset, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def times(self):  # seconds since session start
+        return self.records['t_ns'] / 1e9
+
+    def channel(self, name):  # bool array of one channel
+        bit = self.channels.index(name)
+        return (self.records['state'] >> np.uint32(bit)) & np.uint32(1) == 1
+
+    def states(self):  # (records x channels) bool array
+        bits = np.arange(len(self.channels), dtype=np.uint32)
+        return (self.records['state'][:, None] >> bits) & np.uint32(1) == 1
+
+    # Packed state at time(s) [t] (seconds since session start): the last record at or before t, 0 before the first
+    def packed_at(self, t):
+        t_ns = np.round(np.asarray(t, dtype=float) * 1e9).astype(np.int64)
+        index = np.searchsorted(self.records['t_ns'], t_ns, side='right') - 1
+        states = np.asarray(self.records['state'])[np.maximum(index, 0)] if len(self.records) else np.zeros_like(index)
+        return np.where(index >= 0, states, 0).astype(np.uint32)
+
+    # Full state at time(s) [t]: bool array of the channels, (len(t) x channels) for an array of times.
+    # e.g. reader.state_at(np.arange(0, 3600, 0.001)) rebuilds the old 1 kHz table.
+    def state_at(self, t):
+        bits = np.arange(len(self.channels), dtype=np.uint32)
+        return (self.packed_at(t)[..., None] >> bits) & np.uint32(1) == 1
+
+    def to_csv(self, filename, chunk=100000):
+        with open(filename, 'w', newline='') as out:
+            writer = csv.writer(out)
+            writer.writerow(['Time'] + self.channels)
+            for start in range(0, len(self.records), chunk):
+                part = self.records[start:start + chunk]
+                times = np.round(part['t_ns'] / 1e9, 3)
+                bits = np.arange(len(self.channels), dtype=np.uint32)
+                states = (part['state'][:, None] >> bits) & np.uint32(1) == 1
+                for t, row in zip(times.tolist(), states.tolist()):
+                    writer.writerow([t] + row)
+
+    def to_parquet(self, filename):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Parquet export needs pyarrow (pip install pyarrow)')
+        columns = {'t_ns': pa.array(np.asarray(self.records['t_ns']))}
+        states = self.states()
+        for i, name in enumerate(self.channels):
+            columns[name] = pa.array(states[:, i])
+        table = pa.table(columns).replace_schema_metadata({'rig_header': json.dumps(self.header)})
+        pq.write_table(table, filename)
+
+
+def _file_size(filename):
+    with open(filename, 'rb') as f:
+        f.seek(0, 2)
+        return f.tell()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a rig event stream to CSV and/or Parquet')
+    parser.add_argument('stream')
+    parser.add_argument('--csv')
+    parser.add_argument('--parquet')
+    args = parser.parse_args()
+    reader = StreamReader(args.stream)
+    print(str(len(reader)) + ' records, channels: ' + ', '.join(reader.channels))
+    if args.csv:
+        reader.to_csv(args.csv)
+    if args.parquet:
+        reader.to_parquet(args.parquet)
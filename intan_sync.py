@@ -0,0 +1,271 @@
+'''
+intan_sync contains the sync pulses that tie the rig clock to the Intan recording, and the offline clock map
+
+While a session runs, a SyncPulser sends a numbered barcode on a dedicated pin wired to an Intan digital input
+every [period] seconds:
+
+    ___|‾‾‾‾‾‾|____|b0|b1|...|b15|__________________ ... next barcode [period] s after this one's start
+        start   gap   bits, least significant first (high = 1)
+
+and logs, for each one, its number and when its start pulse went high on the rig clock (monotonic ns and
+clock.time()), to <name>_sync.csv. Afterwards decode() finds the barcodes in the Intan digital-in trace, the
+numbers pair every start pulse with its rig time, and ClockMap interpolates between the pairs (piecewise linear,
+so it follows the drift between the two clocks) to turn any rig time into an Intan sample number:
+
+    python intan_sync.py session_sync.csv digitalin.dat --channel 3 --log session_log.csv
+        # fit report, then every event of session_log.csv with its sample number in session_log_intan.csv
+
+EventLog times have millisecond resolution, so that is the best an event can be placed to; the older time.ctime()
+stamps (1 s) are not worth mapping. The tasks start a SyncPulser on their own when a sync pin is configured
+(RIG_SYNC_PIN=<pin>, or [Intan] sync_pin in pipi2's config.ini).
+'''
+
+import argparse
+import csv
+import os
+
+import numpy as np
+
+from rig_gpio import GPIO as rig_GPIO, clock as rig_clock
+from event_log import EventLog, parse_timestamps
+from tracing import tracer
+
+SYNC_COLUMNS = ['code', 't_ns', 'time']
+
+
+class SyncPulser:
+    # pin = output pin wired to an Intan digital input. filename = CSV the barcode times are logged to. bits = code
+    # length (codes wrap around after 2 ** bits barcodes). Pulse lengths are in ms; a barcode has to fit in [period].
+    def __init__(self, pin, filename, period=1.0, bits=16, start_ms=20, gap_ms=10, bit_ms=10, gpio=None, clock=None):
+        if (start_ms + gap_ms + bits * bit_ms) / 1000 >= period / 2:
+            raise ValueError('barcode longer than half the sync period')
+        self.pin = pin
+        self.filename = filename
+        self.period_ns = int(period * 1e9)
+        self.bits = bits
+        self.start_ms = start_ms
+        self.gap_ms = gap_ms
+        self.bit_ms = bit_ms
+        self.gpio = rig_GPIO if gpio is None else gpio
+        if clock is None:
+            clock = rig_clock if gpio is None else getattr(gpio, 'clock', None) or rig_clock
+        self.clock = clock
+        self.code = 0
+        self.sent = 0  # barcodes sent; unlike [code] it does not wrap, so the schedule never jumps
+        self.timer = None
+        self.log = None
+        self.running = False
+
+    # [(ms after the start, level)] of every edge of barcode [code]
+    def edges(self, code):
+        edges = [(0, 1), (self.start_ms, 0)]
+        level = 0
+        for i in range(self.bits):
+            bit = (code >> i) & 1
+            if bit != level:
+                edges.append((self.start_ms + self.gap_ms + i * self.bit_ms, bit))
+                level = bit
+        if level:
+            edges.append((self.start_ms + self.gap_ms + self.bits * self.bit_ms, 0))
+        return edges
+
+    def start(self):
+        self.gpio.setup(self.pin, self.gpio.OUT)
+        self.gpio.output(self.pin, 0)
+        new = not os.path.exists(self.filename)
+        self.log = EventLog(self.filename, fsync='close')
+        if new:
+            self.log.log_row(SYNC_COLUMNS)
+        self.running = True
+        self.start_ns = self.clock.monotonic_ns()
+        self._barcode()
+        return self
+
+    def _barcode(self):  # send the next barcode, and schedule its edges and the barcode after it
+        if not self.running:
+            return
+        t0 = self.clock.monotonic_ns()
+        with tracer.span('sync.barcode', 'gpio', code=self.code):
+            self.gpio.output(self.pin, 1)
+        t1 = self.clock.monotonic_ns()
+        now = self.clock.time()
+        self.log.log_row([self.code, (t0 + t1) // 2, '%.6f' % (now - (t1 - t0) / 2e9)])
+        self._schedule(self.edges(self.code)[1:], t0)
+        self.code = (self.code + 1) % 2 ** self.bits
+        self.sent += 1
+        due_ns = self.start_ns + self.sent * self.period_ns  # counted from the start, so delays don't add up
+        self.timer = self.clock.call_later(max(due_ns - self.clock.monotonic_ns(), 0) / 1e9, self._barcode)
+
+    def _schedule(self, edges, t0):
+        if not edges or not self.running:
+            return
+        (ms, level), rest = edges[0], edges[1:]
+
+        def write():
+            if self.running:
+                self.gpio.output(self.pin, level)
+                self._schedule(rest, t0)
+        self.clock.call_later(max(t0 + int(ms * 1e6) - self.clock.monotonic_ns(), 0) / 1e9, write)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+        self.gpio.output(self.pin, 0)
+        self.log.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+sync_pin = int(os.environ['RIG_SYNC_PIN']) if os.environ.get('RIG_SYNC_PIN') else None  # default sync pin
+
+
+# A started SyncPulser logging to [filename], on [pin] or the default sync pin; None if neither is set
+def session(filename, pin=None, **kwargs):
+    pin = sync_pin if pin is None else pin
+    if pin is None:
+        return None
+    return SyncPulser(pin, filename, **kwargs).start()
+
+
+# Offline side
+
+# (codes, t_ns, times) logged by a SyncPulser
+def read_sync(filename):
+    with open(filename, newline='') as f:
+        rows = [row for row in csv.reader(f) if row and row[0] != 'code']
+    codes = np.array([int(row[0]) for row in rows], dtype=np.int64)
+    return codes, np.array([int(row[1]) for row in rows], dtype=np.int64), np.array([float(row[2]) for row in rows])
+
+
+# One channel of an Intan digitalin.dat ("one file per signal type": a uint16 word per sample, bit k = DIN k)
+def read_digital_in(filename, channel):
+    return ((np.fromfile(filename, dtype=np.uint16) >> channel) & 1).astype(np.int8)
+
+
+# (codes, onset samples) of the barcodes in a 0/1 [trace] sampled at [rate] Hz. A start pulse is a high pulse of
+# start_ms (+- half a bit) after at least [quiet_ms] low; the bits are read at the middle of each bit.
+def decode(trace, rate, bits=16, start_ms=20, gap_ms=10, bit_ms=10, quiet_ms=None):
+    trace = np.asarray(trace).astype(np.int8) != 0
+    per_ms = rate / 1000
+    quiet_ms = start_ms + gap_ms + bits * bit_ms if quiet_ms is None else quiet_ms
+    change = np.flatnonzero(trace[1:] != trace[:-1]) + 1
+    rises = change[trace[change]]
+    falls = change[~trace[change]]
+    falls = falls[np.searchsorted(falls, rises[0]):] if len(rises) else falls  # a pulse cut at the start has no rise
+    n = min(len(rises), len(falls))
+    rises, falls = rises[:n], falls[:n]
+    widths = (falls - rises) / per_ms
+    quiet = rises - np.r_[-10 ** 12, falls[:-1]]
+    starts = rises[(np.abs(widths - start_ms) <= bit_ms / 2) & (quiet >= quiet_ms * per_ms)]
+    centres = starts[:, None] + np.round((start_ms + gap_ms + (np.arange(bits) + 0.5) * bit_ms) * per_ms).astype(int)
+    starts = starts[centres[:, -1] < len(trace)] if len(starts) else starts
+    centres = centres[:len(starts)]
+    codes = (trace[centres].astype(np.int64) << np.arange(bits)).sum(axis=1) if len(starts) else np.zeros(0, np.int64)
+    return codes, starts
+
+
+# Sequence numbers of barcodes [codes] at [positions] (ascending; [period] apart, in the same unit), and which codes
+# agree with them. The number of barcodes between two neighbours comes from their spacing, and the first barcode's
+# code is the one most codes agree with, so a misread code (or a dropped barcode) only loses its own barcode.
+def _sequence(codes, positions, period, bits):
+    steps = np.r_[0, np.cumsum(np.round(np.diff(positions) / period))].astype(np.int64)
+    first = np.bincount((codes - steps) % 2 ** bits).argmax()
+    numbers = first + steps
+    return numbers, numbers % 2 ** bits == codes
+
+
+class ClockMap:
+    # rig = rig times of the matched barcodes (ascending), samples = their Intan sample numbers. unit = seconds per
+    # rig time unit (1e-9 for monotonic ns).
+    def __init__(self, rig, samples, rate, unit=1.0):
+        if len(rig) < 2:
+            raise ValueError('need at least two matched sync pulses')
+        self.rig = np.asarray(rig, dtype=np.float64)
+        self.samples = np.asarray(samples, dtype=np.float64)
+        self.rate = rate
+        self.unit = unit
+        self.slopes = np.diff(self.samples) / np.diff(self.rig)
+
+    # Intan sample numbers (float) of rig times [t]: interpolated between the pulses around each time, and
+    # extrapolated along the first / last interval outside them
+    def __call__(self, t):
+        t = np.asarray(t, dtype=np.float64)
+        i = np.clip(np.searchsorted(self.rig, t, side='right') - 1, 0, len(self.slopes) - 1)
+        return self.samples[i] + (t - self.rig[i]) * self.slopes[i]
+
+    # Fit report: pulses, span, drift of the rig clock against the Intan clock, and how far a single straight line
+    # would be off (what the piecewise fit corrects)
+    def summary(self):
+        unit = self.unit
+        line = np.polyfit(self.rig, self.samples, 1)
+        residual_ms = (self.samples - np.polyval(line, self.rig)) / self.rate * 1000
+        return {'pulses': len(self.rig), 'span_s': round(float(self.rig[-1] - self.rig[0]) * unit, 1),
+                'drift_ppm': round((float(line[0]) / unit / self.rate - 1) * 1e6, 2),
+                'linear_residual_max_ms': round(float(np.max(np.abs(residual_ms))), 3)}
+
+
+# ClockMap from a SyncPulser CSV and the Intan [trace] of its pin. domain = 'time' (clock.time() seconds, as in the
+# event logs) or 't_ns' (monotonic ns). Barcodes are paired by their position in the sequence, so barcodes read with
+# the wrong code are dropped, and so are pairs more than [tolerance_ms] off a straight-line fit. Keyword arguments go
+# to decode().
+def fit(sync_filename, trace, rate, domain='time', bits=16, tolerance_ms=5.0, **kwargs):
+    codes, t_ns, times = read_sync(sync_filename)
+    found, samples = decode(trace, rate, bits=bits, **kwargs)
+    if len(codes) < 2 or len(found) < 2:
+        raise ValueError('need at least two matched sync pulses')
+    period_ns = np.median(np.diff(t_ns))
+    logged, _ = _sequence(codes, t_ns, period_ns, bits)
+    numbers, read = _sequence(found, samples, period_ns / 1e9 * rate, bits)
+    numbers, samples = numbers[read], samples[read]
+    # Both sequences count from their own first barcode, so the Intan one is off by whole wraps: use the shift that
+    # pairs the most barcodes
+    shifts = np.unique(logged[codes == numbers[0] % 2 ** bits] - numbers[0]) if len(numbers) else np.zeros(0, np.int64)
+    best = max(shifts, key=lambda shift: len(np.intersect1d(logged, numbers + shift)), default=0)
+    _, rig_i, intan_i = np.intersect1d(logged, numbers + best, return_indices=True)
+    rig = (times if domain == 'time' else t_ns)[rig_i].astype(np.float64)
+    samples = samples[intan_i].astype(np.float64)
+    unit = 1.0 if domain == 'time' else 1e-9
+    if len(rig) > 2:
+        residual = samples - np.polyval(np.polyfit(rig, samples, 1), rig)
+        keep = np.abs(residual) <= tolerance_ms / 1000 * rate
+        rig, samples = rig[keep], samples[keep]
+    order = np.argsort(rig)
+    return ClockMap(rig[order], samples[order], rate, unit)
+
+
+# (Intan sample numbers, event names) of every event in an EventLog CSV, parsed and mapped in one pass
+def map_event_log(log_filename, clock_map):
+    with open(log_filename, newline='') as f:
+        rows = [row for row in csv.reader(f) if len(row) >= 2]
+    times = parse_timestamps([row[0] for row in rows])
+    return np.round(clock_map(times)).astype(np.int64), [row[1] for row in rows]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the rig -> Intan clock map and map event logs onto it')
+    parser.add_argument('sync', help='<name>_sync.csv written by SyncPulser')
+    parser.add_argument('digitalin', help="Intan digitalin.dat, or a .npy 0/1 trace of the sync pin's input")
+    parser.add_argument('--channel', type=int, default=0, help='digital input the sync pin is wired to')
+    parser.add_argument('--rate', type=float, default=30000, help='Intan sample rate (Hz)')
+    parser.add_argument('--bits', type=int, default=16)
+    parser.add_argument('--log', nargs='*', default=[], help='EventLog CSVs to map to sample numbers')
+    args = parser.parse_args()
+    trace = np.load(args.digitalin) if args.digitalin.endswith('.npy') else read_digital_in(args.digitalin,
+                                                                                            args.channel)
+    clock_map = fit(args.sync, trace, args.rate, bits=args.bits)
+    print(clock_map.summary())
+    for log in args.log:
+        samples, names = map_event_log(log, clock_map)
+        output = os.path.splitext(log)[0] + '_intan.csv'
+        with open(output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['sample', 'event'])
+            writer.writerows(zip(samples.tolist(), names))
+        print(str(len(names)) + ' events -> ' + output)
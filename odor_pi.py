@@ -1,6 +1,14 @@
-import RPi.GPIO as GPIO
+from rig_gpio import GPIO, clock, setup_board  # RPi.GPIO on the rig, or the simulator (see rig_gpio)
 import time
 import random
+from pokes import PokeMonitor
+from event_log import EventLog
+from tracing import tracer, traced
+
+# Log timestamps in tenths of a second: 2023-10-02 14:03:11.1
+def tenths_timestamp(timestamp):
+    timestamp_tenths = int((timestamp % 1) * 10)
+    return time.strftime("%Y-%m-%d %H:%M:%S.", time.localtime(timestamp)) + str(timestamp_tenths)
 
 class Experiment:
     def __init__(self, water_solenoid_pin, taste_solenoid_pin, reward_solenoid_pin, taste_intan_pin, water_intan_pin, reward_intan_pin, odor_intan_pin):
@@ -18,57 +26,67 @@ class Experiment:
             'reward_intan_pin': reward_intan_pin
         }
         self.setup_gpio_pins()
+        self.ir_beam = PokeMonitor(GPIO, self.PINS['ir_beam'], active=1)  # edge-driven IR beam state
+        self.event_log = EventLog(echo=True, timestamp=tenths_timestamp)  # prints events off the trial path
 
     def setup_gpio_pins(self):
-        GPIO.setwarnings(False)
-        GPIO.cleanup()
-        GPIO.setmode(GPIO.BOARD)
+        setup_board()
         for pin in self.PINS.values():
             GPIO.setup(pin, GPIO.OUT)
         GPIO.setup(self.PINS['ir_beam'], GPIO.IN)
 
+    @traced(cat='gpio')
     def activate_solenoid(self, pin):
         GPIO.output(pin, 1)
 
+    @traced(cat='gpio')
     def deactivate_solenoid(self, pin):
         GPIO.output(pin, 0)
 
+    @traced(cat='gpio')
     def activate_odor_intan_input(self, pin):
         GPIO.output(pin, 1)
 
+    @traced(cat='gpio')
     def deactivate_odor_intan_input(self, pin):
         GPIO.output(pin, 0)
 
+    @traced(cat='gpio')
     def activate_taste_intan_input(self, pin):
         GPIO.output(pin, 1)
 
+    @traced(cat='gpio')
     def deactivate_taste_intan_input(self, pin):
         GPIO.output(pin, 0)
         
+    @traced(cat='gpio')
     def activate_water_intan_input(self, pin):
         GPIO.output(pin, 1)
 
+    @traced(cat='gpio')
     def deactivate_water_intan_input(self, pin):
         GPIO.output(pin, 0)
         
+    @traced(cat='gpio')
     def activate_reward_intan_input(self, pin):
         GPIO.output(pin, 1)
         pass
 
+    @traced(cat='gpio')
     def deactivate_reward_intan_input(self, pin):
         GPIO.output(pin, 0)
 
+    @traced(cat='gpio')
     def activate_cue_light(self):
         GPIO.output(self.PINS['cue_light'], 0)  # Activate cue light
 
+    @traced(cat='gpio')
     def deactivate_cue_light(self):
         GPIO.output(self.PINS['cue_light'], 1)  # Deactivate cue light
 
+    @traced(cat='log')
     def log_event(self, event_name):
-        timestamp = time.time()
-        timestamp_tenths = int((timestamp % 1) * 10)
-        formatted_timestamp = time.strftime("%Y-%m-%d %H:%M:%S.", time.localtime()) + str(timestamp_tenths)
-        print(f"[{formatted_timestamp}] {event_name}")
+        self.event_log.log_event(event_name)
 
     def run_experiment(self, num_trials, selected_odors, water_open_times, reward_open_times, taste_open_times, water_intan_pin, taste_intan_pin, reward_intan_pin, odor_intan_pin):
         try:
@@ -78,20 +96,15 @@ class Experiment:
 
                 # Wait for IR beam to be crossed for at least 0.5 seconds
                 self.log_event("Waiting for IR beam to be crossed for 0.5 seconds...")
-                start_time = time.time()
-                crossed_duration = 0
-                while crossed_duration < 0.5:
-                    if GPIO.input(self.PINS['ir_beam']) == 1:
-                        crossed_duration = time.time() - start_time
-                    else:
-                        crossed_duration = 0  # Reset the timer if beam is broken
-                    time.sleep(0.1)  # Adjust the sleep time as needed
+                with tracer.span('wait_for_poke', 'sleep', trial=trial + 1):
+                    self.ir_beam.wait_for_hold(0.5)
 
                 self.log_event("Cue light turned Off")
                 self.log_event("Vacuum Off")
                 self.activate_solenoid(23)
                 self.deactivate_cue_light()
                 odor_intan_pin = 8
+                selected_odor_pin = self.PINS['odor_solenoids'][random.choice(selected_odors)]
                         
                 self.log_event("Odor solenoid turned On")
                 self.activate_solenoid(selected_odor_pin)
@@ -105,7 +118,8 @@ class Experiment:
                 self.activate_water_intan_input(self.PINS['water_intan_pin'])
 
                 # Sleep for the specified water solenoid open time
-                time.sleep(water_open_times)
+                with tracer.span('water.wait', 'sleep', width=water_open_times):
+                    clock.sleep(water_open_times)
 
                 # Close the water solenoid after the specified open time
                 self.log_event("Water solenoid turned Off")
@@ -117,46 +131,42 @@ class Experiment:
                 
                 self.log_event("Deactivating Odor Intan Pin")
                 self.deactivate_odor_intan_input(odor_intan_pin)
-                time.sleep(2)
+                clock.sleep(2)
                 self.log_event("Vacuum On")
                 self.deactivate_solenoid(23)
 
-                time.sleep(30)
+                clock.sleep(30)
                 # Check if the IR beam is crossed for 2.1 seconds
                 
                 self.log_event("Checking IR beam for 2.1 seconds...")
-                start_time = time.time()
-                crossed_duration = 0
-                while crossed_duration < 1:
-                    if GPIO.input(self.PINS['ir_beam']) == 0:
-                        crossed_duration = time.time() - start_time
-                    else:
-                        crossed_duration = 0  # Reset the timer if beam is broken
-
-                    if crossed_duration >= 0.5:
-                        self.log_event("IR beam crossed for 0.5 seconds. Reward solenoid turned On")
-                        self.activate_solenoid(self.PINS['reward_solenoid'])
-                        self.activate_reward_intan_input(self.PINS['reward_intan_pin'])
-                        time.sleep(reward_open_times)
-
-                        self.log_event("Reward solenoid turned Off")
-                        self.deactivate_solenoid(self.PINS['reward_solenoid'])
-                        self.deactivate_reward_intan_input(self.PINS['reward_intan_pin'])
-                    else:
-                        self.log_event("IR beam not crossed for 0.5 seconds. Skipping reward.")
-
-                    iti = random.uniform(30, 45)
-                    self.log_event("Waiting for ITI (Inter-Trial Interval)...")
-                    time.sleep(iti)
-
-                    if trial < num_trials - 1:
-                        # Print a space between trials
-                        print("\n")
+                # This check counts the beam as crossed while it reads 0
+                if self.ir_beam.wait_for_hold(0.5, crossed=False, timeout=2.1):
+                    self.log_event("IR beam crossed for 0.5 seconds. Reward solenoid turned On")
+                    self.activate_solenoid(self.PINS['reward_solenoid'])
+                    self.activate_reward_intan_input(self.PINS['reward_intan_pin'])
+                    with tracer.span('reward.wait', 'sleep', width=reward_open_times):
+                        clock.sleep(reward_open_times)
+
+                    self.log_event("Reward solenoid turned Off")
+                    self.deactivate_solenoid(self.PINS['reward_solenoid'])
+                    self.deactivate_reward_intan_input(self.PINS['reward_intan_pin'])
+                else:
+                    self.log_event("IR beam not crossed for 0.5 seconds. Skipping reward.")
+
+                iti = random.uniform(30, 45)
+                self.log_event("Waiting for ITI (Inter-Trial Interval)...")
+                clock.sleep(iti)
+
+                if trial < num_trials - 1:
+                    # Print a space between trials
+                    self.event_log.echo("\n")
                                 
         except KeyboardInterrupt:
-            print("Experiment interrupted by user.")
+            self.event_log.echo("Experiment interrupted by user.")
 
         finally:
+            self.event_log.flush()
+            self.ir_beam.close()
             GPIO.cleanup()
 
 def main():
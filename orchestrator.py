@@ -0,0 +1,377 @@
+'''
+orchestrator launches, configures and monitors many rig sessions from one controller process
+
+Every session is one task function called with its arguments from a JSON config, in its own Python process, so
+nothing asks for input: the menus, input() and easygui prompts are replaced by the config, and a task that still
+prompts fails straight away (its stdin is closed) instead of hanging. Sessions on this machine run as child
+processes; sessions on other boxes run under an agent listening on a socket there:
+
+    python orchestrator.py rigs.json                    # run every session in rigs.json, wait for all of them
+    python orchestrator.py agent --port 9100            # on each remote box (add --host 0.0.0.0 to accept
+                                                        # connections from other machines)
+
+rigs.json:
+    {"log_dir": "sessions/2026-10-18",
+     "telemetry_port": 8800,
+     "rigs": [
+        {"name": "box1", "task": "pi_rig:passive", "kwargs": {"trials": 30, "directory": "."}},
+        {"name": "box2", "task": "CuedTaste:run_session", "kwargs": {"anID": "JG12", "runtime": 60},
+         "agent": "10.0.0.12:9100"},
+        {"name": "box3", "task": "pipi2:run_session", "kwargs": {"num_trials": 40, ...}, "env": {...}},
+        {"name": "sim1", "task": "rig_sim:run_basic_np", "kwargs": {"trials": 50}}]}
+
+task = "<module>:<function>" of this repository (CuedTaste is loaded by path). Each session runs in
+<log_dir>/<name>/ (remote sessions: <root>/<name>/ on the agent's box), and its output goes to output.log there. The
+controller also writes every line of every session, timestamped and prefixed with the rig name, to
+<log_dir>/orchestrator_log.csv. With telemetry_port, session i serves its telemetry (see telemetry) on
+telemetry_port + 1 + i, the controller serves the combined dashboard on telemetry_port, and every rig's snapshot
+is collected into <log_dir>/metrics.json while the sessions run.
+
+Agents take jobs from the network, so a remote session may only run one of the AGENT_TASKS protocol entry points,
+and its env may only set the AGENT_ENV variables; the controller checks this before sending, the agent again before
+running.
+'''
+
+import argparse
+import collections
+import datetime
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from event_log import EventLog
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+RESULT = '@@orchestrator-result '  # prefix of the line a session prints with its task's return value
+
+# Tasks an agent runs: the rig protocols and their simulated runs
+AGENT_TASKS = {'pi_rig:passive', 'pi_rig:passive_cue', 'pi_rig:basic_np', 'pi_rig:odor_np', 'pi_rig:affective',
+               'jet_rig:passive', 'jet_rig:passive_cue', 'jet_rig:basic_np', 'jet_rig:odor_np',
+               'CuedTaste:run_session', 'pipi2:run_session',
+               'rig_sim:run_passive', 'rig_sim:run_basic_np', 'rig_sim:run_odor_np', 'rig_sim:run_affective',
+               'rig_sim:run_cuedtaste', 'rig_sim:run_pipi2', 'rig_sim:run_odor_pi'}
+# Environment variables a remote job may set (RIG_TRACE is left out: it names a file the session writes)
+AGENT_ENV = {'RIG_TELEMETRY', 'RIG_GPIO_BACKEND', 'RIG_SYNC_PIN'}
+
+
+# Raise ValueError if an agent may not run [job]
+def check_remote_job(job):
+    if job.get('task') not in AGENT_TASKS:
+        raise ValueError('task ' + repr(job.get('task')) + ' is not one an agent runs (see AGENT_TASKS)')
+    rejected = sorted(set(job.get('env', {})) - AGENT_ENV)
+    if rejected:
+        raise ValueError('env ' + ', '.join(rejected) + ' may not be set on an agent (see AGENT_ENV)')
+
+
+# One session's progress. state = 'starting', 'running', 'done' or 'failed'.
+class RigStatus:
+    def __init__(self, name):
+        self.name = name
+        self.state = 'starting'
+        self.returncode = None
+        self.result = None
+        self.started = time.time()
+        self.ended = None
+        self.lines = 0
+        self.last_line = ''
+
+    def as_dict(self):
+        return {'state': self.state, 'returncode': self.returncode, 'result': self.result,
+                'duration_s': round((self.ended or time.time()) - self.started, 1), 'lines': self.lines,
+                'last_line': self.last_line}
+
+
+# Child process running one job. on_line(line) is called, in a reader thread, for every line it prints.
+class RigProcess:
+    def __init__(self, job, workdir, on_line):
+        os.makedirs(workdir, exist_ok=True)
+        env = dict(os.environ, **{key: str(value) for key, value in job.get('env', {}).items()})
+        env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+        self.process = subprocess.Popen([sys.executable, '-u', os.path.abspath(__file__), 'run', json.dumps(job)],
+                                        cwd=workdir, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, text=True, bufsize=1)
+        self.reader = threading.Thread(target=self._read, args=(on_line,), name='RigProcess ' + job['name'],
+                                       daemon=True)
+        self.reader.start()
+
+    def _read(self, on_line):
+        for line in self.process.stdout:
+            on_line(line.rstrip('\n'))
+
+    def wait(self):
+        code = self.process.wait()
+        self.reader.join()
+        return code
+
+    def stop(self):  # SIGTERM: the session's EventLogs flush on the way out
+        if self.process.poll() is None:
+            self.process.terminate()
+
+
+# A job run by the agent at [address] ("host:port"), with the same interface as RigProcess
+class RemoteRig:
+    def __init__(self, job, address, on_line):
+        host, port = address.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)))
+        self.sock.sendall(json.dumps(job).encode() + b'\n')
+        self.returncode = None
+        self.reader = threading.Thread(target=self._read, args=(on_line,), name='RemoteRig ' + job['name'],
+                                       daemon=True)
+        self.reader.start()
+
+    def _read(self, on_line):
+        with self.sock.makefile('r') as f:
+            for line in f:
+                message = json.loads(line)
+                if 'line' in message:
+                    on_line(message['line'])
+                elif 'exit' in message:
+                    self.returncode = message['exit']
+                    break
+        if self.returncode is None:
+            self.returncode = -1  # connection lost before the agent reported the exit code
+
+    def wait(self):
+        self.reader.join()
+        return self.returncode
+
+    def stop(self):
+        try:
+            self.sock.sendall(b'{"stop": true}\n')
+        except OSError:
+            pass
+
+
+class Orchestrator:
+    # config = dict (see above). echo = also print every session line on the console.
+    def __init__(self, config, echo=True):
+        self.config = config
+        self.log_dir = os.path.abspath(config.get('log_dir', 'sessions'))
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.echo = echo
+        self.rigs = collections.OrderedDict()  # name -> (job, RigProcess / RemoteRig)
+        self.remote = {rig['name'] for rig in config['rigs'] if 'agent' in rig}
+        self.status = collections.OrderedDict()  # name -> RigStatus
+        self.log = EventLog(os.path.join(self.log_dir, 'orchestrator_log.csv'), echo=echo)
+        self.telemetry = collections.OrderedDict()  # name -> "host:port" of its telemetry server
+        self.outputs = {}  # name -> output.log of a local session, closed when it exits
+        self.server = None
+        self.done = threading.Event()
+        names = [rig['name'] for rig in config['rigs']]
+        if len(set(names)) != len(names):
+            raise ValueError('rig names must be unique')
+        for rig in config['rigs']:
+            if 'agent' in rig:
+                check_remote_job(rig)
+
+    def _job(self, i, rig):
+        job = {'name': rig['name'], 'task': rig['task'], 'kwargs': rig.get('kwargs', {}),
+               'env': dict(rig.get('env', {}))}
+        port = self.config.get('telemetry_port')
+        if port is not None:
+            port = port + 1 + i
+            host = rig['agent'].rsplit(':', 1)[0] if 'agent' in rig else '127.0.0.1'
+            job['env']['RIG_TELEMETRY'] = ('0.0.0.0:' if 'agent' in rig else '') + str(port)
+            self.telemetry[rig['name']] = host + ':' + str(port)
+        return job
+
+    def _on_line(self, name):
+        status = self.status[name]
+        output = None
+        if name not in self.remote:
+            output = self.outputs[name] = open(os.path.join(self.log_dir, name, 'output.log'), 'a')
+
+        def on_line(line):
+            if line.startswith(RESULT):
+                status.result = json.loads(line[len(RESULT):])
+                return
+            status.lines += 1
+            status.last_line = line
+            if status.state == 'starting':
+                status.state = 'running'
+            self.log.log_event('[' + name + '] ' + line)
+            if output is not None:
+                output.write(line + '\n')
+                output.flush()
+        return on_line
+
+    def start(self):
+        if self.config.get('telemetry_port') is not None:
+            import telemetry
+            self.server = telemetry.start(self.config['telemetry_port'])
+        for i, rig in enumerate(self.config['rigs']):
+            job = self._job(i, rig)
+            self.status[rig['name']] = RigStatus(rig['name'])
+            if 'agent' in rig:
+                runner = RemoteRig(job, rig['agent'], self._on_line(rig['name']))
+            else:
+                os.makedirs(os.path.join(self.log_dir, rig['name']), exist_ok=True)
+                runner = RigProcess(job, os.path.join(self.log_dir, rig['name']), self._on_line(rig['name']))
+            self.rigs[rig['name']] = (job, runner)
+            self.log.log_event('[' + rig['name'] + '] started ' + rig['task'] +
+                               (' on ' + rig['agent'] if 'agent' in rig else ''))
+        if self.telemetry:
+            self.log.log_event('dashboard: http://127.0.0.1:' + str(self.config['telemetry_port']) + '/?rigs=' +
+                               ','.join(self.telemetry.values()))
+            threading.Thread(target=self._collect, name='Orchestrator metrics', daemon=True).start()
+        return self
+
+    # Every [interval] seconds, save every rig's telemetry snapshot and the session states to metrics.json
+    def _collect(self, interval=5.0):
+        while not self.done.wait(interval):
+            self.save_metrics()
+
+    def save_metrics(self):
+        metrics = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'rigs': {}}
+        for name, status in list(self.status.items()):
+            metrics['rigs'][name] = status.as_dict()
+            address = self.telemetry.get(name)
+            if address is not None and status.state in ('starting', 'running'):
+                try:
+                    with urllib.request.urlopen('http://' + address + '/metrics', timeout=2) as response:
+                        metrics['rigs'][name]['telemetry'] = json.load(response)['sessions']
+                except OSError as e:
+                    metrics['rigs'][name]['telemetry_error'] = str(e)
+        with open(os.path.join(self.log_dir, 'metrics.json.tmp'), 'w') as f:
+            json.dump(metrics, f, indent=1, default=str)
+        os.replace(os.path.join(self.log_dir, 'metrics.json.tmp'), os.path.join(self.log_dir, 'metrics.json'))
+        return metrics
+
+    # Block until every session has exited. Returns {name: RigStatus}.
+    def wait(self):
+        for name, (job, runner) in self.rigs.items():
+            code = runner.wait()
+            if name in self.outputs:
+                self.outputs.pop(name).close()
+            status = self.status[name]
+            status.returncode = code
+            status.ended = time.time()
+            status.state = 'done' if code == 0 else 'failed'
+            self.log.log_event('[' + name + '] ' + status.state + ' (exit code ' + str(code) + ')')
+        self.done.set()
+        self.save_metrics()
+        self.log.close()
+        if self.server is not None:
+            self.server.close()
+        return self.status
+
+    def stop(self):
+        for job, runner in self.rigs.values():
+            runner.stop()
+
+
+# Agent: runs the jobs sent by controllers as local RigProcesses, in <root>/<name>, and streams their
+# output back as JSON lines ({"line": ...} for each line, {"exit": code} at the end)
+class Agent(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root='.'):
+        self.root = os.path.abspath(root)
+        super().__init__(address, _AgentHandler)
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        job = json.loads(self.rfile.readline())
+        lock = threading.Lock()
+
+        def send(message):
+            with lock:
+                try:
+                    self.wfile.write(json.dumps(message).encode() + b'\n')
+                    self.wfile.flush()
+                except OSError:
+                    pass  # the controller went away; the session carries on
+
+        try:
+            check_remote_job(job)
+        except ValueError as e:
+            send({'line': 'agent: ' + str(e)})
+            send({'exit': 2})
+            return
+        workdir = os.path.join(self.server.root, os.path.basename(job['name']))
+        os.makedirs(workdir, exist_ok=True)
+        with open(os.path.join(workdir, 'output.log'), 'a') as output:
+            def on_line(line):
+                send({'line': line})
+                output.write(line + '\n')
+                output.flush()
+            process = RigProcess(job, workdir, on_line)
+            threading.Thread(target=self._watch_stop, args=(process,), daemon=True).start()
+            send({'exit': process.wait()})
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)  # ends _watch_stop's read
+        except OSError:
+            pass
+
+    def _watch_stop(self, process):  # a {"stop": true} line from the controller stops the session
+        try:
+            for line in self.rfile:
+                if json.loads(line).get('stop'):
+                    process.stop()
+        except (OSError, ValueError):
+            pass
+
+
+# Import [module] from this repository (files without .py, like CuedTaste, by path). Agents take jobs from the
+# network, so only plain module names of files in this directory are accepted: no paths.
+def load_module(module):
+    path = os.path.join(REPO, module)
+    if os.path.exists(path + '.py'):
+        path += '.py'
+    if not module.isidentifier() or os.path.dirname(os.path.realpath(path)) != os.path.realpath(REPO):
+        raise ImportError('task module must be a module name in ' + REPO + ', not ' + repr(module))
+    if path.endswith('.py'):
+        return importlib.import_module(module)
+    if os.path.isfile(path):
+        loader = importlib.machinery.SourceFileLoader(module, path)
+        spec = importlib.util.spec_from_loader(module, loader)
+        loaded = importlib.util.module_from_spec(spec)
+        sys.modules[module] = loaded
+        loader.exec_module(loaded)
+        return loaded
+    raise ImportError('no task module ' + module + ' in ' + REPO)
+
+
+# Session process: call the job's task and print its return value on the RESULT line
+def run_job(job):
+    module, function = job['task'].split(':')
+    result = getattr(load_module(module), function)(**job.get('kwargs', {}))
+    print(RESULT + json.dumps(result, default=str), flush=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'run':
+        run_job(json.loads(sys.argv[2]))
+        raise SystemExit(0)
+    parser = argparse.ArgumentParser(description='Run rig sessions from one config, or serve as an agent')
+    parser.add_argument('config', help="rigs JSON config, or 'agent'")
+    parser.add_argument('--host', default='127.0.0.1', help='agent: address to listen on')
+    parser.add_argument('--port', type=int, default=9100, help='agent: port to listen on')
+    parser.add_argument('--root', default='.', help='agent: directory the sessions run in')
+    parser.add_argument('--quiet', action='store_true', help="don't echo the sessions' output")
+    args = parser.parse_args()
+    if args.config == 'agent':
+        with Agent((args.host, args.port), args.root) as agent:
+            print('agent listening on ' + args.host + ':' + str(args.port))
+            agent.serve_forever()
+    with open(args.config) as f:
+        orchestrator = Orchestrator(json.load(f), echo=not args.quiet).start()
+    try:
+        statuses = orchestrator.wait()
+    except KeyboardInterrupt:
+        orchestrator.stop()
+        statuses = orchestrator.wait()
+    for name, status in statuses.items():
+        print(name.ljust(16) + ' ' + status.state.ljust(7) + ' ' + json.dumps(status.as_dict()['result']))
+    raise SystemExit(0 if all(status.state == 'done' for status in statuses.values()) else 1)
@@ -5,18 +5,16 @@ These functions can be used directly via ipython in a terminal window or called
 '''
 
 # Import things for running pi codes
-import time, random, easygui, os, csv
-from math import floor
-import RPi.GPIO as GPIO
+import os, csv
+from rig_gpio import GPIO, clock, setup_board, PinGroup  # RPi.GPIO on the rig, or the simulator (see rig_gpio)
+from protocol import ProtocolEngine, load_protocol
+from calibration import CalibrationStore
+from trial_schedule import save_schedule
 
 # Import other things for video
 from subprocess import Popen
-import numpy as np
 
-# Setup pi board
-GPIO.setwarnings(False)
-GPIO.cleanup()
-GPIO.setmode(GPIO.BOARD)
+# The pi board is set up (cleanup + BOARD numbering) by setup_board() the first time a function below runs
 
 # To empty taste lines
 
@@ -25,79 +23,68 @@ def clearout(outports=[7, 11, 12, 13, 16, 31, 32, 33, 35, 36, 37, 38, 40, 15, 5,
 
 #7 and 11 are for ortho odor vacuum, 32, 36, 38, 40 are rig 2 outports, 13 and 16 are ortho odor input
     # Setup pi board GPIO ports
-    GPIO.setmode(GPIO.BOARD)
-    for i in outports:
-        GPIO.setup(i, GPIO.OUT)
+    setup_board()
+    lines = PinGroup(outports)  # all lines open and close in one write
+    lines.setup()
 
-    for i in outports:
-        GPIO.output(i, 1)
-    time.sleep(dur)
-    for i in outports:
-        GPIO.output(i, 0)
+    lines.output(1)
+    clock.sleep(dur)
+    lines.output(0)
 
     print('Tastant line clearing complete.')
 
 
 # To calibrate taste lines
-def calibrate(outports=[7, 11, 13, 12, 16, 23, 29, 31, 32, 33, 35, 36, 37, 38, 40], opentime=0.05, repeats=5):
+def calibrate(outports=[7, 11, 13, 12, 16, 23, 29, 31, 32, 33, 35, 36, 37, 38, 40], opentime=0.05, repeats=5, weigh=False):
 
     # Setup pi board GPIO ports
-    GPIO.setmode(GPIO.BOARD)
-    for i in outports:
-        GPIO.setup(i, GPIO.OUT)
+    setup_board()
+    lines = PinGroup(outports)
+    lines.setup()
 
     # Open ports
     for rep in range(repeats):
+        lines.output(1)
+        clock.sleep(opentime)
+        lines.output(0)
+        clock.sleep(1)
+
+    # Keep the weighed volumes in each valve's opentime -> volume curve (see calibration)
+    if weigh:
+        store = CalibrationStore()
         for i in outports:
-            GPIO.output(i, 1)
-        time.sleep(opentime)
-        for i in outports:
-            GPIO.output(i, 0)
-        time.sleep(1)
+            weight = input('weight dispensed by port ' + str(i) + ' in grams (enter to skip): ')
+            if weight:
+                store.add(i, opentime, float(weight) * 1000 / repeats, deliveries=repeats)
 
-    print('Calibration procedure complete.')
+    print('Calibration procedure complete. Line write skew: ' + str(lines.summary()))
 
 
-# Passive deliveries
+# Passive deliveries. The tasks below are declared as state machines in protocols.json and run by
+# protocol.ProtocolEngine; the arguments override the protocol's params.
+# record = event stream file of the session's pokes and outputs (passive_cue, basic_np, odor_np, affective), for
+# replay.py and analytics.py
 def passive(outports=[37, 36, 38, 40, 32, 16, 18],
     intaninputs=[15, 19, 21, 23, 11, 12, 13], 
     opentimes=[0.01, 0.01, 0.01, 0.01, 0.01, 0.01], 
-    itimin=22, itimax=22, trials=30):
+    itimin=22, itimax=22, trials=30, directory=None, seed=None, block=None):
 	
 	# Ask the user for the directory to save the video files in
-    directory = easygui.diropenbox(msg='Select the directory to save the delivery times from this experiment.', title='Select directory')
+    if directory is None:
+        import easygui
+        directory = easygui.diropenbox(msg='Select the directory to save the delivery times from this experiment.', title='Select directory')
 	# Change to that directory
     os.chdir(directory)
 	
     # Setup pi board GPIO ports
-    GPIO.setmode(GPIO.BOARD)
-    for i in outports:
-        GPIO.setup(i, GPIO.OUT)
-    for i in intaninputs:
-        GPIO.setup(i, GPIO.OUT)
-
-    # Set and radomize trial order
-    tot_trials = len(outports) * trials
-    count = 0
-    trial_array = trials * list(np.arange(len(outports)))
-    time_array = [] #Store delivery times
-    random.shuffle(trial_array)
-
-    time.sleep(15)
-    print(trial_array)
-    # Loop through trials
-    for i in trial_array:
-        time_array.append(time.ctime())
-        GPIO.output(outports[i], 1) #opens the solenoid
-        GPIO.output(intaninputs[i], 1) #changes dig_in signal to 1
-        time.sleep(opentimes[i]) #waits for opentime
-        GPIO.output(outports[i], 0) #closes the solenoid
-        GPIO.output(intaninputs[i], 0) #changes dig_in signal to 0
-        count += 1
-        iti = random.randint(itimin, itimax)
-        print('Trial '+str(count)+' of '+str(tot_trials) +
-              ' completed. ITI = '+str(iti)+' sec.')
-        time.sleep(iti)
+    setup_board()
+
+    # Trials run against absolute deadlines, so per-trial overhead (prints, clock.ctime(), GPIO calls) can't
+    # accumulate into drift
+    run = ProtocolEngine(load_protocol('passive'), dict(outports=outports, intaninputs=intaninputs,
+                         opentimes=opentimes, itimin=itimin, itimax=itimax, trials=trials,
+                         seed=seed, block=block)).run()
+    time_array = run.stamps['times'] #Store delivery times
 
     print('Passive deliveries completed')
 	
@@ -110,52 +97,26 @@ def passive(outports=[37, 36, 38, 40, 32, 16, 18],
             spamwriter.writerow(time_array[r_i])
 			
     print('Delivery times .csv saved.')
+    print(run.report)
+    run.report.save('delivery_jitter.csv')
+    run.pulses.save('pulse_widths.csv')
+    save_schedule('trial_schedule.npz', run.values['schedule'])  # order, ITIs and seed, to rerun the session
     
 
 def passive_cue(
     outports=[7, 11, 13, 16, 31, 32, 33, 35, 36, 37, 38, 40], 
     intaninputs=[24, 26, 19, 21], 
     opentimes=[0.01], itimin=10, itimax=30, trials=150,
-    cue_input = 40):
+    cue_input = 40, seed=None, block=None, record=None):
 
     # Setup pi board GPIO ports
-    GPIO.setmode(GPIO.BOARD)
-    for i in outports:
-        GPIO.setup(i, GPIO.OUT)
-    for i in intaninputs:
-        GPIO.setup(i, GPIO.OUT)
-    GPIO.setup(cue_input, GPIO.OUT)
-
-    # Set and radomize trial order
-    tot_trials = len(outports) * trials
-    count = 0
-    #trial_array = trials * range(len(outports))
-    trial_array = trials * list(np.arange(len(outports)))
-    time_array = [] #Store delivery times
-    random.shuffle(trial_array)
-
-    time.sleep(3)
-
-    # Loop through trials
-    for i in trial_array:
-        time_array.append(time.ctime())
-        GPIO.output(cue_input, 1)
-        #time.sleep(1) #if you want cue on before taste delivery, uncomment
-        #GPIO.output(cue_input, 0)
-        #time.sleep(1)
-        GPIO.output(outports[i], 1)
-        GPIO.output(intaninputs[i], 1)
-        time.sleep(opentimes[i])
-
-        GPIO.output(outports[i], 0)
-        GPIO.output(intaninputs[i], 0)
-        time.sleep(1)
-        GPIO.output(cue_input, 0)
-        count += 1
-        iti = random.randint(itimin, itimax)
-        print('Trial '+str(count)+' of '+str(tot_trials) +
-              ' completed. ITI = '+str(iti)+' sec.')
-        time.sleep(iti)
+    setup_board()
+
+    # Cue on with each delivery, off 1 s after the valve closes
+    run = ProtocolEngine(load_protocol('passive_cue'), dict(outports=outports, intaninputs=intaninputs,
+                         opentimes=opentimes, itimin=itimin, itimax=itimax, trials=trials,
+                         cue_input=cue_input, seed=seed, block=block), record=record).run()
+    time_array = run.stamps['times'] #Store delivery times
 
     print('Passive deliveries completed')
 	
@@ -168,205 +129,52 @@ def passive_cue(
             spamwriter.writerow(time_array[r_i])
 			
     print('Delivery times .csv saved.')
+    print(run.report)
+    run.report.save('delivery_jitter.csv')
+    run.pulses.save('pulse_widths.csv')
+    save_schedule('trial_schedule.npz', run.values['schedule'])  # order, ITIs and seed, to rerun the session
 
 
 # Basic nose poking procedure to train poking for discrimination 2-AFC task
-def basic_np(outport=40, opentime=0.012, iti=[.4, 1, 2], trials=200, outtime=0):
-
-    intaninput = 8
-    trial = 1
-    inport = 13
-    pokelight = 15 #edit
-    houselight = 22 #edit
-    lights = 0
-    maxtime = 60
+def basic_np(outport=40, opentime=0.012, iti=[.4, 1, 2], trials=200, outtime=0, record=None):
 
     # Setup pi board GPIO ports
-    GPIO.setmode(GPIO.BOARD)
-    GPIO.setup(pokelight, GPIO.OUT)
-    GPIO.setup(houselight, GPIO.OUT)
-    GPIO.setup(inport, GPIO.IN)
-    GPIO.setup(outport, GPIO.OUT)
-    GPIO.setup(intaninput, GPIO.OUT)
-
-    time.sleep(15)
-    starttime = time.time()
-
-    while trial <= trials:
-
-        # Timer to stop experiment if over 60 mins
-        curtime = time.time()
-        elapsedtime = round((curtime - starttime)/60, 2)
-        if elapsedtime > maxtime:
-            GPIO.output(pokelight, 0)
-            GPIO.output(houselight, 0)
-            break
-
-        if lights == 0:
-            GPIO.output(pokelight, 1)
-            GPIO.output(houselight, 1)
-            lights = 1
-
-        # Check for pokes
-        if GPIO.input(inport) == 0:
-            poketime = time.time()
-            curtime = poketime
-
-            # Make rat remove nose from nose poke to receive reward
-            while (curtime - poketime) <= outtime:
-                if GPIO.input(inport) == 0:
-                    poketime = time.time()
-                curtime = time.time()
-
-            # Taste delivery and switch off lights
-            GPIO.output(outport, 1)
-            GPIO.output(intaninput, 1)
-            time.sleep(opentime)
-            GPIO.output(outport, 0)
-            GPIO.output(intaninput, 1)
-            GPIO.output(pokelight, 0)
-            GPIO.output(houselight, 0)
-            print('Trial '+str(trial)+' of '+str(trials)+' completed.')
-            trial += 1
-            lights = 0
-
-            # Calculate and execute ITI delay.  Pokes during ITI reset ITI timer.
-            if trial <= trials/2:
-                delay = floor((random.random()*(iti[1]-iti[0]))*100)/100+iti[0]
-            else:
-                delay = floor((random.random()*(iti[2]-iti[0]))*100)/100+iti[0]
-
-            poketime = time.time()
-            curtime = poketime
-
-            while (curtime - poketime) <= delay:
-                if GPIO.input(inport) == 0:
-                    poketime = time.time()
-                curtime = time.time()
+    setup_board()
 
-    print('Basic nose poking has been completed.')
+    # Pins: intaninput 8, inport 13, pokelight 15, houselight 22 (protocols.json). Pokes during the ITI reset
+    # the ITI timer; the session stops after maxtime (60) minutes.
+    run = ProtocolEngine(load_protocol('basic_np'), dict(outport=outport, opentime=opentime, iti=iti,
+                         trials=trials, outtime=outtime), record=record).run()
 
+    print('Valve pulse widths: '+str(run.pulses.summary()))
+    print('Basic nose poking has been completed.')
 
-def odor_np(outport=40, odorport=36, vacport=37, t_opentime=0.012, o_opentime=0.5, v_opentime=1, iti=[.4, 1, 2], trials=200, outtime=0):
 
-    intaninput_t = 8
-    intaninput_o = 10
-    intaninput_v = 12
-    trial = 1
-    inport = 13
-    pokelight = 15 #edit
-    houselight = 22 #edit
-#    lights = 0
-    maxtime = 60
+def odor_np(outport=40, odorport=36, vacport=37, t_opentime=0.012, o_opentime=0.5, v_opentime=1, iti=[.4, 1, 2], trials=200, outtime=0, record=None):
 
     # Setup pi board GPIO ports
-    GPIO.setmode(GPIO.BOARD)
-    GPIO.setup(pokelight, GPIO.OUT)
-    GPIO.setup(houselight, GPIO.OUT)
-    GPIO.setup(inport, GPIO.IN)
-    GPIO.setup(outport, GPIO.OUT)
-    GPIO.setup(intaninput_t, GPIO.OUT)
-    GPIO.setup(odorport, GPIO.OUT)
-    GPIO.setup(intaninput_o, GPIO.OUT)
-    GPIO.setup(vacport, GPIO.OUT)
-    GPIO.setup(intaninput_v, GPIO.OUT)
-    
-    time.sleep(15)
-    starttime = time.time()
-
-    while trial <= trials:
-
-        # Timer to stop experiment if over 60 mins
-        curtime = time.time()
-        elapsedtime = round((curtime - starttime)/60, 2)
-        if elapsedtime > maxtime:
-            GPIO.output(pokelight, 0)
-            GPIO.output(houselight, 0)
-            break
-
-#        if lights == 0:
-#            GPIO.output(pokelight, 1)
-        GPIO.output(houselight, 1)
-#            lights = 1
-
-        # Check for pokes
-        if GPIO.input(inport) == 0:
-            poketime = time.time()
-            curtime = poketime
-            #vacuum
-            GPIO.output(vacport, 1)
-            GPIO.output(intaninput_v, 1)
-            time.sleep(0.2)  # Overlap vacport with odorport
-            GPIO.output(odorport, 1)
-            GPIO.output(intaninput_o, 1)
-            time.sleep(0.5)  # Remaining 0.2 seconds of odorport opentime
-            GPIO.output(vacport, 0)
-            GPIO.output(odorport, 0)
-            GPIO.output(intaninput_v, 0)
-            GPIO.output(intaninput_o, 0)
-
-            # Make rat remove nose from nose poke to receive reward
-            while (curtime - poketime) <= outtime:
-                if GPIO.input(inport) == 0:
-                    poketime = time.time()
-                curtime = time.time()
-
-            # Taste delivery and switch off lights
-            GPIO.output(outport, 1)
-            GPIO.output(intaninput_t, 1)
-            time.sleep(t_opentime)
-            GPIO.output(outport, 0)
-            GPIO.output(intaninput_t, 1)
-#            GPIO.output(pokelight, 0)
-            GPIO.output(houselight, 0)
-            print('Trial '+str(trial)+' of '+str(trials)+' completed.')
-            trial += 1
-#            lights = 0
-
-            # Calculate and execute ITI delay.  Pokes during ITI reset ITI timer.
-            delay = np.random.choice(np.arange(30, 40, 1), size=1)
-            time.sleep(delay)
-            
-# =============================================================================
-#             if trial <= trials/2:
-#                 delay = floor((random.random()*(iti[1]-iti[0]))*100)/100+iti[0]
-#             else:
-#                 delay = floor((random.random()*(iti[2]-iti[0]))*100)/100+iti[0]
-# 
-#             poketime = time.time()
-#             curtime = poketime
-# 
-#             while (curtime - poketime) <= delay:
-#                 if GPIO.input(inport) == 0:
-#                     poketime = time.time()
-#                 curtime = time.time()
-# 
-# =============================================================================
+    setup_board()
+
+    # Poke -> vacuum, odor 0.2 s later, both off 0.5 s after that -> taste once the rat leaves the port ->
+    # 30-39 s ITI. Pins: intaninputs 8 (taste) / 10 (odor) / 12 (vacuum), inport 13, houselight 22.
+    run = ProtocolEngine(load_protocol('odor_np'), dict(outport=outport, odorport=odorport, vacport=vacport,
+                         t_opentime=t_opentime, o_opentime=o_opentime, v_opentime=v_opentime, iti=iti,
+                         trials=trials, outtime=outtime), record=record).run()
+
+    print('Valve pulse widths: '+str(run.pulses.summary()))
+    print('Vacuum/odor onset skew: '+str(run.timelines.summary()))
     print('Basic nose poking has been completed.')
 
 # Passive H2O deliveries
 
 
-def affective(intaninputs=[24], tim_dur=1200):
+def affective(intaninputs=[24], tim_dur=1200, record=None):
 
     # Setup pi board GPIO ports
-    GPIO.setmode(GPIO.BOARD)
-    for i in intaninputs:
-        GPIO.setup(i, GPIO.OUT)
+    setup_board()
 
-    # Loop through trials
-
-    GPIO.output(intaninputs[0], 1)
-    time.sleep(0.1)
-    GPIO.output(intaninputs[0], 0)
-
-    time.sleep(tim_dur)
-
-    GPIO.output(intaninputs[0], 1)
-    time.sleep(0.1)
-    GPIO.output(intaninputs[0], 0)
-
-    print('Test completed')
+    # 0.1 s intan marks at the start and after tim_dur seconds
+    ProtocolEngine(load_protocol('affective'), dict(intaninputs=intaninputs, tim_dur=tim_dur), record=record).run()
 
 
 # Clear all pi board GPIO settings
@@ -380,25 +188,11 @@ def clearall():
     lasers = [12, 18, 23, 8]
     intan = [12, 15, 19, 21, 23, 11, 13]
 
-    # Set all ports to default/low state
-    for i in intan:
-        GPIO.setup(i, GPIO.OUT)
-        GPIO.output(i, 0)
-
-    for i in outports:
-        GPIO.setup(i, GPIO.OUT)
-        GPIO.output(i, 0)
+    setup_board()
+    # Set all ports to default/low state, in one write
+    outputs = PinGroup(list(dict.fromkeys(intan + outports + pokelights + lasers + [houselight])))
+    outputs.setup()
+    outputs.output(0)
 
     for i in inports:
         GPIO.setup(i, GPIO.IN, GPIO.PUD_UP)
-
-    for i in pokelights:
-        GPIO.setup(i, GPIO.OUT)
-        GPIO.output(i, 0)
-
-    for i in lasers:
-        GPIO.setup(i, GPIO.OUT)
-        GPIO.output(i, 0)
-
-    GPIO.setup(houselight, GPIO.OUT)
-    GPIO.output(houselight, 0)
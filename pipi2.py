@@ -1,35 +1,41 @@
-import RPi.GPIO as GPIO
-import time
-import datetime
+from rig_gpio import GPIO, clock, setup_board  # RPi.GPIO on the rig, or the simulator (see rig_gpio)
 import random
 import curses
 import configparser
 import logging
+import os
 import sys
-import csv
-from picamera import PiCamera
-import multiprocessing
-from multiprocessing import Pool
+from pokes import PokeMonitor
+from event_log import EventLog
+from workers import WorkerPool, log_summary
+from timelines import Channel, TimelineRuntime
+from tracing import tracer, traced
+import telemetry
+import intan_sync
+from video import VideoCapture, ClipRecorder
 
 class GPIOController:
-    def __init__(self):
-        self.PINS = {
-            'cue_light': 11,
-            'ir_beam': 13,
-            'vacuum_solenoids': [8, 10, 12],
-            'odor_solenoids': [31, 33, 35],
-            'digital_inputs': [19, 21, 23, 16, 18, 22],
-            'taste_solenoid': [26, 32, 36, 37, 38, 40],
-            'water_solenoid': None,
-            'retro_solenoid': None,
-        }
+    # Pin map shared by the controller and Experiment (main() fills in the water/retro solenoid pins)
+    PINS = {
+        'cue_light': 11,
+        'ir_beam': 13,
+        'vacuum_solenoids': [8, 10, 12],
+        'odor_solenoids': [31, 33, 35],
+        'digital_inputs': [19, 21, 23, 16, 18, 22],
+        'taste_solenoid': [26, 32, 36, 37, 38, 40],
+        'water_solenoid': None,
+        'retro_solenoid': None,
+    }
+
+    # pins = PINS entries to change for this controller only (e.g. the solenoid pins), leaving the class map as it is
+    def __init__(self, pins=None):
+        self.PINS = dict(self.PINS, **(pins or {}))
 
     def setup(self):
-        GPIO.setwarnings(False)
-        GPIO.cleanup()
-        GPIO.setmode(GPIO.BOARD)
+        setup_board()
         for pin in self.PINS.values():
-            GPIO.setup(pin, GPIO.OUT)
+            if pin is not None:
+                GPIO.setup(pin, GPIO.OUT)
         GPIO.setup(self.PINS['ir_beam'], GPIO.IN)
 
     def activate_solenoid(self, pin):
@@ -46,43 +52,63 @@ class GPIOController:
         GPIO.setup(pin, GPIO.IN)
 
 class Logger:
-    def __init__(self, filename):
+    # events = the EventLog that already owns [filename] (the experiment's), which log_event writes through
+    def __init__(self, filename, events):
         logging.basicConfig(filename=filename, level=logging.INFO, format='[%(asctime)s] %(message)s')
         self.logger = logging.getLogger('Experiment')
         self.log_filename = filename
+        self.events = events
+
+    def error(self, message):
+        self.logger.error(message)
 
+    # Timestamp the event and hand it to the background writer, which prints it and appends it to the CSV
     def log_event(self, event_name):
-        current_time = datetime.datetime.now()
-        formatted_timestamp = current_time.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        log_line = f"[{formatted_timestamp}] {event_name}"
-        print(log_line)
-        with open(self.log_filename, mode='a', newline='') as log_file:
-            log_writer = csv.writer(log_file)
-            log_writer.writerow([formatted_timestamp, event_name])
+        self.events.log_event(event_name)
 
+# Records the whole session into segment files, or with clips=True only [pre_s] before to [post_s] after every
+# trigger() into clip files, with a frame timestamp index either way (see video)
 class VideoRecorder:
-    def __init__(self):
-        self.camera = PiCamera()
-
-    def record_video(self, filename, duration):
-        try:
-            self.camera.start_recording(filename)
-            self.camera.wait_recording(duration)
-        except Exception as e:
-            self.logger.error(f"Error in record_video: {str(e)}")
-
-    def stop_video_recording(self):
-        try:
-            self.camera.stop_recording()
-        except Exception as e:
-            self.logger.error(f"Error in stop_video_recording: {str(e)}")
+    def __init__(self, camera=None):
+        if camera is None:
+            from picamera import PiCamera
+            camera = PiCamera()
+        self.camera = camera
+        self.capture = None
+
+    def start_recording(self, directory, segment_s=60, framerate=30, clips=False, pre_s=3, post_s=3):
+        if clips:
+            self.capture = ClipRecorder(directory, camera=self.camera, pre_s=pre_s, post_s=post_s, framerate=framerate)
+        else:
+            self.capture = VideoCapture(directory, camera=self.camera, segment_s=segment_s, framerate=framerate)
+        self.capture.start()
+
+    # Mark a poke or delivery; only clip recording acts on it
+    def trigger(self, label, t_ns=None):
+        capture = self.capture
+        if isinstance(capture, ClipRecorder):
+            capture.trigger(label, t_ns)
+
+    # Returns the capture's summary, or None if nothing was recording
+    def stop_recording(self):
+        if self.capture is None:
+            return None
+        capture, self.capture = self.capture, None
+        return capture.stop()
 
 # Define a class for the experiment
 class Experiment:
-    def __init__(self):
+    PINS = GPIOController.PINS
+
+    # log_filename and camera default to config.ini and the PiCamera; pass them in to run without either.
+    # workers = the session's WorkerPool for side tasks (None = skip them). pins = PINS entries of this experiment
+    # only (see GPIOController).
+    def __init__(self, log_filename=None, camera=None, workers=None, pins=None):
         # Initialize GPIO controller
-        self.gpio_controller = GPIOController()
+        self.gpio_controller = GPIOController(pins)
         self.gpio_controller.setup()
+        self.PINS = self.gpio_controller.PINS
+        self.ir_beam = PokeMonitor(GPIO, self.gpio_controller.PINS['ir_beam'], active=1)  # edge-driven IR beam state
 
         # Initialize logger (global instance)
         self.logger = None
@@ -91,14 +117,29 @@ class Experiment:
         self.load_config()
 
         # Define the log filename based on the configuration
-        self.log_filename = self.config.get('Experiment', 'log_filename')
+        self.log_filename = log_filename or self.config.get('Experiment', 'log_filename')
+
+        # Buffered event log: events are printed and written to the CSV by a background thread
+        self.event_log = EventLog(self.log_filename, echo=True)
 
         # Initialize the video recorder
-        self.video_recorder = VideoRecorder()
+        self.video_recorder = VideoRecorder(camera)
+
+        # Runs the overlapping solenoid timelines of each trial and keeps their onset skew
+        self.timelines = TimelineRuntime()
+
+        self.workers = workers
+        self.sync = None  # intan_sync.SyncPulser of the running session, if any
+
+        # Live dashboard metrics, if a telemetry server is running (RIG_TELEMETRY=<port>; see telemetry)
+        self.telemetry = telemetry.session('pipi2')
+        if self.telemetry is not None:
+            self.ir_beam.add_listener(self.telemetry.on_poke)
+        self.ir_beam.add_listener(self.on_poke_video)
 
     # Function to set up logging (use the global logger)
     def setup_logging(self):
-        self.logger = Logger(self.log_filename)
+        self.logger = Logger(self.log_filename, self.event_log)
 
     # Function to get the animal ID from user input
     def get_animal_id(self):
@@ -107,36 +148,37 @@ class Experiment:
 
     # Function to set up GPIO pins
     def setup_gpio_pins(self):
-        GPIO.setwarnings(False)
-        GPIO.cleanup()
-        GPIO.setmode(GPIO.BOARD)
+        setup_board()
         for pin in self.PINS.values():
-            GPIO.setup(pin, GPIO.OUT)
+            if pin is not None:
+                GPIO.setup(pin, GPIO.OUT)
         GPIO.setup(self.PINS['ir_beam'], GPIO.IN)
 
     # Function to activate a solenoid
+    @traced(cat='gpio')
     def activate_solenoid(self, pin):
         GPIO.output(pin, 1)
 
     # Function to deactivate a solenoid
+    @traced(cat='gpio')
     def deactivate_solenoid(self, pin):
         GPIO.output(pin, 0)
 
     # Function to activate a digital input
+    @traced(cat='gpio')
     def activate_digital_input(self, pin):
         GPIO.setup(pin, GPIO.OUT)
         GPIO.output(pin, 1)
 
     # Function to deactivate a digital input
+    @traced(cat='gpio')
     def deactivate_digital_input(self, pin):
         GPIO.setup(pin, GPIO.IN)
 
     # Function to log an event with a timestamp
+    @traced(cat='log')
     def log_event(self, event_name):
-        current_time = datetime.datetime.now()
-        formatted_timestamp = current_time.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        log_line = f"[{formatted_timestamp}] {event_name}"
-        print(log_line)
+        self.event_log.log_event(event_name)
 
         # Define quirky messages for specific events
         quirky_messages = {
@@ -147,85 +189,65 @@ class Experiment:
 
         quirky_message = quirky_messages.get(event_name, "")
         if quirky_message:
-            print(f"{quirky_message}")
-
-        # Log the event to a CSV file
-        with open(self.log_filename, mode='a', newline='') as log_file:
-            log_writer = csv.writer(log_file)
-            log_writer.writerow([formatted_timestamp, event_name])
+            self.event_log.echo(quirky_message)
 
     # Function to load configuration settings from a file
     def load_config(self):
         self.config = configparser.ConfigParser()
         self.config.read('config.ini')
 
-    # Function to run the odor solenoid
-    def run_odor_solenoid(self, pin, barrier):
+    # IR beam listener: every crossing is a clip trigger
+    def on_poke_video(self, event):
+        if event.crossed:
+            self.video_recorder.trigger("poke", event.t_ns)
+
+    # Log each solenoid step written by the timeline runtime
+    def log_solenoid_step(self, channel, level, t_ns):
+        self.log_event(f"{channel.name} turned {'On' if level else 'Off'}")
+        if channel.name == "Water_solenoid" and level:
+            self.video_recorder.trigger("water", t_ns)
+        if self.telemetry is not None:
+            self.telemetry.output(channel.name, level, t_ns)
+            if channel.name == "Water_solenoid" and level:
+                self.telemetry.reward(t_ns)
+
+    # Function to start recording the session's video, into <log file name>_video/ next to the log, or with
+    # mode = clips in the [Video] section of config.ini, only the clips around pokes and water into _clips/
+    def start_video_recording(self):
         try:
-            self.log_event("Odor_solenoid turned On")
-            self.activate_solenoid(pin)
-            barrier.wait()
-            time.monotonic(2.1)
+            clips = self.config.get('Video', 'mode', fallback='session') == 'clips'
+            directory = os.path.splitext(self.log_filename)[0] + ("_clips" if clips else "_video")
+            self.video_recorder.start_recording(directory,
+                                                segment_s=self.config.getfloat('Video', 'segment_s', fallback=60),
+                                                framerate=self.config.getint('Video', 'framerate', fallback=30),
+                                                clips=clips,
+                                                pre_s=self.config.getfloat('Video', 'pre_s', fallback=3),
+                                                post_s=self.config.getfloat('Video', 'post_s', fallback=3))
+            self.log_event(f"Video recording started in {directory}")
 
         except Exception as e:
-            self.logger.error(f"Error in run_odor_solenoid: {str(e)}")
-
-        finally:
-            self.log_event("Odor_solenoid turned Off")
-            self.deactivate_solenoid(pin)
-
-    # Function to run the water solenoid
-    def run_water_solenoid(self, open_time, barrier):
-        try:
-            barrier.wait()
-            self.log_event("Water_solenoid turned On")
-            self.activate_solenoid(self.PINS['water_solenoid'])
-            time.monotonic(open_time)
-
-        except Exception as e:
-            self.logger.error(f"Error in run_water_solenoid: {str(e)}")
-
-        finally:
-            self.log_event("water_solenoid turned Off")
-
-    # Function to run the retro solenoid
-    def run_retro_solenoid(self, open_time, barrier):
-        try:
-            barrier.wait()
-            self.log_event("Retro_solenoid turned On")
-            self.activate_solenoid(self.PINS['retro_solenoid'])
-            time.monotonic(open_time)
-
-        except Exception as e:
-            self.logger.error(f"Error in run_retro_solenoid: {str(e)}")
-
-        finally:
-            self.log_event("Retro_solenoid turned Off")
-
-    # Function to record video using the camera
-    def record_video(self, filename, duration):
-        try:
-            self.video_recorder.record_video(filename, duration)
-
-        except Exception as e:
-            self.logger.error(f"Error in record_video: {str(e)}")
+            self.logger.error(f"Error in start_video_recording: {str(e)}")
 
     # Function to stop video recording
     def stop_video_recording(self):
         try:
-            self.video_recorder.stop_video_recording()
+            summary = self.video_recorder.stop_recording()
+            if summary is not None:
+                self.log_event("Video recording stopped")
+                self.event_log.echo(f"Video: {summary}")
 
         except Exception as e:
             self.logger.error(f"Error in stop_video_recording: {str(e)}")
 
     # Function to display a countdown on the terminal
+    @traced(cat='sleep')
     def countdown(self, seconds):
         try:
             for remaining in range(int(seconds), 0, -1):
                 sys.stdout.write("\r")
                 sys.stdout.write(f"Time remaining: {remaining} seconds")
                 sys.stdout.flush()
-                time.monotonic(1)
+                clock.sleep(1)
             sys.stdout.write("\r")
             sys.stdout.write("Time remaining: 0 seconds\n")
             sys.stdout.flush()
@@ -234,18 +256,25 @@ class Experiment:
             self.logger.error(f"Error in countdown: {str(e)}")
 
     # Function to run the entire experiment
-    def run_experiment(self, num_trials, selected_odors, intan_pins, water_open_time, retro_open_time):
+    def run_experiment(self, num_trials, selected_odors, intan_pins, water_open_time, retro_open_time, animal_id=None):
         try:
-            animal_id = self.get_animal_id()
+            if animal_id is None:
+                animal_id = self.get_animal_id()
             self.log_event(f"Animal ID: {animal_id}")
+            self.start_video_recording()  # runs until the session ends; frames are matched to events afterwards
+            # Numbered sync pulses to the Intan, if a sync pin is set ([Intan] sync_pin or RIG_SYNC_PIN; see intan_sync)
+            self.sync = intan_sync.session(os.path.splitext(self.log_filename)[0] + "_sync.csv",
+                                           pin=self.config.getint('Intan', 'sync_pin', fallback=None))
 
             for trial in range(num_trials):
                 self.log_event(f"=== Trial {trial + 1} ===")
+                if self.telemetry is not None:
+                    self.telemetry.trial("waiting for poke")
                 self.log_event("Cue light turned On")
                 self.log_event("Waiting for IR beam to be crossed...")
 
-                while GPIO.input(self.PINS['ir_beam']) == 0:
-                    pass
+                with tracer.span('wait_for_poke', 'sleep', trial=trial + 1):
+                    self.ir_beam.wait_for()
 
                 self.selected_odor_pin = None
                 self.selected_odor_intan = None
@@ -258,17 +287,14 @@ class Experiment:
                     self.selected_odor_intan = self.PINS['digital_inputs'][self.selected_odor]
                     self.log_event(f"Odor {self.selected_odor} turned On")
 
-                    # Create a synchronization barrier for solenoid processes
-                    self.solenoid_sync_barrier = multiprocessing.Barrier(2)
-                    odor_process = multiprocessing.Process(target=self.run_odor_solenoid, args=(self.selected_odor_pin, self.solenoid_sync_barrier))
-                    water_process = multiprocessing.Process(target=self.run_water_solenoid, args=(water_open_time,))
-                    retro_process = multiprocessing.Process(target=self.run_retro_solenoid, args=(retro_open_time, self.solenoid_sync_barrier))
-                    odor_process.start()
-                    water_process.start()
-                    retro_process.start()
-                    odor_process.join()
-                    water_process.join()
-                    retro_process.join()
+                    # Odor, water and retro solenoids open together on one asyncio loop (see timelines)
+                    solenoid_channels = [Channel("Odor_solenoid", self.selected_odor_pin, [(0, 1), (2.1, 0)]),
+                                         Channel("Water_solenoid", self.PINS['water_solenoid'],
+                                                 [(0, 1), (water_open_time, 0)]),
+                                         Channel("Retro_solenoid", self.PINS['retro_solenoid'],
+                                                 [(0, 1), (retro_open_time, 0)])]
+                    report = self.timelines.run(solenoid_channels, on_step=self.log_solenoid_step)
+                    self.log_event(f"Solenoid onset skew: {report.summary()['skew_ms']} ms")
 
                     # Deactivate digital input pins
                     for intan_pin in intan_pins:
@@ -284,30 +310,57 @@ class Experiment:
 
                 self.log_event("Water_solenoid turned On")
                 self.activate_solenoid(self.PINS['water_solenoid'])
-                time.monotonic(water_open_time)
+                self.video_recorder.trigger("water")
+                with tracer.span('water.wait', 'sleep', width=water_open_time):
+                    clock.sleep(water_open_time)
+                self.deactivate_solenoid(self.PINS['water_solenoid'])
                 self.log_event("Water_solenoid turned Off")
                 self.log_event("Cue light turned Off")
-                self.stop_video_recording()
                 iti = random.uniform(10, 15)
                 self.log_event("Waiting for ITI (Inter-Trial Interval)...")
                 self.countdown(iti)
                 if trial < num_trials - 1:
-                    print("\n")
+                    self.event_log.echo("\n")
 
         except KeyboardInterrupt:
             pass
 
         finally:
-            self.camera.close()
+            if self.sync is not None:
+                self.sync.stop()
+            self.stop_video_recording()
+            self.event_log.echo(f"Solenoid timelines: {self.timelines.summary()}")
+            self.event_log.flush()
+            self.timelines.close()
+            if self.workers is not None and os.path.exists(self.log_filename):
+                # Event counts for the session, worked out off the trial process
+                self.workers.submit(log_summary, self.log_filename,
+                                    os.path.splitext(self.log_filename)[0] + '_summary.csv', block=False)
+            self.ir_beam.close()
+            if self.telemetry is not None and telemetry.server is not None:
+                telemetry.server.remove(self.telemetry)  # off the dashboard
+            self.video_recorder.camera.close()
             GPIO.cleanup()
 
+# Run one session without the curses menu (see orchestrator). Returns the solenoid timelines' skew summary.
+def run_session(num_trials, selected_odors, intan_pins, water_solenoid, retro_solenoid, water_open_time,
+                retro_open_time, animal_id, log_filename=None, camera=None):
+    with WorkerPool(processes=1) as workers:
+        experiment = Experiment(log_filename=log_filename, camera=camera, workers=workers,
+                                pins={'water_solenoid': water_solenoid, 'retro_solenoid': retro_solenoid})
+        experiment.setup_logging()
+        experiment.run_experiment(num_trials, selected_odors, intan_pins, water_open_time, retro_open_time,
+                                  animal_id=animal_id)
+    return experiment.timelines.summary()
+
 def main(stdscr):
     curses.curs_set(0)
     stdscr.clear()
     stdscr.refresh()
 
     experiment = None  # Initialize experiment object outside the loop
-    pool = Pool(processes=1)  # Create a multiprocessing pool
+    # Side-task workers, started once before any rig threads exist so every session finds them warm
+    workers = WorkerPool(processes=1)
 
     while True:
         stdscr.clear()
@@ -342,12 +395,14 @@ def main(stdscr):
         elif choice == 7:
             retro_open_time = float(input("Enter retro solenoid open time (in seconds): "))
         elif choice == 8:
-            experiment = Experiment()
+            # The experiment holds the camera and GPIO state, so it runs here; only side tasks go to the workers
+            experiment = Experiment(workers=workers)
             experiment.setup_logging()  # Initialize the logger
-            pool.apply_async(experiment.run_experiment, (num_trials, selected_odors, intan_pins, water_open_time, retro_open_time))
+            experiment.run_experiment(num_trials, selected_odors, intan_pins, water_open_time, retro_open_time)
         elif choice == 9:
             if experiment:
-                experiment.camera.close()  # Close the camera if it's running
+                experiment.video_recorder.camera.close()  # Close the camera if it's running
+            workers.close()  # Finish any queued side tasks
             GPIO.cleanup()
             break
 
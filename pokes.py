@@ -0,0 +1,196 @@
+'''
+pokes contains the event-driven input layer for nose pokes and IR beams on the Katz Lab rigs
+
+Instead of spinning on GPIO.input(), a PokeMonitor registers edge callbacks on its pins, debounces them,
+keeps the current crossed/uncrossed state of every pin and pushes timestamped PokeEvents onto a queue.
+Protocols block on the wait_* methods, so a waiting task uses no CPU and wakes up at interrupt latency.
+
+All timing goes through a rig_gpio clock, so the same code runs in real time on a rig and in simulated time
+on the 'sim' backend. Run this file directly to measure callback latency and CPU use against SimGPIO.
+'''
+
+import collections
+import queue
+import threading
+
+import rig_gpio
+
+# One debounced beam transition. crossed = True when the animal broke the beam, t_ns = clock.monotonic_ns()
+PokeEvent = collections.namedtuple('PokeEvent', ['pin', 'crossed', 't_ns'])
+
+
+class PokeMonitor:
+    # gpio = rig_gpio.GPIO (or any GPIO-like module). pins = one pin or a list of input pins (already set up
+    # as GPIO.IN). active = the input level that means the beam is crossed, either one level for all pins or a
+    # dict of pin -> level. debounce = seconds an edge has to be stable before it is accepted. clock defaults
+    # to the clock of a simulated gpio, otherwise rig_gpio.clock.
+    def __init__(self, gpio, pins, active=0, debounce=0.005, clock=None):
+        self.gpio = gpio
+        self.clock = clock or getattr(gpio, 'clock', None) or rig_gpio.clock
+        self.pins = list(pins) if isinstance(pins, (list, tuple)) else [pins]
+        self.active = active if isinstance(active, dict) else {pin: active for pin in self.pins}
+        self.debounce_ns = int(debounce * 1e9)
+        self.events = queue.Queue()
+        self.cond = threading.Condition()
+        self.state = {}
+        self.changed_ns = {}
+        self.pending = {}  # pin -> Timer re-checking a pin whose edge arrived inside the debounce window
+        self.listeners = []
+        for pin in self.pins:
+            self.state[pin] = self.gpio.input(pin) == self.active[pin]
+            self.changed_ns[pin] = 0
+            self.gpio.remove_event_detect(pin)  # left over if a previous session was interrupted
+            self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self._edge)
+
+    def close(self):  # stop edge detection so the pins can be monitored again by the next protocol
+        for pin in self.pins:
+            self.gpio.remove_event_detect(pin)
+        with self.cond:
+            for timer in self.pending.values():
+                timer.cancel()
+            self.pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Edge callback, runs in the GPIO event thread
+    def _edge(self, pin):
+        t_ns = self.clock.monotonic_ns()
+        crossed = self.gpio.input(pin) == self.active[pin]
+        with self.cond:
+            if crossed == self.state[pin]:
+                return
+            wait_ns = self.changed_ns[pin] + self.debounce_ns - t_ns
+            if wait_ns > 0:
+                # Contact bounce: look at the pin again once the debounce window has passed
+                if pin not in self.pending:
+                    self.pending[pin] = self.clock.call_later(wait_ns / 1e9, self._recheck, pin)
+                return
+            self._accept(pin, crossed, t_ns)
+
+    # Run listener(event) for every accepted PokeEvent, in the GPIO event thread (e.g. a StateRecorder)
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _recheck(self, pin):
+        with self.cond:
+            self.pending.pop(pin, None)
+        self._edge(pin)
+
+    def _accept(self, pin, crossed, t_ns):  # caller holds self.cond
+        self.state[pin] = crossed
+        self.changed_ns[pin] = t_ns
+        event = PokeEvent(pin, crossed, t_ns)
+        self.events.put(event)
+        for listener in self.listeners:
+            listener(event)
+        self.cond.notify_all()
+
+    def _pin(self, pin):
+        return self.pins[0] if pin is None else pin
+
+    def is_crossed(self, pin=None):
+        return self.state[self._pin(pin)]
+
+    # Block until [pin] is in state [crossed]. Returns the monotonic_ns time the state was entered, or None
+    # if [timeout] seconds pass first.
+    def wait_for(self, pin=None, crossed=True, timeout=None):
+        pin = self._pin(pin)
+        deadline = None if timeout is None else self.clock.monotonic() + timeout
+        with self.cond:
+            while self.state[pin] != crossed:
+                remaining = None if deadline is None else deadline - self.clock.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.clock.wait(self.cond, remaining)
+            return self.changed_ns[pin]
+
+    # Block until [pin] has stayed in state [crossed] for [duration] seconds without interruption, counting
+    # from the call. Returns True, or False if [timeout] seconds pass first.
+    def wait_for_hold(self, duration, pin=None, crossed=True, timeout=None):
+        pin = self._pin(pin)
+        start_ns = self.clock.monotonic_ns()
+        deadline = None if timeout is None else start_ns / 1e9 + timeout
+        with self.cond:
+            while True:
+                now = self.clock.monotonic()
+                if self.state[pin] == crossed:
+                    held = now - max(self.changed_ns[pin], start_ns) / 1e9
+                    if held >= duration:
+                        return True
+                    remaining = duration - held
+                else:
+                    remaining = None
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    remaining = deadline - now if remaining is None else min(remaining, deadline - now)
+                self.clock.wait(self.cond, remaining)
+
+    # Block until the animal has stayed out of [pin] for [wait] seconds; a poke restarts the count. This is
+    # the event-driven version of NosePoke.keep_out and of the ITI loops in basic_np.
+    def wait_for_clear(self, wait, pin=None, timeout=None):
+        if wait <= 0:
+            return True
+        return self.wait_for_hold(wait, pin, crossed=False, timeout=timeout)
+
+    # Next debounced event from the queue, or None after [timeout] seconds
+    def get_event(self, timeout=None):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self):  # all queued events, oldest first
+        out = []
+        while True:
+            try:
+                out.append(self.events.get_nowait())
+            except queue.Empty:
+                return out
+
+
+# Latency / CPU check on the simulated backend: an "animal" thread pokes at random times while the main
+# thread waits on the monitor, the way basic_np does.
+if __name__ == '__main__':
+    import random
+    import time
+    from rig_gpio import SimGPIO
+
+    gpio = SimGPIO()
+    gpio.setmode(gpio.BOARD)
+    beam = 13
+    gpio.setup(beam, gpio.IN)
+    monitor = PokeMonitor(gpio, beam, active=0)
+    n_pokes = 50
+    sent = []
+
+    def animal():
+        for i in range(n_pokes):
+            time.sleep(random.uniform(0.02, 0.06))
+            sent.append(time.monotonic_ns())
+            gpio.set_input(beam, 0)
+            time.sleep(0.01)
+            gpio.set_input(beam, 1)
+
+    thread = threading.Thread(target=animal)
+    cpu0 = time.process_time()
+    wall0 = time.monotonic()
+    thread.start()
+    latencies = []
+    for i in range(n_pokes):
+        monitor.wait_for(crossed=True)
+        latencies.append((time.monotonic_ns() - sent[i]) / 1000)
+        monitor.wait_for(crossed=False)
+    thread.join()
+    cpu = time.process_time() - cpu0
+    wall = time.monotonic() - wall0
+    monitor.close()
+    latencies.sort()
+    print('pokes: ' + str(n_pokes) + '   events queued: ' + str(len(monitor.drain())))
+    print('wake latency (us): median ' + str(round(latencies[len(latencies) // 2], 1)) +
+          '   max ' + str(round(latencies[-1], 1)))
+    print('CPU use while waiting: ' + str(round(100 * cpu / wall, 1)) + '%')
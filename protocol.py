@@ -0,0 +1,351 @@
+'''
+protocol contains the state-machine engine that runs the behavioural tasks
+
+A task is declared instead of hand-coded (see protocols.json): parameters, input beams, output pin groups, and
+states with the actions run on entering them and the transitions out of them. ProtocolEngine.run() is one event
+loop for every task: it sleeps on a condition until the next timer deadline or beam edge, so nothing spins, and
+timers count from the planned time of the transition that started the state, so overhead never accumulates.
+
+Spec keys:
+    params   defaults, overridden by the caller (pins, opentimes, trials, ...). start_delay = seconds to wait
+             before the session starts
+    inputs   name -> {"pin": expr, "active": level read while the beam is crossed}
+    outputs  name -> expr giving a pin, a list of pins, or a list of pin groups (picked with "index")
+    setup    actions run once before the first state
+    start    first state
+    states   name -> {"enter": [actions], "on": [transitions]}
+    end      {"after": expr} = session length in seconds, {"when": expr} = checked after each state is entered
+    finally  actions run when the session ends, however it ends
+
+Actions:     {"set": output, "level": expr}   {"pulse": output, "width": expr, "label": text}
+             {"timeline": {output: [[offset expr, level expr], ...], ...}}  {"assign": name, "value": expr}
+             {"print": text}  {"stamp": name}  {"call": expr}
+             "timeline" runs overlapping outputs together (timelines.TimelineRuntime), offsets counted from the
+             state's entry, and blocks until the last step; its onset skew reports are kept in engine.timelines
+             "index": expr picks one group of an output; "label" / "print" texts are str.format()ed with the values
+Transitions: {"after": expr}  {"poke": input}  {"clear": input, "for": expr}  {"hold": input, "for": expr}
+             each with "to": state (or "end") and an optional "if": expr, checked in the order they are listed
+
+Expressions are Python expressions over the params, assigned values, the current "state" and "t" (seconds since
+the start), and the helpers below (random, randint, uniform, choice, shuffled, floor, ..., and
+trial_schedule.make_schedule to draw a whole session's seeded schedule in "setup"); they are evaluated when a state
+is entered, so a random ITI is drawn once per trial.
+'''
+
+import builtins
+import collections
+import datetime
+import json
+import math
+import os
+import random
+import threading
+
+from rig_gpio import GPIO as rig_GPIO, clock as rig_clock
+from pokes import PokeMonitor
+from pulse import PulseEngine
+from event_stream import StateRecorder
+from scheduler import ScheduleReport, TimelineEvent
+from timelines import Channel, TimelineRuntime
+from trial_schedule import make_schedule
+import intan_sync
+import telemetry
+
+PROTOCOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'protocols.json')
+
+_BUILTINS = {name: getattr(builtins, name) for name in ('abs', 'all', 'any', 'bool', 'dict', 'enumerate', 'float',
+                                                         'int', 'len', 'list', 'max', 'min', 'range', 'round',
+                                                         'sorted', 'str', 'sum', 'tuple', 'zip')}
+
+
+# Expression helpers drawing from [rng] (a random.Random, or the random module)
+def helpers(rng=random):
+    def shuffled(items):
+        items = list(items)
+        rng.shuffle(items)
+        return items
+    return {'random': rng.random, 'randint': rng.randint, 'uniform': rng.uniform, 'choice': rng.choice,
+            'shuffled': shuffled, 'floor': math.floor, 'ceil': math.ceil, 'make_schedule': make_schedule}
+
+
+HELPERS = helpers()
+
+
+def load_protocol(name, filename=None):
+    with open(filename or PROTOCOLS) as f:
+        protocols = json.load(f)
+    if name not in protocols:
+        raise KeyError('no protocol named ' + name + ' in ' + (filename or PROTOCOLS))
+    return dict(protocols[name], name=name)
+
+
+class ProtocolEngine:
+    # spec = a protocol dict (see load_protocol). params override the spec's params. monitors = input name ->
+    # PokeMonitor already watching that beam (e.g. CuedTaste's NosePokes); other inputs get a PokeMonitor of
+    # their own. functions = extra names for expressions and "call" actions. pulses = PulseEngine to use.
+    # seed = seed of the random helpers (drawn and kept in [seed] if not given). record = event stream file
+    # (see event_stream) to record the inputs and outputs to, with the params and seed, so the session can be
+    # replayed (see replay). telemetry = SessionMetrics to feed (default: one registered with the running
+    # telemetry server, if any; see telemetry). Each entry of the start state counts as a trial. sync = file for the
+    # Intan sync pulse times, sent while the session runs when a sync pin is set (see intan_sync; default: next to
+    # [record], or <protocol>_<date>_sync.csv).
+    def __init__(self, spec, params=None, gpio=None, clock=None, pulses=None, monitors=None, functions=None,
+                 seed=None, record=None, telemetry=None, sync=None):
+        self.spec = spec
+        self.gpio = rig_GPIO if gpio is None else gpio
+        if clock is None:
+            clock = rig_clock if gpio is None else getattr(gpio, 'clock', None) or rig_clock
+        self.clock = clock
+        self.pulses = pulses or PulseEngine(gpio, clock)
+        self.timelines = TimelineRuntime(self.gpio, clock)
+        unknown = set(params or {}) - set(spec.get('params', {}))
+        if unknown:
+            raise ValueError('unknown protocol parameters: ' + ', '.join(sorted(unknown)))
+        for state in spec['states'].values():
+            for transition in state.get('on', []):
+                if transition['to'] != 'end' and transition['to'] not in spec['states']:
+                    raise ValueError('transition to unknown state ' + transition['to'])
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.values = {'__builtins__': _BUILTINS}
+        self.values.update(helpers(random.Random(self.seed)))
+        self.values.update(functions or {})
+        self.values.update(spec.get('params', {}))
+        self.values.update(params or {})
+        self.params = {name: self.values[name] for name in spec.get('params', {})}
+        self.record = record
+        self.recorder = None
+        self.telemetry = telemetry
+        self.sync = sync
+        self.pulser = None
+        self.monitors = dict(monitors or {})
+        self.own_monitors = []
+        self.listeners = []
+        self.stamps = collections.defaultdict(list)  # name -> clock.ctime() of every "stamp" action
+        self.cond = threading.Condition()
+        self.report = None
+
+    # Run listener(state, t_ns, values) each time a state is entered, after its actions
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _eval(self, expr):
+        if isinstance(expr, str):
+            return eval(expr, self.values)
+        return expr
+
+    def _notify(self, event):  # PokeMonitor listener, wakes the event loop
+        if self.telemetry is not None:
+            self.telemetry.on_poke(event)
+        if self.recorder is not None:
+            for name, (monitor, pin) in self.inputs.items():
+                if pin == event.pin:
+                    self.recorder.set(name, event.crossed, event.t_ns)
+        with self.cond:
+            self.cond.notify_all()
+
+    def _record(self, channels, level, pulsed=False):  # pulses reach telemetry through _pulsed
+        if self.recorder is not None:
+            self.recorder.update({channel: level for channel in channels})
+        if self.telemetry is not None and not pulsed:
+            for channel in channels:
+                self.telemetry.output(channel, level)
+
+    def _setup(self):
+        self.outputs = {name: self._eval(pins) for name, pins in self.spec.get('outputs', {}).items()}
+        self.channels = {}  # output name -> recorded channel names, one per group of a grouped output
+        self.pulse_names = {}  # pins as PulseEngine listeners get them -> channel name, for telemetry
+        for name, pins in self.outputs.items():
+            for pin in _flatten(pins):
+                self.gpio.setup(pin, self.gpio.OUT)
+            grouped = isinstance(pins, (list, tuple)) and pins and all(isinstance(p, (list, tuple)) for p in pins)
+            self.channels[name] = [name + str(i) for i in range(len(pins))] if grouped else [name]
+            for channel, group in zip(self.channels[name], pins if grouped else [pins]):
+                self.pulse_names[tuple(_flatten(group))] = channel
+        self.inputs = {}
+        for name, spec in self.spec.get('inputs', {}).items():
+            pin = self._eval(spec['pin'])
+            if name not in self.monitors:
+                self.gpio.setup(pin, self.gpio.IN)
+                self.monitors[name] = PokeMonitor(self.gpio, pin, active=spec.get('active', 0), clock=self.clock)
+                self.own_monitors.append(self.monitors[name])
+            self.inputs[name] = (self.monitors[name], self.monitors[name].pins[0])
+        for monitor in set(self.monitors.values()):
+            monitor.add_listener(self._notify)
+        if self.telemetry is None:
+            self.telemetry = telemetry.session(self.spec.get('name', 'protocol'), clock=self.clock)
+        if self.telemetry is not None:
+            self.pulses.add_listener(self._pulsed)
+
+    def _pulsed(self, pins, level, t_ns):  # PulseEngine listener: every valve opening counts as a reward
+        self.telemetry.output(self.pulse_names.get(tuple(_flatten(pins)), str(pins)), level, t_ns)
+        if level:
+            self.telemetry.reward(t_ns)
+
+    def _teardown(self):
+        for monitor in set(self.monitors.values()):
+            if self._notify in monitor.listeners:
+                monitor.listeners.remove(self._notify)
+        if self._pulsed in self.pulses.listeners:
+            self.pulses.listeners.remove(self._pulsed)
+        for monitor in self.own_monitors:
+            monitor.close()
+        if self.telemetry is not None and telemetry.server is not None:
+            telemetry.server.remove(self.telemetry)  # off the dashboard
+
+    # (pins, recorded channel names) of the output an action writes
+    def _pins(self, action, key):
+        pins = self.outputs[action[key]]
+        channels = self.channels[action[key]]
+        if 'index' in action:
+            index = self._eval(action['index'])
+            pins = pins[index]
+            channels = channels[index:index + 1] if len(channels) > 1 else channels
+        return pins, channels
+
+    def _act(self, actions):
+        for action in actions:
+            if 'set' in action:
+                pins, channels = self._pins(action, 'set')
+                level = self._eval(action['level'])
+                self.gpio.output(pins, level)
+                self._record(channels, level)
+            elif 'pulse' in action:
+                pins, channels = self._pins(action, 'pulse')
+                self._record(channels, 1, pulsed=True)
+                self.pulses.pulse(pins, self._eval(action['width']),
+                                  label=action.get('label', '').format_map(self.values))
+                self._record(channels, 0, pulsed=True)
+            elif 'timeline' in action:
+                self.timelines.run([Channel(name, self.outputs[name],
+                                            [(self._eval(t), self._eval(level)) for t, level in steps])
+                                    for name, steps in action['timeline'].items()], self.entry_ns,
+                                   lambda channel, level, t_ns: self._record(self.channels[channel.name], level))
+            elif 'assign' in action:
+                self.values[action['assign']] = self._eval(action['value'])
+            elif 'print' in action:
+                print(action['print'].format_map(self.values))
+            elif 'stamp' in action:
+                self.stamps[action['stamp']].append(self.clock.ctime())
+            elif 'call' in action:
+                self._eval(action['call'])
+            else:
+                raise ValueError('unknown protocol action: ' + str(action))
+
+    # Enter [state] at monotonic_ns time [t_ns]. Returns False if the session is over.
+    def _enter(self, state, t_ns):
+        self.state = state
+        self.entry_ns = t_ns
+        self.values['state'] = state
+        self.values['t'] = (t_ns - self.start_ns) / 1e9
+        if self.telemetry is not None:
+            if state == self.spec['start']:
+                self.telemetry.trial()
+            self.telemetry.state = state
+        spec = self.spec['states'][state]
+        self._act(spec.get('enter', []))
+        for listener in self.listeners:
+            listener(state, t_ns, self.values)
+        if 'when' in self.spec.get('end', {}) and self._eval(self.spec['end']['when']):
+            return False
+        self.armed = []
+        for transition in spec.get('on', []):
+            if 'if' in transition and not self._eval(transition['if']):
+                continue
+            duration = transition.get('after', transition.get('for', 0))
+            self.armed.append((transition, round(self._eval(duration) * 1e9)))
+        return True
+
+    # First armed transition that can fire at [now]: (transition, due time, timed), or (None, next deadline, False)
+    def _due(self, now):
+        deadline = None
+        for transition, duration in self.armed:
+            if 'after' in transition:
+                due = self.entry_ns + duration
+            elif 'poke' in transition:
+                monitor, pin = self.inputs[transition['poke']]
+                if monitor.is_crossed(pin):
+                    return transition, max(monitor.changed_ns[pin], self.entry_ns), False
+                continue
+            else:
+                crossed = 'hold' in transition
+                if not crossed and duration <= 0:
+                    return transition, self.entry_ns, False
+                monitor, pin = self.inputs[transition['hold' if crossed else 'clear']]
+                if monitor.is_crossed(pin) != crossed:
+                    continue
+                due = max(monitor.changed_ns[pin], self.entry_ns) + duration
+            if now >= due:
+                return transition, due, True
+            deadline = due if deadline is None else min(deadline, due)
+        return None, deadline, False
+
+    # Sleep until a transition fires: (transition, due time, timed, now), or None when the session time is up
+    def _wait(self):
+        with self.cond:
+            while True:
+                now = self.clock.monotonic_ns()
+                if self.end_ns is not None and now >= self.end_ns:
+                    return None
+                transition, due, timed = self._due(now)
+                if transition is not None:
+                    return transition, due, timed, now
+                wake = [t for t in (due, self.end_ns) if t is not None]
+                self.clock.wait(self.cond, (min(wake) - now) / 1e9 if wake else None)
+
+    def _sync_filename(self):
+        if self.record:
+            return os.path.splitext(self.record)[0] + '_sync.csv'
+        return self.spec.get('name', 'protocol') + datetime.datetime.now().strftime('_%m%d%y_%Hh%Mm') + '_sync.csv'
+
+    def run(self):
+        self._setup()
+        events = []
+        late_ns = []
+        end_error_ns = 0
+        try:
+            self._act(self.spec.get('setup', []))
+            start_delay = self._eval(self.values.get('start_delay', 0))
+            if start_delay:
+                self.clock.sleep(start_delay)
+            self.pulser = intan_sync.session(self.sync or self._sync_filename(), gpio=self.gpio, clock=self.clock)
+            self.start_ns = self.clock.monotonic_ns()
+            if self.record:
+                self.recorder = StateRecorder(self.record, list(self.inputs) + [channel for channels in
+                                                                              self.channels.values()
+                                                                              for channel in channels],
+                                              meta={'protocol': self.spec.get('name'), 'params': self.params,
+                                                    'seed': self.seed}, zero_ns=self.start_ns, clock=self.clock)
+                self.recorder.update({name: monitor.is_crossed(pin) for name, (monitor, pin) in self.inputs.items()})
+            end = self.spec.get('end', {})
+            self.end_ns = None if 'after' not in end else self.start_ns + round(self._eval(end['after']) * 1e9)
+            # planned_ns = due time of the last transition (the planned end of the session once the loop exits)
+            state, t_ns = self.spec['start'], self.start_ns
+            planned_ns = t_ns
+            while state != 'end' and self._enter(state, t_ns):
+                fired = self._wait()
+                if fired is None:
+                    planned_ns = self.end_ns
+                    break
+                transition, t_ns, timed, now = fired
+                if timed:
+                    events.append(TimelineEvent((t_ns - self.start_ns) / 1e9, state + ' -> ' + transition['to']))
+                    late_ns.append(now - t_ns)
+                state = transition['to']
+                planned_ns = t_ns
+            end_error_ns = self.clock.monotonic_ns() - planned_ns
+        finally:
+            self._act(self.spec.get('finally', []))
+            self._teardown()
+            if self.pulser is not None:
+                self.pulser.stop()
+            self.timelines.close()
+            if self.recorder is not None:
+                self.recorder.close()
+        self.report = ScheduleReport(events, late_ns, end_error_ns)
+        return self
+
+
+def _flatten(pins):
+    if isinstance(pins, (list, tuple)):
+        return [pin for item in pins for pin in _flatten(item)]
+    return [pins]
@@ -0,0 +1,143 @@
+'''
+pulse contains the solenoid pulse engine used for taste deliveries
+
+Valve opentimes are 10-12 ms, and time.sleep() on a loaded Pi can overshoot by several ms. PulseEngine sleeps
+for the coarse part of a pulse and busy-waits on perf_counter_ns for the last [spin] seconds, then closes the
+valve. Every pulse is kept as a PulseRecord with the requested and the measured width, so dosing error can be
+checked per delivery.
+
+With realtime=True pulses run on a dedicated thread that asks for SCHED_FIFO priority and can be pinned to one
+CPU (needs root or CAP_SYS_NICE; without it the engine carries on at normal priority and says so).
+See benchmarks/pulse_bench.py for the error distribution under CPU load.
+'''
+
+import collections
+import csv
+import os
+import queue
+import threading
+
+from rig_gpio import GPIO as rig_GPIO, clock as rig_clock, PinGroup
+from tracing import tracer
+
+# requested_s / measured_s = pulse width asked for / time between the open and close writes returning.
+# t_ns = clock.monotonic_ns() when the pins were opened. skew_ns = the longer of the open and close writes, which
+# bounds how far apart the pins' edges (valve and Intan marker) can be.
+PulseRecord = collections.namedtuple('PulseRecord', ['label', 'pins', 't_ns', 'requested_s', 'measured_s',
+                                                     'skew_ns'])
+
+
+class PulseEngine:
+    # spin = seconds at the end of each pulse spent busy-waiting instead of sleeping. realtime / cpu / priority
+    # set up the SCHED_FIFO pulse thread. history = how many PulseRecords to keep.
+    def __init__(self, gpio=None, clock=None, spin=0.002, realtime=False, cpu=None, priority=50, history=10000):
+        self.gpio = rig_GPIO if gpio is None else gpio
+        if clock is None:
+            clock = rig_clock if gpio is None else getattr(gpio, 'clock', None) or rig_clock
+        self.clock = clock
+        self.spin_ns = int(spin * 1e9)
+        self.records = collections.deque(maxlen=history)
+        self.groups = {}  # pins -> the PinGroup that writes them
+        self.listeners = []
+        self.requests = None
+        if realtime and not self.clock.virtual:
+            self.requests = queue.Queue()
+            self.ready = threading.Event()
+            self.worker = threading.Thread(target=self._serve, args=(cpu, priority), daemon=True)
+            self.worker.start()
+            self.ready.wait()
+
+    # Busy-wait the last spin_ns before [deadline_ns] (perf_counter_ns time), sleep before that
+    def wait_until(self, deadline_ns):
+        if self.clock.virtual:
+            self.clock.sleep(max(deadline_ns - self.clock.perf_counter_ns(), 0) / 1e9)
+            return
+        remaining = deadline_ns - self.clock.perf_counter_ns() - self.spin_ns
+        if remaining > 0:
+            self.clock.sleep(remaining / 1e9)
+        while self.clock.perf_counter_ns() < deadline_ns:
+            pass
+
+    # Run listener(pins, level, t_ns) after every open (level 1) and close (level 0), t_ns = clock.monotonic_ns()
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Set [pins] (one pin or a list) high for [width] seconds. Returns the PulseRecord.
+    def pulse(self, pins, width, label=''):
+        if self.requests is None:
+            return self._pulse(pins, width, label)
+        request = [pins, width, label, threading.Event(), None]
+        self.requests.put(request)
+        request[3].wait()
+        if isinstance(request[4], BaseException):
+            raise request[4]
+        return request[4]
+
+    def _group(self, pins):
+        key = tuple(pins) if isinstance(pins, list) else pins
+        if key not in self.groups:
+            self.groups[key] = PinGroup(pins, self.gpio, self.clock)
+        return self.groups[key]
+
+    def _pulse(self, pins, width, label):
+        group = self._group(pins)
+        t_ns = self.clock.monotonic_ns()
+        with tracer.span('gpio.write', 'gpio', pins=pins, level=1):
+            group.output(1)
+        on_ns = self.clock.perf_counter_ns()
+        for listener in self.listeners:
+            listener(pins, 1, t_ns)
+        with tracer.span('pulse.wait', 'sleep', width=width):
+            self.wait_until(on_ns + int(width * 1e9))
+        with tracer.span('gpio.write', 'gpio', pins=pins, level=0):
+            group.output(0)
+        off_ns = self.clock.perf_counter_ns()
+        for listener in self.listeners:
+            listener(pins, 0, self.clock.monotonic_ns())
+        record = PulseRecord(label, pins, t_ns, width, (off_ns - on_ns) / 1e9, max(group.spans_ns[-1],
+                                                                                  group.spans_ns[-2]))
+        self.records.append(record)
+        return record
+
+    def _serve(self, cpu, priority):
+        try:
+            if cpu is not None:
+                os.sched_setaffinity(0, {cpu})
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            print('pulse thread running at normal priority (' + str(e) + ')')
+        self.ready.set()
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            try:
+                request[4] = self._pulse(*request[:3])
+            except Exception as e:
+                request[4] = e
+            request[3].set()
+
+    def close(self):
+        if self.requests is not None:
+            self.requests.put(None)
+            self.worker.join()
+            self.requests = None
+
+    # Width error statistics (ms) over the kept records
+    def summary(self):
+        errors = sorted((r.measured_s - r.requested_s) * 1000 for r in self.records)
+        if not errors:
+            return {'pulses': 0}
+        return {'pulses': len(errors),
+                'median_error_ms': round(errors[len(errors) // 2], 4),
+                'p99_error_ms': round(errors[min(len(errors) - 1, int(0.99 * len(errors)))], 4),
+                'max_error_ms': round(errors[-1], 4),
+                'max_skew_us': round(max(r.skew_ns for r in self.records) / 1e3, 3)}
+
+    def save(self, filename):
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['label', 'pins', 't_ns', 'requested_ms', 'measured_ms', 'skew_us'])
+            for r in self.records:
+                writer.writerow([r.label, r.pins, r.t_ns, round(r.requested_s * 1000, 4), round(r.measured_s * 1000, 4),
+                                 round(r.skew_ns / 1e3, 3)])
@@ -0,0 +1,291 @@
+'''
+replay re-runs recorded sessions on the simulated backend and compares the task's outputs with the recorded ones
+
+A recording holds what the animal did (beam edges) and what the rig did (valves, lights, cues). replay selects
+rig_gpio's 'sim' backend, drives the beam pins with the recorded edges at their recorded times, runs the current
+task code on the VirtualClock, recording it the same way, and pairs the i-th onset (and offset) of every output
+channel in the new recording with the i-th onset (offset) in the old one. An hour-long session replays in well under
+a second, so a protocol change can be checked against every session on disk:
+
+    python replay.py sessions/*.rigevt sessions/*_log.csv --tolerance 1
+
+Sources:
+    protocol engine recordings (pi_rig/jet_rig basic_np, odor_np with record=...): the params and the seed of the
+        random helpers are in the file, so the session is rebuilt exactly
+    CuedTaste recordings (record()): the line order comes from the <file>_schedule.npz saved next to them
+    pipi2 event logs (.csv, last session in the file): each poke is replayed at its recorded latency after
+        "Waiting for IR beam", and every solenoid event is compared relative to its trial's poke
+'''
+
+import argparse
+import collections
+import contextlib
+import csv
+import glob
+import io
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+import rig_gpio
+from event_log import parse_timestamps
+from event_stream import StreamReader, EXTENSION
+
+# An output or input change. t = seconds (since the session start, or since the trial's poke for pipi2 logs).
+Edge = collections.namedtuple('Edge', ['t', 'channel', 'level'])
+
+
+# (state of every channel at the first record, [Edge of every later change] in time order)
+def stream_edges(reader):
+    times = reader.times()
+    states = reader.states()
+    edges = []
+    for i, name in enumerate(reader.channels):
+        changed = np.flatnonzero(states[1:, i] != states[:-1, i]) + 1
+        edges.extend(Edge(float(times[j]), name, int(states[j, i])) for j in changed)
+    edges.sort()
+    initial = {name: bool(states[0, i]) if len(states) else False for i, name in enumerate(reader.channels)}
+    return initial, edges
+
+
+class ReplayReport:
+    # recorded / produced = Edges, in order. channels = the output channels to compare (default: all).
+    # tolerance = seconds a produced onset or offset may differ from its recorded one.
+    def __init__(self, source, recorded, produced, channels=None, tolerance=0.001, simulated_s=0.0, wall_s=0.0):
+        self.source = source
+        self.tolerance = tolerance
+        self.simulated_s = simulated_s
+        self.wall_s = wall_s
+        if channels is None:
+            channels = sorted({edge.channel for edge in recorded} | {edge.channel for edge in produced})
+        self.channels = {}
+        for channel in channels:
+            # Onsets and offsets are paired separately, so a change in how long an output stays on (a valve's
+            # opentime: the reward volume) is a mismatch too
+            mismatched = 0
+            dts = []
+            for level in (1, 0):
+                old = [edge.t for edge in recorded if edge.channel == channel and edge.level == level]
+                new = [edge.t for edge in produced if edge.channel == channel and edge.level == level]
+                n = min(len(old), len(new))
+                dt = np.abs(np.subtract(new[:n], old[:n]))
+                mismatched += int(np.sum(dt > tolerance)) + abs(len(old) - len(new))
+                dts.append(dt)
+                if level:
+                    counts = {'recorded': len(old), 'produced': len(new)}
+            dt = np.concatenate(dts)
+            self.channels[channel] = dict(counts, mismatched=mismatched,
+                                          max_dt_ms=round(float(np.max(dt)) * 1000, 3) if len(dt) else None)
+
+    @property
+    def ok(self):
+        return all(stats['mismatched'] == 0 for stats in self.channels.values())
+
+    def summary(self):
+        return {'source': self.source, 'ok': self.ok, 'simulated_s': round(self.simulated_s, 1),
+                'wall_s': round(self.wall_s, 3),
+                'speedup': round(self.simulated_s / self.wall_s, 1) if self.wall_s > 0 else None,
+                'channels': self.channels}
+
+    def __str__(self):
+        lines = [self.source + ': ' + ('OK' if self.ok else 'MISMATCH') + '   ' + str(round(self.simulated_s, 1)) +
+                 ' s replayed in ' + str(round(self.wall_s, 3)) + ' s']
+        for channel, stats in self.channels.items():
+            lines.append('    ' + channel + ': ' + str(stats['recorded']) + ' recorded, ' + str(stats['produced']) +
+                         ' produced, ' + str(stats['mismatched']) + ' mismatched, max dt ' +
+                         str(stats['max_dt_ms']) + ' ms')
+        return '\n'.join(lines)
+
+
+def _start():
+    gpio = rig_gpio.use_backend('sim')
+    rig_gpio.setup_board()
+    return gpio
+
+
+# Set the beams to their recorded starting state and schedule every recorded edge [offset] seconds later than its
+# recorded time. pins = channel -> (pin, level read while crossed).
+def _drive(gpio, initial, edges, pins, offset=0.0):
+    for channel, (pin, active) in pins.items():
+        gpio.set_input(pin, active if initial.get(channel) else 1 - active)
+    for edge in edges:
+        if edge.channel in pins:
+            pin, active = pins[edge.channel]
+            gpio.schedule_input(pin, active if edge.level else 1 - active, offset + edge.t)
+
+
+@contextlib.contextmanager
+def _session(quiet=True):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+                yield directory
+        finally:
+            os.chdir(cwd)
+
+
+# Replay a protocol engine recording with the protocol's current spec (from [spec_file], default protocols.json)
+def replay_protocol(filename, tolerance=0.001, spec_file=None, quiet=True):
+    from protocol import ProtocolEngine, load_protocol
+    reader = StreamReader(filename)
+    header = reader.header
+    spec = load_protocol(header['protocol'], spec_file)
+    params = header['params']
+    pins = {name: (eval(i['pin'], {'__builtins__': {}}, params) if isinstance(i['pin'], str) else i['pin'],
+                   i.get('active', 0))
+            for name, i in spec.get('inputs', {}).items()}
+    initial, recorded = stream_edges(reader)
+    gpio = _start()
+    wall0 = time.perf_counter()
+    with _session(quiet) as directory:
+        engine = ProtocolEngine(spec, params, seed=header['seed'],
+                                record=os.path.join(directory, 'replay' + EXTENSION))
+        _drive(gpio, initial, recorded, pins, params.get('start_delay', 0))
+        engine.run()
+        produced = stream_edges(StreamReader(engine.record))[1]
+    outputs = [channel for channel in reader.channels if channel not in pins]
+    return ReplayReport(filename, recorded, produced, outputs, tolerance,
+                        recorded[-1].t if recorded else 0.0, time.perf_counter() - wall0)
+
+
+# Replay a CuedTaste recording, with the line order of its saved schedule
+def replay_cuedtaste(filename, tolerance=0.001, quiet=True):
+    import rig_sim
+    from trial_schedule import load_schedule
+    reader = StreamReader(filename)
+    initial, recorded = stream_edges(reader)
+    schedule = os.path.splitext(filename)[0] + '_schedule.npz'
+    seed = load_schedule(schedule).params['seed'] if os.path.exists(schedule) else None
+    if seed is None:
+        print(filename + ': no saved schedule, so the cued lines will not match')
+    cuedtaste = rig_sim.load_cuedtaste()
+    gpio = _start()
+    wall0 = time.perf_counter()
+    with _session(quiet) as directory:
+        # Beams in their recorded state before setup_rig() starts watching them, as rig_sim's Animal does
+        pins = {'Poke1': (38, 1), 'Poke2': (15, 1)}  # record(rew, trig, ...): rew = NosePoke(40, 38), trig beam 15
+        _drive(gpio, initial, recorded, pins)
+        # The recorded lines (opentimes as delivered: the replay has no calibration store, so the volumes don't
+        # change them), or rig_sim's for recordings made before record() saved them
+        header = reader.header
+        cuedtaste.setup_rig(header.get('opentimes', [0.012] * 4),
+                            header.get('tastes', ['water', 'sucrose', 'nacl', 'quinine']),
+                            rig_gpio.SimSerial(gpio.clock), header.get('volumes'))
+        cuedtaste.cuedtaste(anID='replay', runtime=round(float(reader.times()[-1]), 1) / 60, seed=seed)
+        produced = stream_edges(StreamReader(glob.glob(os.path.join(directory, 'replay_*' + EXTENSION))[0]))[1]
+    outputs = [channel for channel in reader.channels if channel not in pins]
+    return ReplayReport(filename, recorded, produced, outputs, tolerance,
+                        float(reader.times()[-1]), time.perf_counter() - wall0)
+
+
+# [(time, event)] of every session in a pipi2 EventLog CSV, split at its "Animal ID" events
+def read_event_log(filename):
+    with open(filename, newline='') as f:
+        rows = [row for row in csv.reader(f) if len(row) >= 2]
+    sessions = []
+    for t, row in zip(parse_timestamps([row[0] for row in rows]).tolist(), rows):
+        if row[1].startswith('Animal ID') or not sessions:
+            sessions.append([])
+        sessions[-1].append((t, row[1]))
+    return sessions
+
+
+# Poke latency after "Waiting for IR beam" and the solenoid Edges (relative to the poke) of every trial
+def _pipi2_trials(events):
+    latencies = []
+    edges = []
+    waiting = poke = None
+    for t, event in events:
+        if event.startswith('Waiting for IR beam'):
+            waiting, poke = t, None
+        elif poke is None and waiting is not None and event.startswith('Odor ') and event.endswith('turned On'):
+            poke = t  # logged as soon as the beam is crossed
+            latencies.append(poke - waiting)
+        if poke is not None and 'solenoid turned' in event.lower():
+            edges.append(Edge(t - poke, event.split()[0].capitalize(), int(event.endswith('On'))))
+    return latencies, edges
+
+
+# The Edges that change their channel's level (all channels start off): pipi2 logs some solenoid writes that leave it
+# as it was, and which trials get one depends on the odor drawn
+def _changes(edges):
+    levels = collections.defaultdict(int)
+    changes = []
+    for edge in edges:
+        if edge.level != levels[edge.channel]:
+            levels[edge.channel] = edge.level
+            changes.append(edge)
+    return changes
+
+
+# Replay the last session of a pipi2 event log (or [session], an index into read_event_log())
+def replay_pipi2(filename, session=-1, tolerance=0.002, quiet=True):
+    import pipi2
+    import rig_sim
+    events = read_event_log(filename)[session]
+    latencies, recorded = _pipi2_trials(events)
+    odors = sorted({int(event.split()[1]) for t, event in events if event.startswith('Odor ')
+                    and event.endswith('turned On') and event.split()[1].isdigit()})
+
+    def open_time(name):  # median logged on -> off time of a solenoid
+        widths = [off.t - on.t for on, off in zip(recorded, recorded[1:])
+                  if on.channel == off.channel == name and on.level and not off.level]
+        return round(statistics.median(widths), 3) if widths else 0.05
+
+    gpio = _start()
+    pins = {'water_solenoid': pipi2.Experiment.PINS['water_solenoid'] or 26,
+            'retro_solenoid': pipi2.Experiment.PINS['retro_solenoid'] or 32}
+    beam = pipi2.Experiment.PINS['ir_beam']
+    gpio.set_input(beam, 0)
+    produced = []
+    wall0 = time.perf_counter()
+    with _session(quiet) as directory:
+        experiment = pipi2.Experiment(log_filename=os.path.join(directory, 'replay_log.csv'),
+                                      camera=rig_sim.NullCamera(), pins=pins)
+        experiment.setup_logging()
+        log_event = experiment.log_event
+        trial = {'waits': 0, 'poke': None}
+
+        def replay_event(name):  # poke the beam as the animal did, and collect the solenoid events
+            now = gpio.clock.monotonic()
+            if name.startswith('Waiting for IR beam') and trial['waits'] < len(latencies):
+                gpio.schedule_input(beam, 1, latencies[trial['waits']])
+                gpio.schedule_input(beam, 0, latencies[trial['waits']] + 0.2)
+                trial['poke'] = now + latencies[trial['waits']]
+                trial['waits'] += 1
+            if 'solenoid turned' in name.lower() and trial['poke'] is not None:
+                produced.append(Edge(now - trial['poke'], name.split()[0].capitalize(), int(name.endswith('On'))))
+            log_event(name)
+        experiment.log_event = replay_event
+        experiment.run_experiment(len(latencies), odors, [19, 21], open_time('Water_solenoid'),
+                                  open_time('Retro_solenoid'), animal_id='replay')
+    return ReplayReport(filename, _changes(recorded), _changes(produced), None, tolerance, gpio.clock.monotonic(),
+                        time.perf_counter() - wall0)
+
+
+# Replay any supported recording, picking the source from the file
+def replay(filename, tolerance=0.001, quiet=True):
+    if not filename.endswith(EXTENSION):
+        return replay_pipi2(filename, tolerance=max(tolerance, 0.002), quiet=quiet)  # log times are in ms
+    if 'protocol' in StreamReader(filename).header:
+        return replay_protocol(filename, tolerance, quiet=quiet)
+    return replay_cuedtaste(filename, tolerance, quiet=quiet)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded sessions against the current task code')
+    parser.add_argument('recordings', nargs='+', help='.rigevt recordings and/or pipi2 event log CSVs')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='allowed onset difference (ms)')
+    parser.add_argument('--verbose', action='store_true', help="show the tasks' own output")
+    args = parser.parse_args()
+    failed = 0
+    for recording in args.recordings:
+        report = replay(recording, args.tolerance / 1000, quiet=not args.verbose)
+        print(report)
+        failed += not report.ok
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,442 @@
+'''
+rig_gpio is the hardware-abstraction layer for GPIO on the Katz Lab rigs
+
+The rig codes import GPIO and clock from here instead of importing RPi.GPIO / Jetson.GPIO and time directly:
+
+    from rig_gpio import GPIO, clock, setup_board
+
+The backend is picked at runtime, the first time GPIO is used, from the RIG_GPIO_BACKEND environment variable
+('rpi', 'jetson' or 'sim'; by default whichever hardware module imports), or explicitly with use_backend('sim').
+Nothing touches the hardware on import, so every rig module can be imported off-rig. PinGroup writes several
+outputs (a valve and its Intan marker, all the taste lines) in one operation.
+
+'sim' is a deterministic in-process simulator. SimGPIO keeps pin levels, runs edge callbacks and records every
+output write, and it runs on a VirtualClock: clock.sleep() returns straight away after moving simulated time
+forward, so an hour-long session runs in seconds. Scripted animals (rig_sim.Animal) drive the input pins.
+'''
+
+import collections
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+
+
+# Clock used on real hardware: thin wrapper around the time module
+class RealClock:
+    virtual = False
+
+    def __init__(self):
+        self.time = time.time
+        self.monotonic = time.monotonic
+        self.monotonic_ns = time.monotonic_ns
+        self.perf_counter = time.perf_counter
+        self.perf_counter_ns = time.perf_counter_ns
+        self.sleep = time.sleep
+        self.ctime = time.ctime
+
+    def wait(self, cond, timeout=None):  # block on a held threading.Condition
+        return cond.wait(timeout)
+
+    def call_later(self, delay, fn, *args):  # run fn(*args) in a timer thread; returns an object with cancel()
+        timer = threading.Timer(delay, fn, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+class _Call:
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+    def cancel(self):
+        self.fn = None
+
+
+# Simulated clock. Time only moves when the program sleeps or waits, and scheduled calls (animal pokes,
+# debounce re-checks, ...) run in order, in the sleeping thread, at the simulated time they were due.
+class VirtualClock:
+    virtual = True
+
+    def __init__(self, start=None):
+        self.epoch = time.time() if start is None else start  # wall-clock time at simulated t = 0
+        self.now_ns = 0
+        self.queue = []  # heap of (due time in ns, sequence number, _Call)
+        self.seq = itertools.count()
+
+    def monotonic_ns(self):
+        return self.now_ns
+
+    def perf_counter_ns(self):
+        return self.now_ns
+
+    def monotonic(self):
+        return self.now_ns / 1e9
+
+    def perf_counter(self):
+        return self.now_ns / 1e9
+
+    def time(self):
+        return self.epoch + self.now_ns / 1e9
+
+    def ctime(self, secs=None):
+        return time.ctime(self.time() if secs is None else secs)
+
+    def sleep(self, secs):
+        self.run_until(self.now_ns + _to_ns(secs))
+
+    def call_at(self, when, fn, *args):  # [when] is in clock.monotonic() seconds
+        call = _Call(fn, args)
+        heapq.heappush(self.queue, (max(int(when * 1e9), self.now_ns), next(self.seq), call))
+        return call
+
+    def call_later(self, delay, fn, *args):
+        return self.call_at(self.monotonic() + delay, fn, *args)
+
+    def next_due(self):  # due time (ns) of the next live scheduled call, or None
+        while self.queue and self.queue[0][2].fn is None:
+            heapq.heappop(self.queue)
+        return self.queue[0][0] if self.queue else None
+
+    def run_until(self, t_ns):
+        while True:
+            due = self.next_due()
+            if due is None or due > t_ns:
+                break
+            call = heapq.heappop(self.queue)[2]
+            self.now_ns = max(self.now_ns, due)
+            fn, call.fn = call.fn, None
+            fn(*call.args)
+        self.now_ns = max(self.now_ns, t_ns)
+
+    # The caller is blocked on [cond] (see PokeMonitor): jump to the next scheduled call, or to the timeout if
+    # that comes first, so the caller can re-check its condition.
+    def wait(self, cond, timeout=None):
+        due = self.next_due()
+        end = None if timeout is None else self.now_ns + _to_ns(timeout)
+        if due is None and end is None:
+            raise RuntimeError('simulation stalled: waiting with no timeout and nothing scheduled')
+        self.run_until(end if due is None or (end is not None and end < due) else due)
+        return True
+
+
+# Stand-in for the RPi.GPIO module: same constants and the calls the rig codes use
+class SimGPIO:
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, clock=None, idle_level=1):
+        self.clock = RealClock() if clock is None else clock
+        self.idle_level = idle_level  # level of an input pin nobody is driving (IR beams idle high)
+        self.mode = None
+        self.levels = {}  # pin -> current level
+        self.directions = {}  # pin -> IN/OUT
+        self.detects = {}  # pin -> [edge, bouncetime (ms), last callback time (s), [callbacks]]
+        self.watchers = {}  # pin -> [callbacks run as callback(pin, level) when an output is written]
+        self.writes = []  # (clock.perf_counter_ns(), pin, level) for every output write
+        self.inputs = []  # (clock.perf_counter_ns(), pin, level) for every input change made by set_input()
+        self.lock = threading.RLock()
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def getmode(self):
+        return self.mode
+
+    def cleanup(self, channel=None):
+        with self.lock:
+            pins = list(self.directions) if channel is None else _as_list(channel)
+            for pin in pins:
+                # Outputs go back to undriven inputs; inputs keep whatever the animal is doing to them
+                if self.directions.pop(pin, None) == self.OUT:
+                    self.levels.pop(pin, None)
+                self.detects.pop(pin, None)
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        with self.lock:
+            for pin in _as_list(channel):
+                self.directions[pin] = direction
+                if direction == self.OUT:
+                    self.levels[pin] = 0 if initial is None else initial
+                elif pin not in self.levels:
+                    if pull_up_down == self.PUD_DOWN:
+                        self.levels[pin] = 0
+                    elif pull_up_down == self.PUD_UP:
+                        self.levels[pin] = 1
+                    else:
+                        self.levels[pin] = self.idle_level
+
+    def input(self, channel):
+        return self.levels.get(channel, self.idle_level)
+
+    def output(self, channel, value):
+        pins = _as_list(channel)
+        values = _as_list(value)
+        if len(values) == 1:
+            values = values * len(pins)
+        t_ns = self.clock.perf_counter_ns()
+        watched = []
+        with self.lock:
+            for pin, level in zip(pins, values):
+                level = int(bool(level))
+                self.levels[pin] = level
+                self.writes.append((t_ns, pin, level))
+                for callback in self.watchers.get(pin, ()):
+                    watched.append((callback, pin, level))
+        for callback, pin, level in watched:
+            callback(pin, level)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self.lock:
+            if channel in self.detects:
+                raise RuntimeError('Conflicting edge detection already enabled for this GPIO channel')
+            self.detects[channel] = [edge, bouncetime or 0, None, [callback] if callback else []]
+
+    def add_event_callback(self, channel, callback):
+        with self.lock:
+            if channel not in self.detects:
+                raise RuntimeError('Add event detection using add_event_detect first before adding a callback')
+            self.detects[channel][3].append(callback)
+
+    def remove_event_detect(self, channel):
+        with self.lock:
+            self.detects.pop(channel, None)
+
+    # Simulation hooks
+
+    # Drive an input pin as the animal would. Edge callbacks run in the calling thread, the same way RPi.GPIO
+    # runs them in its own event thread.
+    def set_input(self, pin, level):
+        level = int(bool(level))
+        with self.lock:
+            old = self.levels.get(pin, self.idle_level)
+            self.levels[pin] = level
+            if old != level:
+                self.inputs.append((self.clock.perf_counter_ns(), pin, level))
+            detect = self.detects.get(pin)
+            if detect is None or old == level:
+                return
+            edge, bouncetime, last, callbacks = detect
+            if edge == self.RISING and level == 0 or edge == self.FALLING and level == 1:
+                return
+            now = self.clock.monotonic()
+            if last is not None and bouncetime and (now - last) * 1000 < bouncetime:
+                return
+            detect[2] = now
+            callbacks = list(callbacks)
+        for callback in callbacks:
+            callback(pin)
+
+    # Drive an input pin [delay] seconds from now
+    def schedule_input(self, pin, level, delay):
+        return self.clock.call_later(delay, self.set_input, pin, level)
+
+    # Run callback(pin, level) whenever the program writes output [pin] (used by scripted animals)
+    def watch_output(self, pin, callback):
+        with self.lock:
+            self.watchers.setdefault(pin, []).append(callback)
+
+
+# Stand-in for the serial.Serial link to the cue Arduino. Written bytes are kept in [sent] with their time;
+# with echo=True each write is read back, as the Arduino echoes the cue it is playing.
+class SimSerial:
+    def __init__(self, clock=None, echo=True):
+        self.clock = RealClock() if clock is None else clock
+        self.echo = echo
+        self.sent = []
+        self.inbox = bytearray()
+
+    def write(self, data):
+        self.sent.append((self.clock.monotonic_ns(), bytes(data)))
+        if self.echo:
+            self.inbox.extend(data)
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.inbox[:size])
+        del self.inbox[:size]
+        return data
+
+    def flushInput(self):
+        self.inbox.clear()
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Module-like object that forwards attribute access to whatever the current backend is, so rig modules can do
+# "from rig_gpio import GPIO, clock" once and still follow use_backend()
+class _Proxy:
+    def __init__(self, name, resolve):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_resolve', resolve)
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __repr__(self):
+        return '<rig_gpio ' + self._name + ' -> ' + repr(self._resolve()) + '>'
+
+
+_backend = {'name': None, 'gpio': None, 'clock': RealClock(), 'board_ready': False}
+
+
+def use_backend(name=None, **kwargs):
+    # Select the GPIO backend: 'rpi', 'jetson', 'sim' or None/'auto' (RIG_GPIO_BACKEND, then whichever of
+    # RPi.GPIO / Jetson.GPIO imports). kwargs go to SimGPIO for 'sim'. Returns the backend GPIO object.
+    name = name or os.environ.get('RIG_GPIO_BACKEND', 'auto')
+    if name == 'auto':
+        for candidate in ('rpi', 'jetson'):
+            try:
+                return use_backend(candidate)
+            except ImportError:
+                pass
+        raise ImportError('no GPIO hardware module found; install RPi.GPIO / Jetson.GPIO or set '
+                          'RIG_GPIO_BACKEND=sim')
+    if name == 'rpi':
+        import RPi.GPIO as gpio
+        clock = RealClock()
+    elif name == 'jetson':
+        import Jetson.GPIO as gpio
+        clock = RealClock()
+    elif name == 'sim':
+        clock = kwargs.pop('clock', None) or VirtualClock()
+        gpio = SimGPIO(clock=clock, **kwargs)
+    else:
+        raise ValueError('unknown GPIO backend: ' + str(name))
+    _backend.update(name=name, gpio=gpio, clock=clock, board_ready=False)
+    return gpio
+
+
+def backend_name():
+    return _backend['name']
+
+
+def simulated():
+    return _backend['name'] == 'sim'
+
+
+def _gpio():
+    if _backend['gpio'] is None:
+        use_backend()
+    return _backend['gpio']
+
+
+GPIO = _Proxy('GPIO', _gpio)
+clock = _Proxy('clock', lambda: _backend['clock'])
+
+
+# BOARD pin -> BCM GPIO number on the 40-pin header
+BOARD_TO_BCM = {3: 2, 5: 3, 7: 4, 8: 14, 10: 15, 11: 17, 12: 18, 13: 27, 15: 22, 16: 23, 18: 24, 19: 10, 21: 9,
+                22: 25, 23: 11, 24: 8, 26: 7, 27: 0, 28: 1, 29: 5, 31: 6, 32: 12, 33: 13, 35: 19, 36: 16, 37: 26,
+                38: 20, 40: 21}
+
+_GPSET0, _GPCLR0 = 7, 10  # 32-bit word offsets of the BCM283x set / clear registers
+_gpiomem = {}
+
+
+# Word view of the GPIO registers through /dev/gpiomem on a Pi 1-4, or None where that is not available (other
+# boards, the Pi 5's RP1 chip, no permission)
+def _gpio_registers():
+    if 'registers' not in _gpiomem:
+        _gpiomem['registers'] = None
+        try:
+            with open('/proc/device-tree/compatible', 'rb') as f:
+                compatible = f.read()
+            if any(chip in compatible for chip in (b'bcm2835', b'bcm2836', b'bcm2837', b'bcm2711')):
+                import mmap
+                with open('/dev/gpiomem', 'r+b', buffering=0) as f:
+                    _gpiomem['registers'] = memoryview(mmap.mmap(f.fileno(), 4096)).cast('I')
+        except OSError:
+            pass
+    return _gpiomem['registers']
+
+
+# Output pins written together. On the 'rpi' backend with BOARD numbering and /dev/gpiomem available, each
+# output() is one store to the set register and/or one to the clear register, so every pin of the group changes
+# on the same bus write; elsewhere it is one GPIO.output(pins, levels) call, which loops in C instead of Python.
+# Every write's duration is kept in [spans_ns]: each edge of the group falls inside it, so it bounds the skew
+# between, e.g., a valve opening and its Intan marker. direct=False always uses GPIO.output.
+class PinGroup:
+    def __init__(self, pins, gpio=None, clock=None, direct=None, history=10000):
+        self.pins = _as_list(pins)
+        self.gpio = GPIO if gpio is None else gpio
+        if clock is None:
+            clock = _backend['clock'] if gpio is None else getattr(gpio, 'clock', None) or _backend['clock']
+        self.clock = clock
+        self.registers = None
+        if direct is not False and self.gpio is GPIO and _backend['name'] == 'rpi':
+            if self.gpio.getmode() == self.gpio.BOARD and all(pin in BOARD_TO_BCM for pin in self.pins):
+                self.registers = _gpio_registers()
+        self.bits = [1 << BOARD_TO_BCM.get(pin, 0) for pin in self.pins]
+        self.all_bits = sum(set(self.bits))
+        self.spans_ns = collections.deque(maxlen=history)
+
+    def setup(self, initial=0):
+        self.gpio.setup(self.pins, self.gpio.OUT, initial=initial)
+
+    # value = one level for every pin, or a list with one level per pin
+    def output(self, value):
+        if self.registers is None:
+            t0 = self.clock.perf_counter_ns()
+            self.gpio.output(self.pins, value)
+        elif isinstance(value, (list, tuple)):
+            high = sum(bit for bit, level in zip(self.bits, value) if level)
+            t0 = self.clock.perf_counter_ns()
+            if high:
+                self.registers[_GPSET0] = high
+            if self.all_bits & ~high:
+                self.registers[_GPCLR0] = self.all_bits & ~high
+        else:
+            t0 = self.clock.perf_counter_ns()
+            self.registers[_GPSET0 if value else _GPCLR0] = self.all_bits
+        self.spans_ns.append(self.clock.perf_counter_ns() - t0)
+
+    # Write-span statistics (microseconds) over the kept writes
+    def summary(self):
+        spans = sorted(span / 1e3 for span in self.spans_ns)
+        if not spans:
+            return {'writes': 0}
+        return {'writes': len(spans), 'direct': self.registers is not None,
+                'median_skew_us': round(spans[len(spans) // 2], 3), 'max_skew_us': round(spans[-1], 3)}
+
+
+# What the rig codes used to do on import: turn off pins left on by a previous program and use BOARD numbering.
+# Only the first call for a backend runs cleanup(), so protocols can call it freely.
+def setup_board():
+    if not _backend['board_ready']:
+        GPIO.setwarnings(False)
+        GPIO.cleanup()
+        _backend['board_ready'] = True
+    GPIO.setmode(GPIO.BOARD)
+
+
+def _to_ns(secs):  # round up, so waiting out a remainder always moves simulated time forward
+    return max(math.ceil(secs * 1e9), 0)
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
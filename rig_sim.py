@@ -0,0 +1,269 @@
+'''
+rig_sim runs the rig protocols on the simulated GPIO backend with a scripted animal
+
+Every run selects rig_gpio's 'sim' backend, so time is simulated (see rig_gpio.VirtualClock) and a full
+60 minute session finishes in seconds of wall time. Use it for regression and throughput testing:
+
+    python rig_sim.py basic_np --minutes 60
+    python rig_sim.py cuedtaste --minutes 60 --seed 3
+    python rig_sim.py pipi2 --trace pipi2_trace.json     # spans of the run (see tracing), in simulated time
+
+Each run_* function returns a summary dict (simulated and wall seconds, speed-up, output writes, pokes).
+'''
+
+import argparse
+import contextlib
+import glob
+import importlib.machinery
+import importlib.util
+import io
+import os
+import random
+import tempfile
+import time
+
+import rig_gpio
+
+
+# Scripted animal. gpio = the SimGPIO backend, beams = input pins the animal can poke, active = level a beam
+# reads while it is crossed. Sessions with the same seed are identical.
+class Animal:
+    def __init__(self, gpio, beams, active=0, seed=0):
+        self.gpio = gpio
+        self.clock = gpio.clock
+        self.active = active
+        self.random = random.Random(seed)
+        self.pokes = []  # (simulated monotonic time, pin) of every poke
+        for pin in beams:
+            gpio.set_input(pin, 1 - active)
+
+    # Cross [pin] [delay] seconds from now and leave it [hold] seconds later
+    def poke(self, pin, delay=0, hold=0.2):
+        self.pokes.append((self.clock.monotonic() + delay, pin))
+        self.gpio.schedule_input(pin, self.active, delay)
+        self.gpio.schedule_input(pin, 1 - self.active, delay + hold)
+
+    # Poke [pin] at random (Poisson) times, [rate] pokes per second, for the next [duration] seconds
+    def poke_randomly(self, pin, rate, duration, hold=0.2):
+        t = self.random.expovariate(rate)
+        while t < duration:
+            self.poke(pin, t, hold)
+            t += hold + self.random.expovariate(rate)
+
+    # Poke [pin] a random [latency] (min, max) after the program sets output [cue_pin] to [cue_level], with
+    # probability [p]. Lights, valves or cue lines can all be used as the cue.
+    def respond(self, cue_pin, pin, cue_level=1, latency=(0.3, 1.5), hold=0.2, p=1.0):
+        def on_cue(cue, level):
+            if level == cue_level and self.random.random() < p:
+                self.poke(pin, self.random.uniform(*latency), hold)
+        self.gpio.watch_output(cue_pin, on_cue)
+
+
+def _start(seed):
+    gpio = rig_gpio.use_backend('sim')
+    rig_gpio.setup_board()
+    random.seed(seed)
+    try:
+        import numpy as np
+        np.random.seed(seed)
+    except ImportError:
+        pass
+    return gpio
+
+
+def _summary(protocol, gpio, wall0, animal=None):
+    wall = time.perf_counter() - wall0
+    simulated = gpio.clock.monotonic()
+    return {'protocol': protocol, 'simulated_s': round(simulated, 3), 'wall_s': round(wall, 3),
+            'speedup': round(simulated / wall, 1) if wall > 0 else None,
+            'writes': len(gpio.writes), 'pokes': 0 if animal is None else len(animal.pokes)}
+
+
+@contextlib.contextmanager
+def _session(quiet):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            if quiet:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    yield directory
+            else:
+                yield directory
+        finally:
+            os.chdir(cwd)
+
+
+# The default pin lists of passive/passive_cue are longer than their opentimes, so use the four cuedtaste lines
+def run_passive(trials=30, itimin=22, itimax=22, seed=0, quiet=True, cue=False):
+    import pi_rig
+    gpio = _start(seed)
+    lines = {'outports': [31, 33, 35, 37], 'intaninputs': [24, 26, 19, 21], 'opentimes': [0.01] * 4}
+    wall0 = time.perf_counter()
+    with _session(quiet) as directory:
+        if cue:
+            pi_rig.passive_cue(trials=trials, itimin=itimin, itimax=itimax, seed=seed, **lines)
+        else:
+            pi_rig.passive(trials=trials, itimin=itimin, itimax=itimax, directory=directory, seed=seed, **lines)
+    return _summary('passive_cue' if cue else 'passive', gpio, wall0)
+
+
+def run_basic_np(trials=200, seed=0, quiet=True, rig=None):
+    rig = rig or __import__('pi_rig')
+    gpio = _start(seed)
+    inport, pokelight = 13, 15
+    if rig.__name__ == 'jet_rig':
+        inport, pokelight = 36, 37
+    animal = Animal(gpio, [inport], active=0, seed=seed)
+    animal.respond(pokelight, inport, latency=(0.5, 10), hold=0.3)
+    wall0 = time.perf_counter()
+    with _session(quiet):
+        rig.basic_np(trials=trials)
+    return _summary('basic_np', gpio, wall0, animal)
+
+
+def run_odor_np(trials=100, seed=0, quiet=True, rig=None):
+    rig = rig or __import__('pi_rig')
+    gpio = _start(seed)
+    inport, houselight = 13, 22
+    if rig.__name__ == 'jet_rig':
+        inport, houselight = 36, 38
+    animal = Animal(gpio, [inport], active=0, seed=seed)
+    animal.respond(houselight, inport, latency=(0.5, 10), hold=0.3)
+    wall0 = time.perf_counter()
+    with _session(quiet):
+        rig.odor_np(trials=trials)
+    return _summary('odor_np', gpio, wall0, animal)
+
+
+def run_affective(tim_dur=1200, seed=0, quiet=True):
+    import pi_rig
+    gpio = _start(seed)
+    wall0 = time.perf_counter()
+    with _session(quiet):
+        pi_rig.affective(tim_dur=tim_dur)
+    return _summary('affective', gpio, wall0)
+
+
+# CuedTaste has no .py extension, so load it by path
+def load_cuedtaste():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CuedTaste')
+    loader = importlib.machinery.SourceFileLoader('CuedTaste', path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader('CuedTaste', loader))
+    loader.exec_module(module)
+    return module
+
+
+# video = keep synthetic video clips around pokes and deliveries (the summary gets the clip counts)
+def run_cuedtaste(minutes=60, seed=0, quiet=True, p_reward=0.9, video=False):
+    import video as rig_video
+    cuedtaste = load_cuedtaste()
+    gpio = _start(seed)
+    # Beams read 1 while crossed (NosePoke.is_crossed); poke lights are on at 0 (flash_on)
+    animal = Animal(gpio, [15, 38], active=1, seed=seed)
+    animal.respond(13, 15, cue_level=0, latency=(1, 8), hold=0.3)
+    animal.respond(40, 38, cue_level=0, latency=(0.5, 6), hold=0.3, p=p_reward)
+    wall0 = time.perf_counter()
+    with _session(quiet) as directory:
+        cuedtaste.setup_rig([0.012] * 4, ['water', 'sucrose', 'nacl', 'quinine'], rig_gpio.SimSerial(gpio.clock))
+        camera = rig_video.SyntheticCamera() if video else None
+        cuedtaste.cuedtaste(anID='sim', runtime=minutes, seed=seed, camera=camera)
+        if video:
+            index = rig_video.FrameIndex(glob.glob(os.path.join(directory, '*_clips', 'clip_frames.csv'))[0])
+            files = len(set(row[1] for row in index.rows))
+    summary = _summary('cuedtaste', gpio, wall0, animal)
+    if video:
+        summary.update(frames=len(index), files=files)
+    return summary
+
+
+# Stand-in for PiCamera so pipi2.Experiment can be built without a camera (video.SyntheticCamera also makes frames)
+class NullCamera:
+    frame = None
+
+    def start_recording(self, output, **options):
+        pass
+
+    def wait_recording(self, duration):
+        pass
+
+    def stop_recording(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# video = record synthetic frames through pipi2's video recorder, the whole session (True) or 'clips' around pokes and
+# water (slower; the summary gets the indexed frame count)
+def run_pipi2(trials=20, seed=0, quiet=True, odors=(0, 1, 2), video=False):
+    import pipi2
+    import video as rig_video
+    gpio = _start(seed)
+    animal = Animal(gpio, [pipi2.Experiment.PINS['ir_beam']], active=1, seed=seed)
+    animal.poke_randomly(pipi2.Experiment.PINS['ir_beam'], rate=0.2, duration=trials * 60, hold=0.5)
+    wall0 = time.perf_counter()
+    with _session(quiet) as directory:
+        camera = rig_video.SyntheticCamera() if video else NullCamera()
+        experiment = pipi2.Experiment(log_filename=os.path.join(directory, 'sim_log.csv'), camera=camera,
+                                      pins={'water_solenoid': 26, 'retro_solenoid': 32})
+        experiment.setup_logging()
+        if video == 'clips':
+            experiment.config['Video'] = {'mode': 'clips'}
+        experiment.run_experiment(trials, list(odors), [19, 21], 0.05, 0.05, animal_id='sim')
+        if video:
+            index = rig_video.FrameIndex(os.path.join(directory, 'sim_log_clips', 'clip_frames.csv') if video == 'clips'
+                                         else os.path.join(directory, 'sim_log_video', 'video_frames.csv'))
+            files = len(set(row[1] for row in index.rows))
+    summary = _summary('pipi2', gpio, wall0, animal)
+    if video:
+        summary.update(frames=len(index), files=files)
+    return summary
+
+
+def run_odor_pi(trials=20, seed=0, quiet=True):
+    import odor_pi
+    gpio = _start(seed)
+    animal = Animal(gpio, [16], active=1, seed=seed)
+    animal.poke_randomly(16, rate=0.05, duration=trials * 120, hold=1.0)
+    wall0 = time.perf_counter()
+    with _session(quiet):
+        experiment = odor_pi.Experiment(11, 13, 21, 24, 26, 29, 8)
+        experiment.run_experiment(trials, [0, 1], 0.05, 0.05, 0.05, 26, 24, 29, 8)
+    return _summary('odor_pi', gpio, wall0, animal)
+
+
+PROTOCOLS = {
+    'passive': run_passive,
+    'passive_cue': lambda **kw: run_passive(cue=True, **kw),
+    'basic_np': run_basic_np,
+    'odor_np': run_odor_np,
+    'affective': run_affective,
+    'cuedtaste': run_cuedtaste,
+    'pipi2': run_pipi2,
+    'odor_pi': run_odor_pi,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a rig protocol on the simulated backend')
+    parser.add_argument('protocol', choices=sorted(PROTOCOLS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--minutes', type=int, help='session length (cuedtaste)')
+    parser.add_argument('--trials', type=int)
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the protocol's own prints")
+    parser.add_argument('--trace', help='save a Chrome trace JSON of the run to this file')
+    args = parser.parse_args()
+    if args.trace:
+        from tracing import tracer
+        tracer.enable()
+    kwargs = {'seed': args.seed, 'quiet': not args.verbose}
+    if args.minutes is not None:
+        kwargs['minutes'] = args.minutes
+    if args.trials is not None:
+        kwargs['trials'] = args.trials
+    print(PROTOCOLS[args.protocol](**kwargs))
+    if args.trace:
+        tracer.save(args.trace)
+        for name, row in tracer.summary().items():
+            print(name.ljust(32), row)
@@ -0,0 +1,126 @@
+'''
+rig_state contains the shared-memory block holding the live state of a running task
+
+The task process creates a SharedRigState and is its only writer: packed pin state (the StateRecorder channels),
+trial number, task state, current cue and the poke light flash modes. Recorder, flasher and UI processes attach
+to it by name and read it without locks or hardware access. Writes are guarded by a sequence counter (a
+seqlock): the writer makes it odd while a write is in progress and even again after, and a reader retries until
+it copied the block between two equal, even counter values, so every snapshot is consistent.
+
+    python rig_state.py <name>     # live view of a running task's state
+'''
+
+import collections
+import multiprocessing
+import struct
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+from rig_gpio import clock as rig_clock
+
+# (name, struct code) of every field, in block order. t_ns = clock.monotonic_ns() of the last write.
+FIELDS = [('t_ns', 'q'), ('pins', 'I'), ('trial', 'i'), ('task_state', 'i'), ('cue', 'i'),
+          ('rew_flash', 'i'), ('trig_flash', 'i')]
+_SEQ = struct.Struct('<Q')
+_BLOCK = struct.Struct('<' + ''.join(code for name, code in FIELDS))
+_INDEX = {name: i for i, (name, code) in enumerate(FIELDS)}
+
+RigSnapshot = collections.namedtuple('RigSnapshot', [name for name, code in FIELDS])
+
+
+class SharedRigState:
+    # name = None creates a new block (the task process); pass the name of an existing block to attach to it.
+    # child = attaching from a child process of the owner (set when a SharedRigState is passed to mp.Process).
+    def __init__(self, name=None, clock=None, child=False):
+        self.clock = clock or rig_clock
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=_SEQ.size + _BLOCK.size)
+            self.shm.buf[:_SEQ.size + _BLOCK.size] = bytes(_SEQ.size + _BLOCK.size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the owner may unlink the block; without this, Python unlinks it when an attached process exits.
+            # Child processes share their parent's resource tracker, so only separately started ones need it.
+            if not child and multiprocessing.parent_process() is None:
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.values = list(self.snapshot())
+        self.lock = threading.Lock()  # the writer's own threads (poke callbacks, cue I/O, task loop)
+
+    def __reduce__(self):  # mp.Process arguments attach by name in the child
+        return SharedRigState, (self.name, None, True)
+
+    # Writer side (task process)
+
+    def update(self, **values):  # write some fields as one consistent change; t_ns defaults to now
+        values.setdefault('t_ns', self.clock.monotonic_ns())
+        with self.lock:
+            for name, value in values.items():
+                self.values[_INDEX[name]] = value
+            seq = _SEQ.unpack_from(self.buf)[0]
+            _SEQ.pack_into(self.buf, 0, seq + 1)
+            _BLOCK.pack_into(self.buf, _SEQ.size, *self.values)
+            _SEQ.pack_into(self.buf, 0, seq + 2)
+
+    # Reader side (any process)
+
+    def snapshot(self):
+        while True:
+            before = _SEQ.unpack_from(self.buf)[0]
+            if before % 2:
+                continue
+            values = _BLOCK.unpack_from(self.buf, _SEQ.size)
+            if _SEQ.unpack_from(self.buf)[0] == before:
+                return RigSnapshot(*values)
+
+    def get(self, name):
+        return self.snapshot()[_INDEX[name]]
+
+    # Object with a .value attribute backed by one field, usable where the rig codes take an mp.Value
+    # (e.g. the [run] flag of NosePoke.flash)
+    def field(self, name):
+        return _Field(self, name)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Field:
+    def __init__(self, state, name):
+        self.state = state
+        self.name = name
+
+    @property
+    def value(self):
+        return self.state.get(self.name)
+
+    @value.setter
+    def value(self, value):
+        self.state.update(**{self.name: value})
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    state = SharedRigState(sys.argv[1])
+    try:
+        while True:
+            snapshot = state.snapshot()
+            print('\r' + '  '.join(name + ' ' + (format(value, '010b') if name == 'pins' else str(value))
+                                   for name, value in snapshot._asdict().items()), end='', flush=True)
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        state.close()
@@ -0,0 +1,47 @@
+'''
+scheduler holds the timing report of a protocol run
+
+ProtocolEngine.run() fires every timed transition against its absolute due time (the state's entry time plus the
+transition's duration), so overhead never accumulates; the ScheduleReport it returns records how late each
+transition fired (its jitter) and how far the session's end was from its planned end.
+'''
+
+import collections
+import csv
+
+# t = planned time in seconds from session start
+TimelineEvent = collections.namedtuple('TimelineEvent', ['t', 'label'])
+
+
+# Per-event jitter of a ProtocolEngine.run(): late_ns[i] is how long after its due time events[i] fired, and
+# end_error_ns how long after the planned end the session ended
+class ScheduleReport:
+    def __init__(self, events, late_ns, end_error_ns):
+        self.events = events
+        self.late_ns = late_ns
+        self.end_error_ns = end_error_ns
+
+    def summary(self):
+        late = sorted(self.late_ns)
+        if not late:
+            return {'events': 0}
+        return {'events': len(late),
+                'mean_ms': round(sum(late) / len(late) / 1e6, 3),
+                'p99_ms': round(late[min(len(late) - 1, int(0.99 * len(late)))] / 1e6, 3),
+                'max_ms': round(late[-1] / 1e6, 3),
+                'end_error_ms': round(self.end_error_ns / 1e6, 3)}
+
+    def save(self, filename):
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['event', 'planned_s', 'jitter_ms'])
+            for event, late in zip(self.events, self.late_ns):
+                writer.writerow([event.label, round(event.t, 6), round(late / 1e6, 3)])
+
+    def __str__(self):
+        summary = self.summary()
+        if not summary['events']:
+            return 'no events scheduled'
+        return ('events: ' + str(summary['events']) + '   jitter (ms) mean ' + str(summary['mean_ms']) +
+                '  p99 ' + str(summary['p99_ms']) + '  max ' + str(summary['max_ms']) +
+                '   session end error: ' + str(summary['end_error_ms']) + ' ms')
@@ -0,0 +1,252 @@
+'''
+telemetry contains the optional live session dashboard, served locally over HTTP
+
+A task that has a SessionMetrics only appends to it on the trial path (a counter, or a timestamp on a deque); a
+TelemetryServer thread turns the buffers into snapshots (trial count, poke rate, poke -> reward latency histogram,
+output duty cycles over the last [window] seconds) and streams them to browsers as Server-Sent Events, so nobody
+watching a session ever makes the control loop print, format or wait.
+
+    RIG_TELEMETRY=8765 python pi_rig.py ...    # or telemetry.start(8765) before the session (host:port to
+                                               # serve beyond localhost)
+    http://localhost:8765/                     # dashboard of every session in this process
+    http://localhost:8765/?rigs=rig2:8765,rig3:8765   # ... and of other rigs' servers, in one page
+    http://localhost:8765/metrics              # current snapshots as JSON
+
+ProtocolEngine sessions (pi_rig, jet_rig, CuedTaste) and pipi2 register themselves with session() while a server
+is running; without one, session() returns None and nothing is collected. The server only binds to [host]
+(localhost by default).
+'''
+
+import bisect
+import collections
+import http.server
+import itertools
+import json
+import os
+import threading
+import urllib.parse
+
+from rig_gpio import clock as rig_clock
+
+LATENCY_BINS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # upper edges; the last bin is open
+
+
+class SessionMetrics:
+    # name = label on the dashboard. window = seconds the poke rate and duty cycles are computed over. reward_window
+    # = longest poke -> reward time counted as a latency. history = events kept per buffer.
+    def __init__(self, name, window=60, reward_window=10, clock=None, history=10000):
+        self.name = name
+        self.id = None  # set by TelemetryServer.add()
+        self.clock = clock or rig_clock
+        self.window_ns = int(window * 1e9)
+        self.reward_window_ns = int(reward_window * 1e9)
+        self.start_ns = self.clock.monotonic_ns()
+        self.state = None
+        self.trials = 0
+        self.poke_count = 0
+        self.pokes = collections.deque(maxlen=history)  # t_ns of every crossing
+        self.latencies = collections.deque(maxlen=history)  # poke -> reward, ms
+        self.outputs = {}  # output name -> deque of [on ns, off ns or None]
+        self.last_poke_ns = None
+
+    # Hot path: appends only
+
+    def poke(self, name, crossed, t_ns=None):
+        if crossed:
+            t_ns = self.clock.monotonic_ns() if t_ns is None else t_ns
+            self.poke_count += 1
+            self.pokes.append(t_ns)
+            self.last_poke_ns = t_ns
+
+    def trial(self, state=None):
+        self.trials += 1
+        if state is not None:
+            self.state = state
+
+    def output(self, name, level, t_ns=None):
+        t_ns = self.clock.monotonic_ns() if t_ns is None else t_ns
+        spans = self.outputs.get(name)
+        if spans is None:
+            spans = self.outputs[name] = collections.deque(maxlen=self.pokes.maxlen)
+        if level and (not spans or spans[-1][1] is not None):
+            spans.append([t_ns, None])
+        elif not level and spans and spans[-1][1] is None:
+            spans[-1][1] = t_ns
+
+    # A reward was delivered at [t_ns]: its latency is counted from the last crossing, if that came after the
+    # previous reward and within reward_window
+    def reward(self, t_ns=None):
+        t_ns = self.clock.monotonic_ns() if t_ns is None else t_ns
+        if self.last_poke_ns is not None and 0 <= t_ns - self.last_poke_ns <= self.reward_window_ns:
+            self.latencies.append((t_ns - self.last_poke_ns) / 1e6)
+        self.last_poke_ns = None
+
+    # Listeners: PokeMonitor (PokeEvent) and PulseEngine (pins, level, t_ns), for tasks that use them directly
+
+    def on_poke(self, event):
+        self.poke(event.pin, event.crossed, event.t_ns)
+
+    def on_pulse(self, pins, level, t_ns):
+        self.output(str(pins), level, t_ns)
+        if level:
+            self.reward(t_ns)
+
+    # Server side
+
+    def snapshot(self):
+        now = self.clock.monotonic_ns()
+        since = now - self.window_ns
+        window_s = min(self.window_ns, now - self.start_ns) / 1e9
+        pokes = [t for t in list(self.pokes) if t >= since]
+        latencies = sorted(self.latencies)
+        counts = [0] * (len(LATENCY_BINS_MS) + 1)
+        for latency in latencies:
+            counts[bisect.bisect_left(LATENCY_BINS_MS, latency)] += 1
+        outputs = {}
+        for name, spans in list(self.outputs.items()):
+            spans = list(spans)
+            open_ns = sum(max(min(now if off is None else off, now) - max(on, since), 0) for on, off in spans)
+            outputs[name] = {'openings': len(spans), 'open': bool(spans) and spans[-1][1] is None,
+                             'duty': round(open_ns / 1e9 / window_s, 4) if window_s > 0 else 0.0}
+        pick = lambda q: round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3) if latencies else None
+        return {'name': self.name, 'state': self.state, 'uptime_s': round((now - self.start_ns) / 1e9, 1),
+                'trials': self.trials, 'pokes': self.poke_count,
+                'poke_rate_per_min': round(len(pokes) / window_s * 60, 2) if window_s > 0 else 0.0,
+                'latency_ms': {'count': len(latencies), 'p50': pick(0.5), 'p95': pick(0.95),
+                               'bins': LATENCY_BINS_MS, 'counts': counts},
+                'outputs': outputs}
+
+
+class TelemetryServer:
+    # interval = seconds between the snapshots streamed to each browser
+    def __init__(self, port=8765, host='127.0.0.1', interval=1.0):
+        self.sessions = collections.OrderedDict()  # id -> SessionMetrics, ids unique so equal names don't collide
+        self.ids = itertools.count(1)
+        self.interval = interval
+        self.closed = threading.Event()
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _handler(self))
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='TelemetryServer', daemon=True)
+        self.thread.start()
+
+    def add(self, metrics):
+        metrics.id = next(self.ids)
+        self.sessions[metrics.id] = metrics
+        return metrics
+
+    # Take a finished session off the dashboard
+    def remove(self, metrics):
+        if self.sessions.get(metrics.id) is metrics:
+            del self.sessions[metrics.id]
+
+    def snapshot(self):
+        return {'sessions': [metrics.snapshot() for metrics in list(self.sessions.values())]}
+
+    def close(self):
+        self.closed.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _handler(server):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):  # keep the task's terminal clean
+            pass
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urllib.parse.urlparse(self.path).path
+            if path == '/':
+                self._send(DASHBOARD.encode(), 'text/html; charset=utf-8')
+            elif path == '/metrics':
+                self._send(json.dumps(server.snapshot()).encode(), 'application/json')
+            elif path == '/events':
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                try:
+                    while not server.closed.is_set():
+                        self.wfile.write(b'data: ' + json.dumps(server.snapshot()).encode() + b'\n\n')
+                        self.wfile.flush()
+                        server.closed.wait(server.interval)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            else:
+                self.send_error(404)
+    return Handler
+
+
+server = None  # the process's TelemetryServer, once start() has run
+
+
+def start(port=8765, host='127.0.0.1', interval=1.0):
+    global server
+    if server is None:
+        server = TelemetryServer(port, host, interval)
+    return server
+
+
+# SessionMetrics registered with the running server, or None if no server is running. remove() it from the server
+# when the session ends.
+def session(name, **kwargs):
+    if server is None:
+        return None
+    return server.add(SessionMetrics(name, **kwargs))
+
+
+DASHBOARD = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>rig telemetry</title>
+<style>
+body { font-family: monospace; margin: 1em; } .session { border: 1px solid #999; padding: .5em; margin: .5em 0; }
+.bar { display: inline-block; background: #4a7; height: .8em; } td { padding: 0 .6em; } .down { color: #c33; }
+</style></head>
+<body><h3>rig telemetry</h3><div id="sessions"></div>
+<script>
+const rigs = [''].concat((new URLSearchParams(location.search).get('rigs') || '').split(',').filter(r => r));
+const data = {};
+function render() {
+  let html = '';
+  for (const rig of rigs) {
+    const d = data[rig];
+    if (!d) { html += '<div class="session down">' + (rig || location.host) + ': no data</div>'; continue; }
+    for (const s of d.sessions) {
+      const l = s.latency_ms, top = Math.max(1, ...l.counts);
+      html += '<div class="session"><b>' + (rig ? rig + ' / ' : '') + s.name + '</b> state ' + s.state +
+        ' | up ' + s.uptime_s + ' s | trials ' + s.trials + ' | pokes ' + s.pokes + ' (' + s.poke_rate_per_min +
+        '/min)<br>reward latency (ms): n ' + l.count + ', p50 ' + l.p50 + ', p95 ' + l.p95 + '<table>';
+      l.counts.forEach((c, i) => { html += '<tr><td>' + (i < l.bins.length ? '&lt;' + l.bins[i] : '&ge;' +
+        l.bins[l.bins.length - 1]) + '</td><td>' + c + '</td><td><span class="bar" style="width:' +
+        (200 * c / top) + 'px"></span></td></tr>'; });
+      html += '</table><table><tr><td>output</td><td>openings</td><td>duty</td><td></td></tr>';
+      for (const [name, o] of Object.entries(s.outputs)) {
+        html += '<tr><td>' + name + '</td><td>' + o.openings + '</td><td>' + (100 * o.duty).toFixed(1) +
+          ' %</td><td>' + (o.open ? 'open' : '') + '</td></tr>';
+      }
+      html += '</table></div>';
+    }
+  }
+  document.getElementById('sessions').innerHTML = html;
+}
+for (const rig of rigs) {
+  const source = new EventSource((rig ? 'http://' + rig : '') + '/events');
+  source.onmessage = e => { data[rig] = JSON.parse(e.data); render(); };
+  source.onerror = () => { delete data[rig]; render(); };
+}
+render();
+</script></body></html>
+'''
+
+
+if os.environ.get('RIG_TELEMETRY'):  # <port> or <host>:<port>
+    _host, _, _port = os.environ['RIG_TELEMETRY'].rpartition(':')
+    start(int(_port), _host or '127.0.0.1')
@@ -0,0 +1,158 @@
+'''
+timelines contains the asyncio runtime for overlapping output timelines
+
+Some deliveries drive several outputs at once: odor, water and retro solenoids in pipi2, vacuum and odor in
+odor_np. Each output is a Channel, a list of (offset, level) steps, and every channel runs as a coroutine on one
+asyncio loop in the calling thread, sleeping until its next step's deadline on the shared monotonic clock (asyncio
+sleep for the coarse part, a short busy-wait for the last [spin] seconds). There is no process or thread per
+channel, so steps planned for the same time are written microseconds apart; each run returns a ChannelReport with
+the measured lateness of every step and the inter-channel skew of steps planned together.
+
+On a simulated clock the coroutines still run on asyncio, but simulated time only moves once every channel is
+waiting, and then straight to the earliest deadline.
+'''
+
+import asyncio
+import collections
+import csv
+import heapq
+import itertools
+
+from rig_gpio import GPIO as rig_GPIO, clock as rig_clock
+from tracing import tracer
+
+# name = label for logs and reports, pins = one pin or a list, steps = [(seconds from the start, level), ...]
+Channel = collections.namedtuple('Channel', ['name', 'pins', 'steps'])
+
+# One written step: planned_ns / t_ns = clock.monotonic_ns() it was due / written
+ChannelStep = collections.namedtuple('ChannelStep', ['channel', 'offset', 'level', 'planned_ns', 't_ns'])
+
+
+class TimelineRuntime:
+    # spin = seconds before each deadline spent busy-waiting instead of in asyncio.sleep. history = how many
+    # ChannelReports to keep for summary() / save().
+    def __init__(self, gpio=None, clock=None, spin=0.001, history=10000):
+        self.gpio = rig_GPIO if gpio is None else gpio
+        if clock is None:
+            clock = rig_clock if gpio is None else getattr(gpio, 'clock', None) or rig_clock
+        self.clock = clock
+        self.spin_ns = int(spin * 1e9)
+        self.reports = collections.deque(maxlen=history)
+        self.loop = None  # made on the first run, so a runtime can be built in one process and used in another
+
+    # Run [channels] together, their offsets counted from monotonic_ns time [t0_ns] (default: now). on_step(channel,
+    # level, t_ns) runs after each write (e.g. to log it). Blocks until every channel is done.
+    def run(self, channels, t0_ns=None, on_step=None):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        if t0_ns is None:
+            t0_ns = self.clock.monotonic_ns()
+        steps = []
+        self.loop.run_until_complete(self._main([self._channel(channel, t0_ns, on_step, steps)
+                                                 for channel in channels]))
+        report = ChannelReport(steps)
+        self.reports.append(report)
+        return report
+
+    async def _channel(self, channel, t0_ns, on_step, steps):
+        for offset, level in sorted(channel.steps, key=lambda step: step[0]):
+            planned_ns = t0_ns + round(offset * 1e9)
+            await self.sleep_until(planned_ns)
+            with tracer.span('gpio.write', 'gpio', channel=channel.name, level=level):
+                self.gpio.output(channel.pins, level)
+            t_ns = self.clock.monotonic_ns()
+            steps.append(ChannelStep(channel.name, offset, level, planned_ns, t_ns))
+            if on_step is not None:
+                on_step(channel, level, t_ns)
+
+    async def _main(self, coroutines):
+        self.active = len(coroutines)
+        self.waiting = []  # heap of (deadline, seq, future) on a simulated clock
+        self.seq = itertools.count()
+        self.changed = asyncio.Event()
+        tasks = [self._track(coroutine) for coroutine in coroutines]
+        if self.clock.virtual:
+            tasks.append(self._drive())
+        await asyncio.gather(*tasks)
+
+    async def _track(self, coroutine):
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.changed.set()
+
+    # Sleep until clock.monotonic_ns() reaches [t_ns]
+    async def sleep_until(self, t_ns):
+        if self.clock.virtual:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (t_ns, next(self.seq), future))
+            self.changed.set()
+            await future
+            return
+        remaining = t_ns - self.clock.monotonic_ns() - self.spin_ns
+        if remaining > 0:
+            await asyncio.sleep(remaining / 1e9)
+        while self.clock.monotonic_ns() < t_ns:
+            pass
+
+    # Simulated clock: once every channel is waiting, move time to the earliest deadline and wake that channel
+    async def _drive(self):
+        while self.active:
+            if len(self.waiting) < self.active:
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+            t_ns, seq, future = heapq.heappop(self.waiting)
+            self.clock.sleep(max(t_ns - self.clock.monotonic_ns(), 0) / 1e9)
+            future.set_result(None)
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+    # Skew and lateness statistics (ms) over the kept reports
+    def summary(self):
+        skews = sorted(report.skew_ns() / 1e6 for report in self.reports)
+        late = sorted(step.t_ns - step.planned_ns for report in self.reports for step in report.steps)
+        if not skews:
+            return {'runs': 0}
+        return {'runs': len(skews),
+                'median_skew_ms': round(skews[len(skews) // 2], 4),
+                'max_skew_ms': round(skews[-1], 4),
+                'median_late_ms': round(late[len(late) // 2] / 1e6, 4),
+                'max_late_ms': round(late[-1] / 1e6, 4)}
+
+    def save(self, filename):
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['run', 'channel', 'offset_s', 'level', 'late_ms'])
+            for run, report in enumerate(self.reports):
+                for step in report.steps:
+                    writer.writerow([run, step.channel, step.offset, step.level,
+                                     round((step.t_ns - step.planned_ns) / 1e6, 4)])
+
+
+# Steps written by one TimelineRuntime.run()
+class ChannelReport:
+    def __init__(self, steps):
+        self.steps = steps
+
+    # Largest spread (ns) between the writes of different channels planned for the same time
+    def skew_ns(self):
+        groups = collections.defaultdict(list)
+        for step in self.steps:
+            groups[step.planned_ns].append(step.t_ns)
+        return max((max(times) - min(times) for times in groups.values() if len(times) > 1), default=0)
+
+    def summary(self):
+        late = [step.t_ns - step.planned_ns for step in self.steps]
+        return {'steps': len(self.steps),
+                'skew_ms': round(self.skew_ns() / 1e6, 4),
+                'max_late_ms': round(max(late, default=0) / 1e6, 4)}
+
+    def __str__(self):
+        summary = self.summary()
+        return ('steps: ' + str(summary['steps']) + '   onset skew ' + str(summary['skew_ms']) + ' ms   max late ' +
+                str(summary['max_late_ms']) + ' ms')
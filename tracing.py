@@ -0,0 +1,166 @@
+'''
+tracing contains the span tracer for the trial hot paths
+
+When a reward comes late, the question is which step held it up: a print, the event log, the serial link to the
+cue Arduino, or a GPIO write. The task code wraps those steps in spans:
+
+    with tracer.span('cue.send', 'serial'):
+        channel.send(message)
+
+and the global tracer keeps (name, category, start ns, duration ns, thread) for each one in a ring buffer of
+[capacity] spans (a collections.deque: appending is atomic, so writer threads never take a lock and the oldest
+spans are simply overwritten). Export the buffer as Chrome trace JSON, which chrome://tracing and ui.perfetto.dev
+open directly, or print the per-span statistics:
+
+    RIG_TRACE=trace.json python pipi2.py      # trace the whole run, saved at exit
+    python tracing.py trace.json              # count / total / median / max ms of every span name
+
+Tracing is off unless enabled (tracer.enable(), or the RIG_TRACE environment variable). While it is off, span()
+returns one shared do-nothing context manager, so a traced step costs an attribute check and a method call.
+Times come from the rig_gpio clock, so on the 'sim' backend spans are in simulated time.
+'''
+
+import atexit
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+
+from rig_gpio import clock as rig_clock
+
+# One finished span. t_ns = clock.perf_counter_ns() at its start, tid = threading.get_ident() of the thread it ran in
+Span = collections.namedtuple('Span', ['name', 'cat', 't_ns', 'dur_ns', 'tid', 'args'])
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _ActiveSpan:
+    __slots__ = ('tracer', 'name', 'cat', 'args', 't_ns')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.t_ns = self.tracer.clock.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.cat, self.t_ns, self.tracer.clock.perf_counter_ns() - self.t_ns, self.args)
+        return False
+
+
+class Tracer:
+    # capacity = spans kept; older ones are dropped first
+    def __init__(self, capacity=100000, clock=None):
+        self.clock = clock or rig_clock
+        self.enabled = False
+        self.spans = collections.deque(maxlen=capacity)
+        self.threads = {}  # tid -> thread name, for the exported trace
+
+    def enable(self, capacity=None):
+        if capacity is not None and capacity != self.spans.maxlen:
+            self.spans = collections.deque(self.spans, maxlen=capacity)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self.spans.clear()
+
+    # Context manager timing the block it wraps. args = extra values shown with the span in the trace viewer.
+    def span(self, name, cat='task', **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _ActiveSpan(self, name, cat, args or None)
+
+    # Record a span that was timed elsewhere (t_ns and dur_ns on this tracer's clock)
+    def add(self, name, cat, t_ns, dur_ns, args=None):
+        tid = threading.get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        self.spans.append(Span(name, cat, t_ns, dur_ns, tid, args))
+
+    # Per span name: count, total, median and max duration (ms), slowest total first
+    def summary(self):
+        return summarize(self.spans)
+
+    # Write the kept spans as Chrome trace JSON (complete "X" events, microsecond timestamps)
+    def save(self, filename):
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in list(self.threads.items())]
+        for span in list(self.spans):
+            event = {'name': span.name, 'cat': span.cat, 'ph': 'X', 'ts': span.t_ns / 1e3, 'dur': span.dur_ns / 1e3,
+                     'pid': pid, 'tid': span.tid}
+            if span.args:
+                event['args'] = {key: str(value) for key, value in span.args.items()}
+            events.append(event)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ns'}, f)
+
+
+def summarize(spans):
+    durations = collections.defaultdict(list)
+    for span in spans:
+        durations[span.name].append(span.dur_ns / 1e6)
+    rows = {}
+    for name, values in durations.items():
+        values.sort()
+        rows[name] = {'count': len(values), 'total_ms': round(sum(values), 3),
+                      'median_ms': round(values[len(values) // 2], 4), 'max_ms': round(values[-1], 4)}
+    return dict(sorted(rows.items(), key=lambda row: -row[1]['total_ms']))
+
+
+tracer = Tracer()
+
+
+# Decorator: run the function inside a span named [name] (default: its qualified name)
+def traced(name=None, cat='task'):
+    def decorate(fn):
+        label = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return fn(*args, **kwargs)
+            with _ActiveSpan(tracer, label, cat, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Spans of a saved Chrome trace
+def load(filename):
+    with open(filename) as f:
+        events = json.load(f)['traceEvents']
+    return [Span(e['name'], e.get('cat'), round(e['ts'] * 1e3), round(e['dur'] * 1e3), e.get('tid'), e.get('args'))
+            for e in events if e.get('ph') == 'X']
+
+
+if os.environ.get('RIG_TRACE'):
+    tracer.enable()
+    atexit.register(lambda: tracer.save(os.environ['RIG_TRACE']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        raise SystemExit('usage: python tracing.py trace.json')
+    print('span'.ljust(36) + 'count'.rjust(8) + 'total ms'.rjust(12) + 'median ms'.rjust(12) + 'max ms'.rjust(12))
+    for name, row in summarize(load(sys.argv[1])).items():
+        print(name.ljust(36) + str(row['count']).rjust(8) + str(row['total_ms']).rjust(12) +
+              str(row['median_ms']).rjust(12) + str(row['max_ms']).rjust(12))
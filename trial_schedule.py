@@ -0,0 +1,85 @@
+'''
+trial_schedule contains the seeded, precomputed trial schedules of the tasks
+
+The whole session is drawn before the first trial, as a NumPy structured array with one row per trial (stimulus,
+ITI, cue), so the trial loop only indexes it. Every schedule comes from a seeded generator; the seed is drawn and
+kept when none is given, and save_schedule() stores it with the array next to the session's data, so any session
+can be rebuilt exactly with make_schedule(..., seed=<saved seed>).
+
+Balancing: with block=k the trials come in blocks holding every stimulus k times, each block shuffled on its own
+(block=None shuffles the whole session, which is only balanced overall). max_run limits how many trials in a row
+may give the same stimulus, across block boundaries too.
+'''
+
+import json
+
+import numpy as np
+
+SCHEDULE_DTYPE = np.dtype([('trial', '<i4'), ('stimulus', '<i4'), ('iti', '<f8'), ('cue', '<i4')])
+
+
+class Schedule(np.ndarray):  # SCHEDULE_DTYPE array that also carries the parameters (seed included) it came from
+    def __array_finalize__(self, obj):
+        self.params = getattr(obj, 'params', None)
+
+
+# [trials] trials of each of [n_stimuli] stimuli. iti = (min, max) seconds drawn uniformly (whole seconds, both
+# ends included, with integer_iti), one fixed value, or None (all 0). cues = cue of each stimulus (default: the
+# stimulus number).
+def make_schedule(n_stimuli, trials, iti=None, seed=None, block=None, max_run=None, cues=None, integer_iti=False):
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+    if max_run is not None and n_stimuli < 2:
+        raise ValueError('max_run needs at least two stimuli')
+    params = dict(n_stimuli=n_stimuli, trials=trials, iti=iti, seed=seed, block=block, max_run=max_run,
+                  cues=cues, integer_iti=integer_iti)
+    rng = np.random.default_rng(seed)
+    if block is None:
+        blocks = [np.repeat(np.arange(n_stimuli), trials)]
+    else:
+        if trials % block:
+            raise ValueError('trials (' + str(trials) + ') must be a multiple of block (' + str(block) + ')')
+        blocks = [np.repeat(np.arange(n_stimuli), block) for i in range(trials // block)]
+    order = []
+    for stimuli in blocks:
+        for attempt in range(1000):
+            stimuli = rng.permutation(stimuli)
+            if max_run is None or _longest_run(order[-max_run:] + list(stimuli)) <= max_run:
+                break
+        else:
+            raise ValueError('no order found with runs of at most ' + str(max_run))
+        order.extend(stimuli.tolist())
+
+    schedule = np.zeros(len(order), dtype=SCHEDULE_DTYPE).view(Schedule)
+    schedule['trial'] = np.arange(1, len(order) + 1)
+    schedule['stimulus'] = order
+    if isinstance(iti, (list, tuple)):
+        if integer_iti:
+            schedule['iti'] = rng.integers(iti[0], iti[1], len(order), endpoint=True)
+        else:
+            schedule['iti'] = rng.uniform(iti[0], iti[1], len(order))
+    elif iti is not None:
+        schedule['iti'] = iti
+    schedule['cue'] = np.asarray(cues)[schedule['stimulus']] if cues is not None else schedule['stimulus']
+    schedule.params = params
+    return schedule
+
+
+def _longest_run(values):
+    longest = run = 0
+    for i, value in enumerate(values):
+        run = run + 1 if i and value == values[i - 1] else 1
+        longest = max(longest, run)
+    return longest
+
+
+# Save [schedule] and its parameters to [filename] (.npz)
+def save_schedule(filename, schedule):
+    np.savez(filename, schedule=np.asarray(schedule), params=json.dumps(schedule.params))
+
+
+def load_schedule(filename):
+    with np.load(filename) as data:
+        schedule = data['schedule'].view(Schedule)
+        schedule.params = json.loads(str(data['params']))
+    return schedule
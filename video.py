@@ -0,0 +1,488 @@
+'''
+video contains the segmented, frame-indexed video capture and the lookups that align frames with logged events
+
+VideoCapture is the file-like output handed to camera.start_recording(): the camera's encoder thread writes the
+H.264 stream to it, and it
+    - splits the stream into segment files (<prefix>_0000.h264, <prefix>_0001.h264, ...), starting a new one at
+      the first key frame after [segment_s] seconds, so every segment decodes on its own and a crash loses at most
+      one segment
+    - appends one row per frame to <prefix>_frames.csv: frame number, segment, frame within the segment, and the
+      capture time on the rig clock (monotonic ns, and clock.time() as in the event logs), worked out from the
+      camera's own frame timestamp, not from when the encoder got round to writing it
+
+Recording runs for the whole session; nothing is stopped or restarted between trials. Afterwards FrameIndex finds
+the frames of any moment, and event_frames() those of every logged event:
+
+    python video.py session_video/video_frames.csv session_log.csv "Water_solenoid turned On" --before 1 --after 2
+
+When only the moments around pokes and deliveries matter, ClipRecorder takes VideoCapture's place: it keeps the
+last few seconds of the stream in RAM and saves a clip around every trigger(), so only those seconds reach the SD
+card, indexed the same way.
+
+SyntheticCamera stands in for the PiCamera: it "records" numbered frames at [framerate] on the rig clock (simulated
+time on the 'sim' backend), through the same interface, so capture and indexing can be tested without a camera.
+'''
+
+import argparse
+import bisect
+import collections
+import csv
+import os
+import queue
+import struct
+import threading
+
+from rig_gpio import clock as rig_clock
+
+# picamera.PiVideoFrameType values
+FRAME, KEY_FRAME, SPS_HEADER, MOTION_DATA = 0, 1, 2, 3
+
+# What camera.frame describes: the frame the current write() belongs to. timestamp = camera clock (us) at capture,
+# None for SPS headers. complete = this write() is the frame's last buffer.
+Frame = collections.namedtuple('Frame', ['index', 'timestamp', 'complete', 'frame_type'])
+
+INDEX_COLUMNS = ['frame', 'segment', 'segment_frame', 't_ns', 'time', 'camera_us']
+
+
+# Capture time of [frame] as (clock.monotonic_ns(), clock.time()): now, back-dated by how long ago the camera
+# captured it, on the camera's own clock
+def capture_time(camera, frame, clock):
+    now_ns = clock.monotonic_ns()
+    t_ns = now_ns
+    if frame.timestamp is not None:
+        t_ns = now_ns - max(int(camera.timestamp - frame.timestamp), 0) * 1000
+    return t_ns, clock.time() - (now_ns - t_ns) / 1e9
+
+
+class VideoCapture:
+    # directory = where the segments and the index go. segment_s = seconds per segment (a segment ends at the first
+    # key frame after that, so keep intra_period, in frames, to about a second). camera = a PiCamera (the default)
+    # or a stand-in with the same recording interface, such as SyntheticCamera. on_segment(filename) is called
+    # with every finished segment, from the camera's thread.
+    def __init__(self, directory, prefix='video', camera=None, segment_s=60, framerate=30, resolution=(640, 480),
+                 intra_period=None, clock=None, on_segment=None):
+        if camera is None:
+            from picamera import PiCamera
+            camera = PiCamera()
+        self.camera = camera
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_ns = int(segment_s * 1e9)
+        self.framerate = framerate
+        self.resolution = resolution
+        self.intra_period = intra_period or int(round(framerate))
+        self.clock = clock or rig_clock
+        self.on_segment = on_segment
+        self.lock = threading.Lock()
+        self.recording = False
+        self.file = None
+        self.segment = -1
+        self.segment_start_ns = None
+        self.segment_frames = 0
+        self.frames = 0
+        self.late_frames = 0  # frames more than 1.5 frame intervals after the previous one (dropped in between)
+        self.last_camera_us = None
+        self.segments = []  # file names, in order
+        self.index_file = None
+        self.index_writer = None
+
+    def segment_filename(self, segment):
+        return os.path.join(self.directory, self.prefix + '_' + str(segment).zfill(4) + '.h264')
+
+    @property
+    def index_filename(self):
+        return os.path.join(self.directory, self.prefix + '_frames.csv')
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_file = open(self.index_filename, 'w', newline='')
+        self.index_writer = csv.writer(self.index_file)
+        self.index_writer.writerow(INDEX_COLUMNS)
+        self._next_segment()
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.framerate
+        self.recording = True
+        # Inline SPS headers before every key frame are where the segments are cut
+        self.camera.start_recording(self, format='h264', intra_period=self.intra_period, inline_headers=True)
+        return self
+
+    def _next_segment(self):
+        finished = None
+        if self.file is not None:
+            self.file.close()
+            self.index_file.flush()
+            finished = self.segments[-1]
+        self.segment += 1
+        self.segments.append(self.segment_filename(self.segment))
+        self.file = open(self.segments[-1], 'wb')
+        self.segment_start_ns = None
+        self.segment_frames = 0
+        if finished is not None and self.on_segment is not None:
+            self.on_segment(finished)
+
+    # Called by the camera with each piece of the encoded stream
+    def write(self, data):
+        with self.lock:
+            if self.file is None:
+                return 0
+            frame = self.camera.frame
+            if frame is None:
+                self.file.write(data)
+                return len(data)
+            if (frame.frame_type == SPS_HEADER and self.segment_start_ns is not None and
+                    self.clock.monotonic_ns() - self.segment_start_ns >= self.segment_ns):
+                self._next_segment()
+            self.file.write(data)
+            if frame.complete and frame.frame_type in (FRAME, KEY_FRAME):
+                self._index(frame)
+        return len(data)
+
+    def _index(self, frame):
+        t_ns, t = capture_time(self.camera, frame, self.clock)
+        if frame.timestamp is not None:
+            if (self.last_camera_us is not None and
+                    frame.timestamp - self.last_camera_us > 1.5e6 / self.framerate):
+                self.late_frames += 1
+            self.last_camera_us = frame.timestamp
+        if self.segment_start_ns is None:
+            self.segment_start_ns = t_ns
+        self.index_writer.writerow([self.frames, self.segment, self.segment_frames, t_ns, '%.6f' % t,
+                                    frame.timestamp])
+        self.frames += 1
+        self.segment_frames += 1
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                self.index_file.flush()
+
+    # Stop recording and close the last segment and the index. Returns summary().
+    def stop(self):
+        if self.recording:
+            self.recording = False
+            self.camera.stop_recording()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.index_file.close()
+                self.file = None
+                if self.on_segment is not None:
+                    self.on_segment(self.segments[-1])
+        return self.summary()
+
+    def summary(self):
+        return {'frames': self.frames, 'segments': len(self.segments), 'late_frames': self.late_frames,
+                'index': self.index_filename}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# One key frame and the frames up to the next: the smallest piece of the stream that decodes on its own.
+# frames = [(frame number, t_ns, time, camera us)]
+class _Gop:
+    __slots__ = ('start_ns', 'chunks', 'frames', 'nbytes')
+
+    def __init__(self):
+        self.start_ns = None
+        self.chunks = []
+        self.frames = []
+        self.nbytes = 0
+
+
+class ClipRecorder:
+    # Camera output like VideoCapture, but only keeps the last [pre_s] seconds of the encoded stream, in RAM, and
+    # saves a clip from [pre_s] before to [post_s] after every trigger(). A trigger during a clip extends it, and a
+    # clip never repeats frames already saved in the previous one, so the clips' frames (in <prefix>_frames.csv,
+    # with the clip number as the segment, so FrameIndex and event_frames() read it) stay in time order. Clips start
+    # at the key frame before [pre_s] and end at the first one after [post_s]. max_bytes caps the RAM held for the
+    # pre-trigger window; going over it drops the oldest key frame interval and is counted in [overflows].
+    # Clips are written by a background thread, never by the camera's thread or the task's.
+    def __init__(self, directory, prefix='clip', camera=None, pre_s=3, post_s=3, framerate=30, resolution=(640, 480),
+                 intra_period=None, clock=None, max_bytes=64 * 2 ** 20):
+        if camera is None:
+            from picamera import PiCamera
+            camera = PiCamera()
+        self.camera = camera
+        self.directory = directory
+        self.prefix = prefix
+        self.pre_ns = int(pre_s * 1e9)
+        self.post_ns = int(post_s * 1e9)
+        self.framerate = framerate
+        self.resolution = resolution
+        self.intra_period = intra_period or int(round(framerate))
+        self.clock = clock or rig_clock
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.recording = False
+        self.gops = collections.deque()  # the pre-trigger window, oldest first
+        self.buffered_bytes = 0
+        self.clip = None  # the clip being collected: {'labels', 'trigger_ns', 'end_ns', 'gops'}
+        self.saved = None  # last _Gop handed to the writer
+        self.clips = 0
+        self.frames = 0
+        self.bytes_seen = 0
+        self.bytes_saved = 0
+        self.overflows = 0
+        self.queue = queue.Queue()
+        self.writer = None
+
+    @property
+    def index_filename(self):
+        return os.path.join(self.directory, self.prefix + '_frames.csv')
+
+    @property
+    def clips_filename(self):
+        return os.path.join(self.directory, self.prefix + '_clips.csv')
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for filename, columns in ((self.index_filename, INDEX_COLUMNS),
+                                  (self.clips_filename, ['clip', 'file', 'labels', 'trigger_time', 'start_time',
+                                                         'end_time', 'frames', 'bytes'])):
+            with open(filename, 'w', newline='') as f:
+                csv.writer(f).writerow(columns)
+        self.writer = threading.Thread(target=self._write_clips, name='ClipRecorder writer', daemon=True)
+        self.writer.start()
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.framerate
+        self.recording = True
+        self.camera.start_recording(self, format='h264', intra_period=self.intra_period, inline_headers=True)
+        return self
+
+    # Save a clip around [t_ns] (clock.monotonic_ns(), default now). Safe to call from any thread, e.g. a
+    # PokeMonitor or PulseEngine listener.
+    def trigger(self, label='', t_ns=None):
+        t_ns = self.clock.monotonic_ns() if t_ns is None else t_ns
+        with self.lock:
+            if self.clip is not None:
+                self.clip['end_ns'] = max(self.clip['end_ns'], t_ns + self.post_ns)
+                self.clip['labels'].append(label)
+                return
+            gops = list(self.gops)
+            if self.saved is not None and self.saved in gops:
+                gops = gops[gops.index(self.saved) + 1:]
+            # The key frame interval holding the start of the window, and everything after it
+            first = 0
+            for i, gop in enumerate(gops):
+                if gop.start_ns is not None and gop.start_ns <= t_ns - self.pre_ns:
+                    first = i
+            self.clip = {'labels': [label], 'trigger_ns': t_ns, 'end_ns': t_ns + self.post_ns, 'gops': gops[first:]}
+
+    # Called by the camera with each piece of the encoded stream
+    def write(self, data):
+        with self.lock:
+            frame = self.camera.frame
+            self.bytes_seen += len(data)
+            if (frame is not None and frame.frame_type == SPS_HEADER) or not self.gops:
+                self._next_gop()
+            gop = self.gops[-1]
+            gop.chunks.append(data)
+            gop.nbytes += len(data)
+            self.buffered_bytes += len(data)
+            if frame is not None and frame.complete and frame.frame_type in (FRAME, KEY_FRAME):
+                t_ns, t = capture_time(self.camera, frame, self.clock)
+                if gop.start_ns is None:
+                    gop.start_ns = t_ns
+                gop.frames.append((self.frames, t_ns, t, frame.timestamp))
+                self.frames += 1
+        return len(data)
+
+    def _next_gop(self):  # caller holds self.lock
+        if self.clip is not None and self.gops:
+            last = self.gops[-1]
+            if self.clip['gops'][-1:] != [last]:
+                self.clip['gops'].append(last)
+            if last.frames and last.frames[-1][1] >= self.clip['end_ns']:
+                self._finish_clip()
+        gop = _Gop()
+        self.gops.append(gop)
+        # Keep only what a trigger now could still need: the interval holding now - pre_s, and the ones after it
+        keep_ns = self.clock.monotonic_ns() - self.pre_ns
+        while len(self.gops) > 2 and self.gops[1].start_ns is not None and self.gops[1].start_ns <= keep_ns:
+            self.buffered_bytes -= self.gops.popleft().nbytes
+        while len(self.gops) > 2 and self.buffered_bytes > self.max_bytes:
+            self.buffered_bytes -= self.gops.popleft().nbytes
+            self.overflows += 1
+
+    def _finish_clip(self):  # caller holds self.lock
+        clip, self.clip = self.clip, None
+        if not clip['gops']:
+            return
+        self.saved = clip['gops'][-1]
+        clip['number'] = self.clips
+        self.clips += 1
+        self.bytes_saved += sum(gop.nbytes for gop in clip['gops'])
+        self.queue.put(clip)
+
+    def _write_clips(self):
+        while True:
+            clip = self.queue.get()
+            if clip is None:
+                break
+            filename = os.path.join(self.directory, self.prefix + '_' + str(clip['number']).zfill(4) + '.h264')
+            frames = [frame for gop in clip['gops'] for frame in gop.frames]
+            with open(filename, 'wb') as f:
+                for gop in clip['gops']:
+                    f.writelines(gop.chunks)
+            with open(self.index_filename, 'a', newline='') as f:
+                csv.writer(f).writerows([frame, clip['number'], i, t_ns, '%.6f' % t, camera_us]
+                                        for i, (frame, t_ns, t, camera_us) in enumerate(frames))
+            times = ['', '', '']
+            if frames:  # the trigger's clock.time(), from the first frame's pair of clock readings
+                trigger = frames[0][2] + (clip['trigger_ns'] - frames[0][1]) / 1e9
+                times = ['%.6f' % t for t in (trigger, frames[0][2], frames[-1][2])]
+            with open(self.clips_filename, 'a', newline='') as f:
+                csv.writer(f).writerow([clip['number'], os.path.basename(filename), ' '.join(clip['labels'])] + times +
+                                       [len(frames), sum(gop.nbytes for gop in clip['gops'])])
+
+    # Stop recording, save the clip in progress (cut short) and wait for every clip to be written. Returns summary().
+    def stop(self):
+        if self.recording:
+            self.recording = False
+            self.camera.stop_recording()
+            with self.lock:
+                if self.clip is not None:
+                    if self.gops and self.clip['gops'][-1:] != [self.gops[-1]]:
+                        self.clip['gops'].append(self.gops[-1])
+                    self._finish_clip()
+            self.queue.put(None)
+            self.writer.join()
+        return self.summary()
+
+    def summary(self):
+        return {'frames': self.frames, 'clips': self.clips, 'overflows': self.overflows,
+                'saved_fraction': round(self.bytes_saved / self.bytes_seen, 4) if self.bytes_seen else 0.0,
+                'index': self.index_filename}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class SyntheticCamera:
+    # frame_bytes = size of each fake encoded frame. Frames are written from clock.call_later() callbacks, so on
+    # the VirtualClock they arrive while the task sleeps or waits, at their simulated capture times.
+    def __init__(self, resolution=(640, 480), framerate=30, frame_bytes=256, clock=None):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.frame_bytes = frame_bytes
+        self.clock = clock or rig_clock
+        self.frame = None
+        self.output = None
+        self.timer = None
+        self.closed = False
+
+    @property
+    def timestamp(self):  # the camera clock, in us
+        return self.clock.monotonic_ns() // 1000
+
+    def start_recording(self, output, format='h264', intra_period=None, **options):
+        self.output = output
+        self.intra_period = intra_period or int(round(self.framerate))
+        self.index = 0
+        self.start_ns = self.clock.monotonic_ns()
+        self._capture()
+
+    def _capture(self):  # write one frame (an SPS header first if it is a key frame), then schedule the next
+        output = self.output
+        if output is None:
+            return
+        key = self.index % self.intra_period == 0
+        if key:
+            self.frame = Frame(self.index, None, True, SPS_HEADER)
+            output.write(b'\x00\x00\x00\x01\x67')
+        self.frame = Frame(self.index, self.timestamp, True, KEY_FRAME if key else FRAME)
+        output.write(struct.pack('<4sQQ', b'\x00\x00\x00\x01', self.index, self.frame.timestamp)
+                     .ljust(self.frame_bytes, b'\x00'))
+        self.index += 1
+        due_ns = self.start_ns + int(self.index * 1e9 / self.framerate)
+        self.timer = self.clock.call_later(max(due_ns - self.clock.monotonic_ns(), 0) / 1e9, self._capture)
+
+    def wait_recording(self, timeout=0):
+        self.clock.sleep(timeout)
+
+    def stop_recording(self):
+        self.output = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def close(self):
+        self.stop_recording()
+        self.closed = True
+
+
+# Frame index of a VideoCapture, loaded for lookups by time
+class FrameIndex:
+    def __init__(self, filename):
+        self.filename = filename
+        self.directory = os.path.dirname(filename)
+        self.prefix = os.path.basename(filename)[:-len('_frames.csv')]
+        self.rows = []  # (frame, segment, segment_frame, t_ns, time)
+        with open(filename, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                self.rows.append((int(row[0]), int(row[1]), int(row[2]), int(row[3]), float(row[4])))
+        self.times = [row[4] for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def segment_filename(self, segment):
+        return os.path.join(self.directory, self.prefix + '_' + str(segment).zfill(4) + '.h264')
+
+    # Position in the index of the frame captured nearest to [t] (a clock.time() value, as in the event logs)
+    def nearest(self, t):
+        if not self.rows:
+            raise ValueError('no frames in ' + self.filename)
+        i = bisect.bisect_left(self.times, t)
+        if i == len(self.times) or (i > 0 and t - self.times[i - 1] <= self.times[i] - t):
+            i -= 1
+        return i
+
+    # (segment file, frame within the segment, seconds into the segment) of the frame nearest to [t], i.e. where a
+    # player or ffmpeg -ss should seek to
+    def seek(self, t):
+        i = self.nearest(t)
+        frame, segment, segment_frame, t_ns, frame_t = self.rows[i]
+        first = self.rows[i - segment_frame][4]
+        return self.segment_filename(segment), segment_frame, round(frame_t - first, 6)
+
+    # Index rows of the frames captured from [before] seconds before [t] to [after] seconds after it
+    def window(self, t, before=1.0, after=1.0):
+        return self.rows[bisect.bisect_left(self.times, t - before):bisect.bisect_right(self.times, t + after)]
+
+
+# [(event time, event name, seek(), window())] of every logged event starting with [event] in an EventLog CSV
+def event_frames(index, log_filename, event, before=1.0, after=1.0):
+    from replay import read_event_log
+    if not isinstance(index, FrameIndex):
+        index = FrameIndex(index)
+    matches = []
+    for session in read_event_log(log_filename):
+        for t, name in session:
+            if name.startswith(event) and index.rows and index.times[0] <= t <= index.times[-1]:
+                matches.append((t, name, index.seek(t), index.window(t, before, after)))
+    return matches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Frames of logged events')
+    parser.add_argument('index', help='<prefix>_frames.csv written by VideoCapture')
+    parser.add_argument('log', help='EventLog CSV of the same session')
+    parser.add_argument('event', help='event name (prefix), e.g. "Water_solenoid turned On"')
+    parser.add_argument('--before', type=float, default=1.0, help='seconds of frames before each event')
+    parser.add_argument('--after', type=float, default=1.0, help='seconds of frames after each event')
+    args = parser.parse_args()
+    for t, name, (segment, segment_frame, offset), frames in event_frames(args.index, args.log, args.event,
+                                                                          args.before, args.after):
+        print('%.3f  %s  %s frame %d (%.3f s)  frames %d-%d' % (t, name, os.path.basename(segment), segment_frame,
+                                                             offset, frames[0][0], frames[-1][0]))
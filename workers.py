@@ -0,0 +1,107 @@
+'''
+workers contains the session's pool of worker processes for side tasks
+
+Work that is not part of a trial (per-session summary statistics) is handed to a WorkerPool, which is started
+once per session: its processes are launched and warmed up before the first trial, so submitting a task never waits
+on process creation, and the trial loop never does the work itself. The queue is bounded: once [queue_size] tasks
+are waiting or running, submit() blocks until one finishes (or, with block=False, drops the task and counts it), so
+a slow disk cannot pile up unbounded work behind the rig.
+
+Tasks are module-level functions with picklable arguments (file names, numbers), never objects holding hardware
+such as the camera or GPIO. Failures are kept in [errors] and reported by summary(); they never reach the trial
+loop.
+'''
+
+import collections
+import concurrent.futures
+import csv
+import os
+import threading
+import time
+
+
+class WorkerPool:
+    # processes = worker processes, started and warmed up straight away. queue_size = tasks allowed waiting or
+    # running before submit() applies backpressure.
+    def __init__(self, processes=1, queue_size=16):
+        self.processes = processes
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.blocked = 0  # submit() calls that had to wait for a free slot
+        self.blocked_s = 0.0
+        self.errors = collections.deque(maxlen=100)  # (task name, repr of the exception)
+        # Launch every worker now: one task each, held until all of them are running
+        for future in [self.executor.submit(_warm, 0.05) for i in range(processes)]:
+            future.result()
+
+    # Run fn(*args, **kwargs) in a worker. Returns a concurrent.futures.Future, or None if the queue was full and
+    # block=False.
+    def submit(self, fn, *args, block=True, **kwargs):
+        if not self.slots.acquire(blocking=False):
+            if not block:
+                with self.lock:
+                    self.dropped += 1
+                return None
+            t0 = time.monotonic()
+            self.slots.acquire()
+            with self.lock:
+                self.blocked += 1
+                self.blocked_s += time.monotonic() - t0
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.submitted += 1
+        future.add_done_callback(lambda future: self._done(fn, future))
+        return future
+
+    def _done(self, fn, future):
+        self.slots.release()
+        with self.lock:
+            self.completed += 1
+            if not future.cancelled() and future.exception() is not None:
+                self.errors.append((getattr(fn, '__name__', str(fn)), repr(future.exception())))
+
+    # Wait for every submitted task, then stop the workers
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def summary(self):
+        with self.lock:
+            return {'submitted': self.submitted, 'completed': self.completed, 'failed': len(self.errors),
+                    'dropped': self.dropped, 'blocked': self.blocked, 'blocked_s': round(self.blocked_s, 3)}
+
+
+def _warm(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+# Side tasks
+
+# Count the events in an EventLog CSV ([time, event] rows) by name. If [output] is given, the counts are also
+# written there as a CSV. Returns {event name: count}.
+def log_summary(filename, output=None):
+    counts = collections.Counter()
+    with open(filename, newline='') as csvfile:
+        for row in csv.reader(csvfile):
+            if len(row) >= 2:
+                counts[row[1]] += 1
+    if output is not None:
+        with open(output, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['event', 'count'])
+            writer.writerows(sorted(counts.items()))
+    return dict(counts)